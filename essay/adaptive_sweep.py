@@ -0,0 +1,155 @@
+from autocomplete import AutocompleteExperiment, MIN_TEMP, MAX_TEMP
+from perplexity import PerplexityExperiment, STORE_COLUMNS, STORE_KEY, STORE_PATH as DENSE_STORE_PATH
+from utils.bloom import generate_text
+from utils.cache import PrefixCache
+from utils.sampling import SEED
+from utils.scoring import continuation_perplexities
+from utils.results import write_results
+from utils.store import ResultStore
+from utils.sweep import AdaptiveSweep, crossing_temperature, COARSE_POINTS, SWEEP_BUDGET
+import numpy as np
+import pandas as pd
+
+
+STORE_PATH = "essay/results/adaptive-perplexity-results.sqlite"
+GENERATED_STORE_PATH = "essay/results/adaptive-autocomplete-results.sqlite"
+RESULTS_PATH = "essay/results/adaptive-autocomplete-results"
+
+
+def temperature_seed(temp):
+    """ Seed for a temperature's row, fixed by its value so any sweep that tries it draws the same text """
+    return SEED + int(round(temp * 1000))
+
+
+class AdaptiveSweepExperiment(AutocompleteExperiment):
+    """
+    Autocomplete plus perplexity at each changepoint over an adaptively
+    chosen set of temperatures (see utils/sweep.py) instead of the dense
+    NUM_TEMPS-point grid. The metric is the log-perplexity of each
+    generated continuation, and the target is the actual output's, so
+    refinement concentrates where the generations look most like the
+    author's text and where the curve moves fastest.
+    """
+    def run(self, verbose=True, budget=SWEEP_BUDGET, coarse_points=COARSE_POINTS,
+            generated_store_path=GENERATED_STORE_PATH, store_path=STORE_PATH, **kwargs):
+        with self.open_store(generated_store_path) as generated_store, \
+                ResultStore(store_path, "perplexity", STORE_COLUMNS, STORE_KEY) as store:
+            completed = store.completed_keys()
+
+            essay = None
+            for i, name, j, prompt, prompt_short, actual_output in self.essay_units():
+                if i != essay:
+                    # Prompts within an essay are prefixes of one another
+                    essay, prefix_cache = i, PrefixCache()
+
+                if store.key({'essay': i, 'changepoint': j, 'temp': None}) in completed:
+                    continue
+                prompt_ids, actual_output_ids = self.token_ids(name, j)
+                generated_rows = []
+
+                def evaluate(temperatures):
+                    pred_outputs = generate_text(
+                        prompt, prompt_short, actual_output,
+                        model=self.model, tokenizer=self.tokenizer,
+                        temperatures=temperatures, batched=True,
+                        seeds=[temperature_seed(temp) for temp in temperatures],
+                        prefix_cache=prefix_cache,
+                        prompt_ids=prompt_ids, actual_output_ids=actual_output_ids,
+                        **kwargs
+                    )
+                    rows = [
+                        {
+                            'essay': i,
+                            'name': name,
+                            'changepoint': j,
+                            'full_prompt': prompt,
+                            'short_prompt': prompt_short,
+                            'act_output': actual_output,
+                            'temp': temp,
+                            'pred_output': pred_output
+                        }
+                        for temp, pred_output in zip(temperatures, pred_outputs)
+                    ]
+                    generated_rows.extend(rows)
+                    perplexities = continuation_perplexities(
+                        prompt, pred_outputs, self.model, self.tokenizer,
+                        prefix_cache=prefix_cache, prompt_ids=prompt_ids
+                    )
+                    return np.log(perplexities)
+
+                actual_perplexity = continuation_perplexities(
+                    prompt, [actual_output], self.model, self.tokenizer,
+                    prefix_cache=prefix_cache, prompt_ids=prompt_ids
+                )[0]
+                sweep = AdaptiveSweep(
+                    evaluate, np.log(actual_perplexity),
+                    min_temp=MIN_TEMP, max_temp=MAX_TEMP,
+                    coarse_points=coarse_points, budget=budget
+                )
+                results = sweep.run()
+
+                # Both stores are written once the sweep is done, so an
+                # interrupted changepoint is redone from scratch
+                generated_rows.sort(key=lambda row: row['temp'])
+                generated_store.append(generated_rows)
+                perplexities = [float(np.exp(results[row['temp']])) for row in generated_rows]
+                store.append(PerplexityExperiment.perplexity_rows(
+                    generated_rows, j, perplexities + [actual_perplexity]
+                ))
+                if verbose:
+                    print(
+                        f"Essay {i}, changepoint {j}: {len(results)} temperatures in {sweep.rounds} rounds, "
+                        f"actual perplexity reached at T = {sweep.crossing_temperature():.2f}"
+                    )
+
+            self.write_results(generated_store)
+
+    def write_results(self, store):
+        """ The adaptive sweep keeps its own report files next to the dense sweep's """
+        results_df = store.to_dataframe().sort_values(by=['essay', 'changepoint', 'temp'])
+        write_results(results_df, RESULTS_PATH)
+
+    @staticmethod
+    def compare_to_dense(store_path=STORE_PATH, dense_store_path=DENSE_STORE_PATH):
+        """
+        Per changepoint, the generations each sweep used, the temperature at
+        which each reaches the actual output's perplexity and the mean
+        absolute log-perplexity gap between the adaptive curve (interpolated)
+        and the dense one
+        """
+        with ResultStore(store_path, "perplexity", STORE_COLUMNS, STORE_KEY) as store:
+            adaptive = store.to_dataframe()
+        with ResultStore(dense_store_path, "perplexity", STORE_COLUMNS, STORE_KEY) as store:
+            dense = store.to_dataframe()
+
+        rows = []
+        for (i, j), dense_results in dense.groupby(['essay', 'changepoint']):
+            adaptive_results = adaptive[(adaptive['essay'] == i) & (adaptive['changepoint'] == j)]
+            if adaptive_results.empty:
+                continue
+            target = np.log(dense_results.loc[dense_results['temp'].isna(), 'perplexity'].iloc[0])
+            dense_curve = dense_results.dropna(subset=['temp']).sort_values('temp')
+            adaptive_curve = adaptive_results.dropna(subset=['temp']).sort_values('temp')
+            dense_log = np.log(dense_curve['perplexity'].to_numpy())
+            adaptive_log = np.log(adaptive_curve['perplexity'].to_numpy())
+            interpolated = np.interp(dense_curve['temp'], adaptive_curve['temp'], adaptive_log)
+
+            rows.append({
+                'essay': i,
+                'name': name,
+                'changepoint': j,
+                'dense_generations': len(dense_curve),
+                'adaptive_generations': len(adaptive_curve),
+                'dense_crossing': crossing_temperature(dense_curve['temp'], dense_log, target),
+                'adaptive_crossing': crossing_temperature(adaptive_curve['temp'], adaptive_log, target),
+                'mean_log_perplexity_gap': float(np.mean(np.abs(interpolated - dense_log)))
+            })
+
+        comparison = pd.DataFrame(rows)
+        comparison.to_csv("essay/results/adaptive-sweep-comparison.csv")
+        return comparison
+
+
+if __name__ == "__main__":
+    experiment = AdaptiveSweepExperiment()
+    experiment.run()
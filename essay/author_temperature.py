@@ -0,0 +1,91 @@
+from utils.corpus import strip_markers
+from utils.disk_cache import model_fingerprint
+from utils.registry import get_model
+from utils.temperature import LogitCache, cache_logits, fit_temperature, fit_windows
+import glob
+import hashlib
+import os
+import pandas as pd
+
+
+WINDOW_TOKENS = 256
+
+
+class AuthorTemperatureExperiment:
+    """
+    Estimates the sampling temperature that best explains each author's
+    actual tokens, over the whole essay, each changepoint's actual output
+    and sliding windows, from one cached pass of logits per essay
+    """
+    def __init__(self, data_glob="essay/data/essay-*.txt", precision="fp32"):
+        self.model, self.tokenizer = get_model("essay/models/bloom-1b1", precision=precision)
+        self.essay_paths = sorted(glob.glob(data_glob))
+
+    @staticmethod
+    def cache_path(essay_path):
+        name = os.path.splitext(os.path.basename(essay_path))[0]
+        return f"essay/results/logits-{name}.npz"
+
+    def load_cache(self, essay_path, text):
+        """
+        The essay's LogitCache, computed and saved on first use and again
+        whenever the essay's text or the model (its weights or precision)
+        differs from the one the saved logits came from
+        """
+        path = self.cache_path(essay_path)
+        source = {
+            'text_sha256': hashlib.sha256(text.encode("utf8")).hexdigest(),
+            'model': model_fingerprint(self.model)
+        }
+        if os.path.exists(path):
+            cache = LogitCache.load(path)
+            if cache.metadata == source:
+                return cache
+        cache = cache_logits(text, self.model, self.tokenizer)
+        cache.metadata = source
+        cache.save(path)
+        return cache
+
+    def run(self, verbose=True, window=WINDOW_TOKENS, step=None):
+        results = []
+        for essay_path in self.essay_paths:
+            name = os.path.splitext(os.path.basename(essay_path))[0]
+            with open(essay_path, 'r', encoding="utf8") as f:
+                text, changepoints = strip_markers(f.read())
+            cache = self.load_cache(essay_path, text)
+
+            temperature, log_likelihood = fit_temperature(cache)
+            results.append({
+                'essay': name, 'scope': 'essay', 'char_start': 0, 'char_end': len(text),
+                'temperature': temperature, 'log_likelihood': log_likelihood, 'num_tokens': len(cache)
+            })
+
+            for j, (_, change, end) in enumerate(changepoints):
+                rows = cache.select(change, end)
+                if len(rows) == 0:
+                    continue
+                temperature, log_likelihood = fit_temperature(cache, rows)
+                results.append({
+                    'essay': name, 'scope': f'changepoint-{j}', 'char_start': change, 'char_end': end,
+                    'temperature': temperature, 'log_likelihood': log_likelihood, 'num_tokens': len(rows)
+                })
+
+            for start, temperature, mean_log_likelihood in fit_windows(cache, window, step):
+                char_start = int(cache.char_start[start])
+                char_end = int(cache.char_start[start + window]) if start + window < len(cache) else len(text)
+                results.append({
+                    'essay': name, 'scope': 'window', 'char_start': char_start, 'char_end': char_end,
+                    'temperature': temperature, 'log_likelihood': mean_log_likelihood * window, 'num_tokens': window
+                })
+
+            if verbose:
+                essay_rows = [r for r in results if r['essay'] == name and r['scope'] != 'window']
+                for r in essay_rows:
+                    print(f"{name} {r['scope']}: T = {r['temperature']:.3f} over {r['num_tokens']} tokens")
+
+        pd.DataFrame(results).to_csv("essay/results/author-temperature.csv")
+
+
+if __name__ == "__main__":
+    experiment = AuthorTemperatureExperiment()
+    experiment.run()
@@ -1,21 +1,47 @@
-from utils.bloom import load_model, generate_text
+from utils.bloom import generate_text
+from utils.cache import PrefixCache
+from utils.corpus import Corpus
+from utils.ingest import iter_work_units, parse_essay, IngestStats, DATA_SOURCE
+from utils.profiling import span
+from utils.registry import get_model
+from utils.results import write_results
+from utils.seed import SEED
+from utils.store import ResultStore
 import numpy as np
-import pandas as pd
-import re
+import os
 
 
 MIN_TEMP = 0.1
 MAX_TEMP = 2.0
 NUM_TEMPS = 20
-NUM_ESSAYS = 4
 LINEBREAK = "-" * 80 + "\n"
+STORE_PATH = "essay/results/autocomplete-results.sqlite"
+STORE_COLUMNS = ['essay', 'name', 'changepoint', 'full_prompt', 'short_prompt', 'act_output', 'temp', 'pred_output']
+STORE_KEY = ['essay', 'changepoint', 'temp']
+RESULTS_PATH = "essay/results/autocomplete-results"
 
 class AutocompleteExperiment:
-    def __init__(self):
-        self.model, self.tokenizer = load_model("essay/models/bloom-1b1")
+    def __init__(self, corpus_path=None, precision="fp32", data_source=DATA_SOURCE, backend="eager"):
+        self.model, self.tokenizer = get_model("essay/models/bloom-1b1", precision=precision, backend=backend)
         self.temperatures = np.linspace(MIN_TEMP, MAX_TEMP, NUM_TEMPS)
-        self.essay_nums = range(1, NUM_ESSAYS+1)
-        self.essays = [self.read_essay(f"essay/data/essay-{i}.txt") for i in self.essay_nums]
+        # Directory or glob of essays, streamed by essay_units
+        self.data_source = data_source
+        # Pre-tokenized prompts, see utils/corpus.py
+        self.corpus = Corpus(corpus_path) if corpus_path else None
+
+    def essay_units(self, stats=None):
+        """ Changepoints of every essay in data_source, read lazily (see utils/ingest.py) """
+        return iter_work_units(self.data_source, stats)
+
+    def token_ids(self, name, changepoint):
+        """
+        (prompt ids, actual output ids) from the corpus, or Nones to tokenize
+        the strings; name is the essay's file name without its suffix, as
+        the corpus and EssayUnit.name give it
+        """
+        if self.corpus is None:
+            return None, None
+        return self.corpus.prompt_ids(name, changepoint), self.corpus.actual_output_ids(name, changepoint)
 
     @staticmethod
     def extract_prompt(essay, change, start=0):
@@ -28,20 +54,10 @@ class AutocompleteExperiment:
            
         return prompt
 
-    def read_essay(self, filepath):
+    @classmethod
+    def read_essay(cls, filepath):
         with open(filepath, 'r', encoding="utf8") as f:
-            essay = f.read()
-
-        start_indices = [i.start() for i in re.finditer('\[START\]', essay)]
-        change_indices = [i.start() for i in re.finditer('\[CHANGEPOINT\]', essay)]
-        end_indices = [i.start() for i in re.finditer('\[END\]', essay)]
-
-        if len(start_indices) != len(change_indices) or len(change_indices) != len(end_indices):
-            raise ValueError("Number of start, change, and end indices must be equal")
-
-        prompts = [self.extract_prompt(essay, change) for change in change_indices]
-        prompts_short = [self.extract_prompt(essay, change, start) for change, start in zip(change_indices, start_indices)]
-        actual_outputs = [self.extract_prompt(essay, end, change) for end, change in zip(end_indices, change_indices)]
+            prompts, prompts_short, actual_outputs = parse_essay(f.read())
 
         output = {
             'prompts': prompts,
@@ -52,44 +68,100 @@ class AutocompleteExperiment:
         return output
 
 
-    def run(self, verbose=True, **kwargs):
-        results_df = pd.DataFrame(columns=['essay', 'full_prompt', 'short_prompt', 'act_output', 'temp', 'pred_output'])
+    @staticmethod
+    def write_prompt_report(f, prompt_short, actual_output, temperatures, pred_outputs):
+        f.write(LINEBREAK + LINEBREAK)
+        f.write(f"Prompt: {prompt_short}\n")
+        f.write(LINEBREAK)
+        f.write(f"Actual Output: {actual_output}\n")
+        f.write(LINEBREAK)
+        for pred_output, temp in zip(pred_outputs, temperatures):
+            f.write(f"Predicted Output (w/temp {temp}): {pred_output}\n")
+            f.write(LINEBREAK)
+        f.write(LINEBREAK + "\n\n")
+
+    @staticmethod
+    def open_store(path=STORE_PATH):
+        return ResultStore(path, "autocomplete", STORE_COLUMNS, STORE_KEY)
+
+    def run(self, verbose=True, batched=True, store_path=STORE_PATH, **kwargs):
+        with self.open_store(store_path) as store:
+            completed = store.completed_keys()
+
+            stats = IngestStats()
+            essay = None
+            for i, name, j, prompt, prompt_short, actual_output in self.essay_units(stats):
+                if i != essay:
+                    essay = i
+                    if verbose:
+                        print(f"Running essay {i+1}...")
+                    # Prompts within an essay are prefixes of one another
+                    prefix_cache = PrefixCache() if batched else None
+                    draft_prefix_cache = PrefixCache() if kwargs.get('draft_model') is not None else None
+
+                pending = [
+                    (k, temp) for k, temp in enumerate(self.temperatures)
+                    if store.key({'essay': i, 'changepoint': j, 'temp': temp}) not in completed
+                ]
+                if not pending:
+                    continue
+
+                temp_nums, temps = zip(*pending)
+                prompt_ids, actual_output_ids = self.token_ids(name, j)
+                pred_outputs = generate_text(
+                    prompt, prompt_short, actual_output, 
+                    model=self.model, tokenizer=self.tokenizer, 
+                    temperatures=list(temps),
+                    verbose=verbose, batched=batched,
+                    # Resumed temperatures keep the seeds of the full sweep
+                    seeds=[SEED + k for k in temp_nums] if batched else None,
+                    prefix_cache=prefix_cache,
+                    draft_prefix_cache=draft_prefix_cache,
+                    prompt_ids=prompt_ids, actual_output_ids=actual_output_ids,
+                    **kwargs
+                )
+
+                with span("store", rows=len(pred_outputs)):
+                    store.append(
+                        {
+                            'essay': i,
+                            'name': name,
+                            'changepoint': j,
+                            'full_prompt': prompt,
+                            'short_prompt': prompt_short,
+                            'act_output': actual_output,
+                            'temp': temp,
+                            'pred_output': pred_output
+                        }
+                        for temp, pred_output in zip(temps, pred_outputs)
+                    )
 
-        for i, essay in zip(self.essay_nums, self.essays):
             if verbose:
-                print(f"Running essay {i+1}...")
-            prompts = essay['prompts']
-            prompts_short = essay['prompts_short']
-            actual_outputs = essay['actual_outputs']
-
-            with open(f"essay/results/autocomplete-results-essay-{i+1}.txt", 'w') as f:
-                for prompt, prompt_short, actual_output in zip(prompts, prompts_short, actual_outputs):
-                    pred_outputs = generate_text(
-                        prompt, prompt_short, actual_output, 
-                        model=self.model, tokenizer=self.tokenizer, 
-                        temperatures=self.temperatures,
-                        verbose=verbose, **kwargs
+                print(stats.report())
+
+            with span("write_results"):
+                self.write_results(store)
+
+    def write_results(self, store):
+        """
+        Write the text reports and columnar results (see utils/results.py)
+        from everything in the store, next to it and named after it, so a
+        run with its own store (e.g. a --stop mode) keeps its own results;
+        the default store's are RESULTS_PATH
+        """
+        results_df = store.to_dataframe().sort_values(by=['essay', 'changepoint', 'temp'])
+        results_path = os.path.splitext(store.path)[0]
+
+        for i, essay_results in results_df.groupby('essay'):
+            with open(f"{results_path}-essay-{i+1}.txt", 'w') as f:
+                for _, prompt_results in essay_results.groupby('changepoint'):
+                    first = prompt_results.iloc[0]
+                    self.write_prompt_report(
+                        f, first['short_prompt'], first['act_output'],
+                        prompt_results['temp'], prompt_results['pred_output']
                     )
-                    f.write(LINEBREAK + LINEBREAK)
-                    f.write(f"Prompt: {prompt_short}\n")
-                    f.write(LINEBREAK)
-                    f.write(f"Actual Output: {actual_output}\n")
-                    f.write(LINEBREAK)
-                    for pred_output, temp in zip(pred_outputs, self.temperatures):
-                        f.write(f"Predicted Output (w/temp {temp}): {pred_output}\n")
-                        f.write(LINEBREAK)
-                    f.write(LINEBREAK + "\n\n")
-
-                    prompt_results = pd.DataFrame({
-                        'essay': [i] * len(self.temperatures), 
-                        'full_prompt': [prompt] * len(self.temperatures), 
-                        'short_prompt': [prompt_short] * len(self.temperatures), 
-                        'act_output': [actual_output] * len(self.temperatures), 
-                        'temp': self.temperatures, 
-                        'pred_output': pred_outputs
-                    })
-                    results_df = results_df.append(prompt_results, ignore_index=True)
-        results_df.to_csv("essay/results/autocomplete-results.csv")
+
+        write_results(results_df, results_path)
 
 
 
@@ -0,0 +1,118 @@
+from utils.bloom import load_model, calculate_perplexity, BACKENDS
+from utils.compiled import set_backend, backend_stats
+from utils.ingest import DATA_SOURCE, iter_work_units
+import pandas as pd
+import time
+import torch
+
+
+MODEL_PATH = "essay/models/bloom-1b1"
+REFERENCE_BACKEND = "eager"
+MAX_LOGIT_DIFFERENCE = 1e-3
+MAX_RELATIVE_ERROR = 1e-4
+
+
+class BackendExperiment:
+    """
+    Checks the compiled backends against eager PyTorch on the essays: the
+    logits at every scored position of each changepoint's actual output and
+    its perplexity must match, and the time for the first pass (which
+    compiles or traces each sequence bucket) and the throughput of a second
+    one are recorded. The model is loaded once and its backend swapped in
+    place.
+    """
+    def __init__(self, backends=BACKENDS, model_path=MODEL_PATH, data_source=DATA_SOURCE):
+        self.backends = [REFERENCE_BACKEND] + [b for b in backends if b != REFERENCE_BACKEND]
+        self.model, self.tokenizer = load_model(model_path)
+        self.units = [
+            (unit.essay, unit.changepoint, unit.prompt, unit.actual_output)
+            for unit in iter_work_units(data_source)
+        ]
+
+    def score(self):
+        """ Logits at the actual output's positions and its perplexity, per changepoint """
+        scores = {}
+        num_tokens = 0
+        for i, j, prompt, actual_output in self.units:
+            prompt_length = self.tokenizer(prompt, return_tensors='pt').input_ids.shape[1]
+            full_text = prompt + actual_output
+            input_ids = self.tokenizer(full_text, return_tensors='pt').input_ids
+            num_tokens += input_ids.shape[1]
+            with torch.no_grad():
+                logits = self.model(input_ids, use_cache=False).logits[0, prompt_length-1:-1]
+            perplexity = calculate_perplexity(
+                full_text,
+                model=self.model, tokenizer=self.tokenizer,
+                start_calculating_at=prompt_length
+            )
+            scores[(i, j)] = (logits, perplexity)
+        return scores, num_tokens
+
+    def measure(self, backend, verbose=True):
+        set_backend(self.model, backend)
+        start = time.perf_counter()
+        self.score()
+        warmup_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        scores, num_tokens = self.score()
+        score_seconds = time.perf_counter() - start
+
+        summary = {
+            'backend': backend,
+            'warmup_seconds': warmup_seconds,
+            'tokens_per_second': num_tokens / score_seconds,
+            **{key: value for key, value in backend_stats(self.model).items() if key != 'backend'}
+        }
+        if verbose:
+            print(
+                f"{backend}: first pass {warmup_seconds:.1f}s, "
+                f"then {summary['tokens_per_second']:.0f} tokens/s"
+            )
+        return scores, summary
+
+    def run(self, verbose=True, max_logit_difference=MAX_LOGIT_DIFFERENCE,
+            max_relative_error=MAX_RELATIVE_ERROR):
+        results = []
+        summaries = []
+        reference = None
+        for backend in self.backends:
+            scores, summary = self.measure(backend, verbose=verbose)
+            summaries.append(summary)
+            if reference is None:
+                reference = scores
+            for (i, j), (logits, perplexity) in scores.items():
+                reference_logits, reference_perplexity = reference[(i, j)]
+                results.append({
+                    'essay': i,
+                    'changepoint': j,
+                    'backend': backend,
+                    'perplexity': perplexity,
+                    'reference_perplexity': reference_perplexity,
+                    'relative_error': abs(perplexity - reference_perplexity) / reference_perplexity,
+                    'max_logit_difference': (logits - reference_logits).abs().max().item()
+                })
+        set_backend(self.model, REFERENCE_BACKEND)
+
+        results_df = pd.DataFrame(results)
+        results_df.to_csv("essay/results/backend-results.csv")
+
+        summary_df = pd.DataFrame(summaries).set_index('backend')
+        summary_df['speedup'] = (
+            summary_df['tokens_per_second'] / summary_df.loc[REFERENCE_BACKEND, 'tokens_per_second']
+        )
+        grouped = results_df.groupby('backend')
+        summary_df['max_logit_difference'] = grouped['max_logit_difference'].max()
+        summary_df['max_relative_error'] = grouped['relative_error'].max()
+        summary_df['passed'] = (
+            (summary_df['max_logit_difference'] <= max_logit_difference)
+            & (summary_df['max_relative_error'] <= max_relative_error)
+        )
+        if verbose:
+            print(summary_df.to_string())
+
+        return summary_df
+
+
+if __name__ == "__main__":
+    experiment = BackendExperiment()
+    experiment.run()
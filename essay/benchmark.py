@@ -0,0 +1,262 @@
+from autocomplete import MIN_TEMP, MAX_TEMP, NUM_TEMPS
+from utils.bloom import load_model, generate_text, generate_probabilities, calculate_perplexity, stream_text
+from utils.ingest import DATA_SOURCE, iter_work_units
+from utils.registry import MODEL_PATH
+from utils.resources import peak_resident_memory
+import argparse
+import glob
+import json
+import numpy as np
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import torch
+
+
+BASELINE_PATH = "essay/results/benchmark-baseline.json"
+TINY_MODEL_PATH = os.path.join(tempfile.gettempdir(), "essay-bloom-tiny")
+TINY_VOCAB_SIZE = 1000
+TINY_CONFIG = {'hidden_size': 64, 'n_layer': 2, 'n_head': 4}
+PROMPT_TOKENS = 512
+MAX_NEW_TOKENS = 20
+NUM_REPEATS = 3
+REGRESSION_TOLERANCE = 0.2
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Commands timed from a fresh interpreter; torch_transformers is what every
+# one of them paid at startup before those imports were made lazy
+COLD_START_COMMANDS = {
+    'import_autocomplete': ["-c", "import autocomplete"],
+    'import_bloom': ["-c", "import utils.bloom"],
+    'cli_help': ["main.py", "--help"],
+    'cli_plan': ["main.py", "plan"],
+    'torch_transformers': ["-c", "import torch, transformers"]
+}
+BENCHMARKS = ['cold_start', 'load_model', 'generate_text', 'time_to_first_token',
+              'generate_probabilities', 'calculate_perplexity']
+
+
+def build_tiny_model(model_path=TINY_MODEL_PATH, data_glob="essay/data/essay-*.txt", seed=0):
+    """
+    Save a randomly initialized BLOOM small enough to benchmark in seconds,
+    with a byte-level BPE tokenizer trained on the essays, so the
+    benchmark runs offline without the real weights
+    """
+    from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+    from transformers import BloomConfig, BloomForCausalLM, BloomTokenizerFast
+
+    special_tokens = ["<unk>", "<s>", "</s>", "<pad>"]
+    bpe = Tokenizer(models.BPE(unk_token="<unk>"))
+    bpe.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    bpe.decoder = decoders.ByteLevel()
+    bpe.train(sorted(glob.glob(data_glob)), trainers.BpeTrainer(
+        vocab_size=TINY_VOCAB_SIZE,
+        special_tokens=special_tokens,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet(),
+        show_progress=False
+    ))
+    tokenizer = BloomTokenizerFast(
+        tokenizer_object=bpe, unk_token="<unk>", bos_token="<s>", eos_token="</s>", pad_token="<pad>"
+    )
+
+    torch.manual_seed(seed)
+    config = BloomConfig(
+        vocab_size=len(tokenizer), bos_token_id=1, eos_token_id=2, pad_token_id=3, **TINY_CONFIG
+    )
+    model = BloomForCausalLM(config)
+    model.save_pretrained(model_path)
+    tokenizer.save_pretrained(model_path)
+    return model_path
+
+
+def compare(baseline, results, tolerance=REGRESSION_TOLERANCE):
+    """
+    Regressions of results against baseline, one message per metric that
+    got worse by more than tolerance (relative). Rates (*_per_second) should
+    go up; times and memory should go down.
+    """
+    regressions = []
+    for name, metrics in results['benchmarks'].items():
+        for metric, value in metrics.items():
+            reference = baseline['benchmarks'].get(name, {}).get(metric)
+            if not reference:
+                continue
+            change = (value - reference) / reference
+            worse = -change if metric.endswith("_per_second") else change
+            if worse > tolerance:
+                regressions.append(f"{name}.{metric}: {reference:.4g} -> {value:.4g} ({100 * change:+.0f}%)")
+    return regressions
+
+
+class Benchmark:
+    """
+    Times the pipeline's hot paths on the bundled essays: model loading,
+    generate_text over the temperature sweep, time to first token,
+    generate_probabilities and calculate_perplexity.
+
+    By default the model is a tiny random BLOOM (see build_tiny_model);
+    real=True uses the real weights instead. Each timing is the median of
+    repeats runs after one warm-up run.
+    """
+    def __init__(self, real=False, model_path=None, repeats=NUM_REPEATS,
+                 prompt_tokens=PROMPT_TOKENS, max_new_tokens=MAX_NEW_TOKENS, data_source=DATA_SOURCE):
+        self.real = real
+        self.model_path = model_path or (MODEL_PATH if real else TINY_MODEL_PATH)
+        if not real and not os.path.exists(os.path.join(self.model_path, "config.json")):
+            build_tiny_model(self.model_path)
+        self.repeats = repeats
+        self.prompt_tokens = prompt_tokens
+        self.max_new_tokens = max_new_tokens
+        self.temperatures = np.linspace(MIN_TEMP, MAX_TEMP, NUM_TEMPS)
+        self.units = [(unit.prompt, unit.actual_output) for unit in iter_work_units(data_source)]
+        self.model, self.tokenizer = None, None
+
+    def _median_seconds(self, fn, warmup=True):
+        if warmup:
+            fn()
+        timings = []
+        for _ in range(self.repeats):
+            start = time.perf_counter()
+            fn()
+            timings.append(time.perf_counter() - start)
+        return float(np.median(timings))
+
+    def _prompts(self):
+        """ (prompt, actual output) at every changepoint, prompts cut to their last prompt_tokens tokens """
+        for prompt, actual_output in self.units:
+            ids = self.tokenizer(prompt).input_ids[-self.prompt_tokens:]
+            yield self.tokenizer.decode(ids), actual_output
+
+    def bench_cold_start(self):
+        """ Wall time of each COLD_START_COMMANDS entry in a new Python process """
+        env = {**os.environ, 'PYTHONPATH': os.path.join(REPO_ROOT, "essay")}
+        metrics = {}
+        for name, command in COLD_START_COMMANDS.items():
+            metrics[f"{name}_seconds"] = self._median_seconds(lambda: subprocess.run(
+                [sys.executable, *command], cwd=REPO_ROOT, env=env,
+                check=True, stdout=subprocess.DEVNULL
+            ))
+        return metrics
+
+    def bench_load_model(self):
+        start = time.perf_counter()
+        self.model, self.tokenizer = load_model(self.model_path)
+        return {'load_seconds': time.perf_counter() - start}
+
+    def bench_generate_text(self):
+        prompts = [prompt for prompt, _ in self._prompts()]
+
+        def run():
+            for prompt in prompts:
+                generate_text(
+                    prompt, prompt, '',
+                    model=self.model, tokenizer=self.tokenizer,
+                    temperatures=self.temperatures, batched=True,
+                    max_new_tokens=self.max_new_tokens
+                )
+
+        seconds = self._median_seconds(run)
+        num_tokens = len(prompts) * len(self.temperatures) * self.max_new_tokens
+        return {'seconds': seconds, 'tokens_per_second': num_tokens / seconds}
+
+    def bench_time_to_first_token(self):
+        prompts = [prompt for prompt, _ in self._prompts()]
+        first_token_seconds = []
+
+        def run():
+            for prompt in prompts:
+                stream = stream_text(prompt, model=self.model, tokenizer=self.tokenizer, max_new_tokens=1)
+                first_token_seconds.append(next(stream).elapsed)
+                stream.close()
+
+        # Only the timed repeats count, not the cold warm-up call
+        run()
+        first_token_seconds.clear()
+        self._median_seconds(run, warmup=False)
+        return {'seconds': float(np.median(first_token_seconds))}
+
+    def bench_generate_probabilities(self):
+        prompts = [prompt for prompt, _ in self._prompts()]
+        num_tokens = sum(len(self.tokenizer(prompt).input_ids) for prompt in prompts)
+
+        def run():
+            for prompt in prompts:
+                generate_probabilities(prompt, model=self.model, tokenizer=self.tokenizer)
+
+        seconds = self._median_seconds(run)
+        return {'seconds': seconds, 'tokens_per_second': num_tokens / seconds}
+
+    def bench_calculate_perplexity(self):
+        texts = []
+        for prompt, actual_output in self._prompts():
+            prompt_length = len(self.tokenizer(prompt).input_ids)
+            texts.append((prompt + actual_output, prompt_length))
+        num_tokens = sum(len(self.tokenizer(text).input_ids) for text, _ in texts)
+
+        def run():
+            for text, prompt_length in texts:
+                calculate_perplexity(
+                    text, model=self.model, tokenizer=self.tokenizer,
+                    start_calculating_at=prompt_length
+                )
+
+        seconds = self._median_seconds(run)
+        return {'seconds': seconds, 'tokens_per_second': num_tokens / seconds}
+
+    def run(self, verbose=True, names=BENCHMARKS):
+        benchmarks = {}
+        # Loading comes before the rest: every later benchmark uses the loaded model
+        for name in names:
+            metrics = getattr(self, f"bench_{name}")()
+            metrics['peak_rss_bytes'] = peak_resident_memory()
+            benchmarks[name] = metrics
+            if verbose:
+                print(f"{name}: " + ", ".join(f"{metric} {value:.4g}" for metric, value in metrics.items()))
+
+        return {
+            'model_path': self.model_path,
+            'real': self.real,
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'threads': torch.get_num_threads(),
+            'benchmarks': benchmarks
+        }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the essay pipeline")
+    parser.add_argument("--real", action="store_true",
+                        help=f"use the real model at {MODEL_PATH} instead of a tiny random one")
+    parser.add_argument("--repeats", type=int, default=NUM_REPEATS)
+    parser.add_argument("--data", metavar="DIR_OR_GLOB", default=DATA_SOURCE,
+                        help="directory (searched recursively for .txt files) or glob of marked-up essays")
+    parser.add_argument("--baseline", default=BASELINE_PATH,
+                        help="baseline JSON to compare against")
+    parser.add_argument("--save-baseline", action="store_true",
+                        help="write these results as the new baseline")
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS,
+                        help="run just these benchmarks (anything after load_model needs it too)")
+    parser.add_argument("--tolerance", type=float, default=REGRESSION_TOLERANCE,
+                        help="relative slowdown flagged as a regression")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = Benchmark(real=args.real, repeats=args.repeats, data_source=args.data).run(names=args.only)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['real'] != results['real']:
+            sys.exit(f"Baseline {args.baseline} was recorded with real={baseline['real']}")
+        regressions = compare(baseline, results, tolerance=args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,173 @@
+from autocomplete import AutocompleteExperiment, MIN_TEMP, MAX_TEMP, NUM_TEMPS, STORE_PATH
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+import multiprocessing
+from utils.bloom import generate_text
+from utils.cache import PrefixCache
+from utils.corpus import Corpus
+from utils.ingest import DATA_SOURCE
+from utils.profiling import TRACER
+from utils.registry import REGISTRY, get_model
+from utils.sampling import SEED
+import numpy as np
+import os
+import time
+import torch
+
+
+MODEL_PATH = "essay/models/bloom-1b1"
+# Work units handed to the pool at a time, so memory stays flat however
+# many essays the data source holds
+MAX_QUEUED_UNITS = 64
+
+# Per-process state, set once by the pool initializer
+_model = None
+_tokenizer = None
+_prefix_cache = None
+_corpus = None
+_draft_model = None
+_draft_prefix_cache = None
+_kwargs = {}
+
+
+def threads_per_worker(workers):
+    """ Split the machine's cores evenly so workers don't oversubscribe them """
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+def _init_worker(model_path, num_threads, corpus_path=None, precision="fp32", backend="eager",
+                 draft_path=None, kwargs=None):
+    global _model, _tokenizer, _prefix_cache, _corpus, _draft_model, _draft_prefix_cache, _kwargs
+    torch.set_num_threads(num_threads)
+    # A forked worker starts with a copy of the parent's spans; only its own go back
+    TRACER.clear()
+    # Already in the registry when the pool was forked from a preloaded parent
+    _model, _tokenizer = get_model(model_path, precision=precision, backend=backend)
+    _prefix_cache = PrefixCache()
+    # Every worker maps the same token file, so the pages are shared
+    _corpus = Corpus(corpus_path) if corpus_path else None
+    if draft_path:
+        _draft_model, _ = get_model(draft_path, precision=precision)
+        _draft_prefix_cache = PrefixCache()
+    # generate_text's options (e.g. a DiskCache) reach each worker once, not with every unit
+    _kwargs = kwargs or {}
+
+
+def _run_unit(unit):
+    """ Generate the continuations for one (essay, changepoint) at its pending temperatures """
+    (essay_num, prompt_num, temp_nums), (name, prompt, prompt_short, actual_output, temps) = unit
+    prompt_ids, actual_output_ids = None, None
+    if _corpus is not None:
+        prompt_ids = _corpus.prompt_ids(name, prompt_num)
+        actual_output_ids = _corpus.actual_output_ids(name, prompt_num)
+
+    # One batched sweep over the shared prompt encoding, as the serial run does
+    pred_outputs = generate_text(
+        prompt, prompt_short, actual_output,
+        model=_model, tokenizer=_tokenizer,
+        temperatures=list(temps),
+        batched=True,
+        # Same seeds the serial batched sweep gives these temperatures' rows
+        seeds=[SEED + k for k in temp_nums],
+        prefix_cache=_prefix_cache,
+        draft_model=_draft_model,
+        draft_prefix_cache=_draft_prefix_cache,
+        prompt_ids=prompt_ids,
+        actual_output_ids=actual_output_ids,
+        **_kwargs
+    )
+
+    # The worker's spans go back with its result, so the parent's trace covers the run
+    return (essay_num, prompt_num, temp_nums), pred_outputs, TRACER.drain()
+
+
+class ParallelAutocompleteExperiment(AutocompleteExperiment):
+    """
+    Runs the autocomplete experiment with (essay, changepoint) work units,
+    each a batched sweep over its pending temperatures, spread across a
+    pool of processes that each hold one model
+    """
+    def __init__(self, workers=None, model_path=MODEL_PATH, corpus_path=None, precision="fp32",
+                 share_weights=True, data_source=DATA_SOURCE, backend="eager", draft_path=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.model_path = model_path
+        self.corpus_path = corpus_path
+        self.precision = precision
+        self.backend = backend
+        # Smaller model for speculative decoding, loaded by each worker
+        self.draft_path = draft_path
+        # Load once in the parent and fork, so workers share the weights
+        # copy-on-write instead of each loading a copy
+        self.share_weights = share_weights and "fork" in multiprocessing.get_all_start_methods()
+        self.temperatures = np.linspace(MIN_TEMP, MAX_TEMP, NUM_TEMPS)
+        self.data_source = data_source
+
+    def work_units(self, store, completed):
+        """ One unit per changepoint with temperatures left to generate """
+        for i, name, j, prompt, prompt_short, actual_output in self.essay_units():
+            pending = [
+                (k, temp) for k, temp in enumerate(self.temperatures)
+                if store.key({'essay': i, 'changepoint': j, 'temp': temp}) not in completed
+            ]
+            if pending:
+                temp_nums, temps = zip(*pending)
+                yield (i, j, temp_nums), (name, prompt, prompt_short, actual_output, temps)
+
+    def run(self, verbose=True, store_path=STORE_PATH, **kwargs):
+        with self.open_store(store_path) as store:
+            completed = store.completed_keys()
+            units = self.work_units(store, completed)
+
+            if verbose:
+                print(f"Running work units on {self.workers} workers...")
+            num_outputs = 0
+            start = time.perf_counter()
+            mp_context = None
+            if self.share_weights:
+                get_model(self.model_path, precision=self.precision, backend=self.backend)
+                if self.draft_path:
+                    get_model(self.draft_path, precision=self.precision)
+                mp_context = multiprocessing.get_context("fork")
+            with ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=mp_context,
+                initializer=_init_worker,
+                initargs=(
+                    self.model_path, threads_per_worker(self.workers),
+                    self.corpus_path, self.precision, self.backend,
+                    self.draft_path, kwargs
+                )
+            ) as executor:
+                while batch := list(islice(units, MAX_QUEUED_UNITS)):
+                    results = executor.map(_run_unit, batch)
+                    # Results arrive in unit order and are committed as they come
+                    for ((i, j, _), (name, prompt, prompt_short, actual_output, temps)), (_, pred_outputs, spans) in zip(batch, results):
+                        TRACER.merge(spans)
+                        store.append(
+                            {
+                                'essay': i,
+                                'name': name,
+                                'changepoint': j,
+                                'full_prompt': prompt,
+                                'short_prompt': prompt_short,
+                                'act_output': actual_output,
+                                'temp': temp,
+                                'pred_output': pred_output
+                            }
+                            for temp, pred_output in zip(temps, pred_outputs)
+                        )
+                        num_outputs += len(pred_outputs)
+            elapsed = time.perf_counter() - start
+            if verbose:
+                print(f"Generated {num_outputs} outputs in {elapsed:.1f}s")
+                if self.share_weights:
+                    print(REGISTRY.report())
+
+            self.write_results(store)
+
+        return elapsed
+
+
+if __name__=="__main__":
+    experiment = ParallelAutocompleteExperiment()
+    experiment.run()
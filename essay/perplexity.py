@@ -1,68 +1,107 @@
-from utils.bloom import load_model, calculate_perplexity
-import pandas as pd
+from autocomplete import RESULTS_PATH as AUTOCOMPLETE_RESULTS_PATH
+from utils.cache import PrefixCache
+from utils.corpus import Corpus
+from utils.registry import get_model
+from utils.scoring import continuation_perplexities
+from utils.results import ResultsTable, PREDICTED, exists, read_legacy_csv, write_results
+from utils.store import ResultStore
+
+
+STORE_PATH = "essay/results/perplexity-results.sqlite"
+STORE_COLUMNS = ['essay', 'name', 'changepoint', 'full_prompt', 'short_prompt', 'act_output', 'temp', 'pred_output', 'perplexity']
+STORE_KEY = ['essay', 'changepoint', 'temp']
+RESULTS_PATH = "essay/results/perplexity-results"
 
 
 class PerplexityExperiment:
-    def __init__(self):
-        self.model, self.tokenizer = load_model("essay/models/bloom-1b1")
-        self.generated_outputs = pd.read_csv("essay/results/autocomplete-results.csv").drop(columns=['Unnamed: 0'])
-        self.generated_outputs['perplexity'] = [None for _ in range(len(self.generated_outputs))]   
+    def __init__(self, corpus_path=None, precision="fp32", backend="eager"):
+        self.model, self.tokenizer = get_model("essay/models/bloom-1b1", precision=precision, backend=backend)
+        self.generated_outputs = self.read_generated_outputs()
+        # Pre-tokenized prompts, see utils/corpus.py
+        self.corpus = Corpus(corpus_path) if corpus_path else None
+
+    @staticmethod
+    def read_generated_outputs(path=AUTOCOMPLETE_RESULTS_PATH):
+        """ The autocomplete experiment's generations, from its columnar results or its older CSV """
+        if exists(path):
+            return ResultsTable.load(path).frame(kind=PREDICTED).drop(columns=['kind', 'perplexity'])
+        return read_legacy_csv(path + ".csv", source=None)
 
-    def run(self, verbose=True, **kwargs):
-        for i in self.generated_outputs.index:
-            if verbose:
-                essay = self.generated_outputs.loc[i, 'essay']
-                temp = self.generated_outputs.loc[i, 'temp']
-                print(f"Calculating perplexity for essay {essay+1} temp {temp} predicted outputs...")
-            prompt = self.generated_outputs.loc[i, 'full_prompt']
-            pred_output = self.generated_outputs.loc[i, 'pred_output']
+    def run(self, verbose=True, store_path=STORE_PATH, stride=None, **kwargs):
+        """
+        Perplexity of every generated and actual output, stored per prompt.
+        stride is kept for backwards compatibility and no longer used.
+        """
+        with ResultStore(store_path, "perplexity", STORE_COLUMNS, STORE_KEY) as store:
+            completed = store.completed_keys()
 
-            prompt_length = len(self.tokenizer(prompt, return_tensors='pt').input_ids)
-            full_text = prompt + pred_output
+            for essay, essay_outputs in self.generated_outputs.groupby('essay', sort=False):
+                # Prompts within an essay are prefixes of one another
+                prefix_cache = PrefixCache()
+                # Changepoints may share a prompt and differ in their actual outputs
+                for changepoint, prompt_outputs in essay_outputs.groupby('changepoint', sort=False):
+                    prompt = prompt_outputs.iloc[0]['full_prompt']
+                    if store.key({'essay': essay, 'changepoint': changepoint, 'temp': None}) in completed:
+                        continue
+                    if verbose:
+                        print(f"Calculating perplexity for essay {essay+1} predicted and actual outputs...")
+                    pred_outputs = prompt_outputs['pred_output'].fillna('').tolist()
+                    actual_output = prompt_outputs.iloc[0]['act_output']
+                    prompt_ids = None
+                    if self.corpus is not None:
+                        name = prompt_outputs.iloc[0].get('name')
+                        if not isinstance(name, str):
+                            raise ValueError(
+                                f"Generated outputs of essay {essay} have no essay name to look up in the corpus; "
+                                "rerun the autocomplete experiment or score without a corpus"
+                            )
+                        prompt_ids = self.corpus.prompt_ids(name, changepoint)
 
-            self.generated_outputs.loc[i, 'perplexity'] = calculate_perplexity(
-                full_text, 
-                model=self.model, tokenizer=self.tokenizer,
-                start_calculating_at=prompt_length,
-                **kwargs
-            )
-        
-        for i in self.generated_outputs['essay'].unique():
-            if verbose:
-                print(f"Calculating perplexity for essay {i+1} actual outputs...")
-            prompt = self.generated_outputs.query(f"essay == {i}").iloc[0]['full_prompt']
-            short_prompt = self.generated_outputs.query(f"essay == {i}").iloc[0]['short_prompt']
-            actual_output = self.generated_outputs.query(f"essay == {i}").iloc[0]['act_output']
+                    # Score every temperature and the actual output against one prompt encoding
+                    perplexities = continuation_perplexities(
+                        prompt, pred_outputs + [actual_output],
+                        self.model, self.tokenizer,
+                        prefix_cache=prefix_cache,
+                        prompt_ids=prompt_ids,
+                        **kwargs
+                    )
 
-            prompt_length = len(self.tokenizer(prompt, return_tensors='pt').input_ids)
-            full_text = prompt + actual_output
+                    # One transaction per prompt, so the actual output's key marks it done
+                    store.append(self.perplexity_rows(
+                        prompt_outputs.to_dict('records'), changepoint, perplexities
+                    ))
 
-            perplexity = calculate_perplexity(
-                full_text, 
-                model=self.model, tokenizer=self.tokenizer,
-                start_calculating_at=prompt_length,
-                **kwargs
-            )
+            self.write_results(store)
 
-            self.generated_outputs = self.generated_outputs.append(
-                {
-                    'essay': i,
-                    'full_prompt': prompt,
-                    'short_prompt': short_prompt,
-                    'act_output': actual_output,
-                    'temp': None,
-                    'pred_output': None,
-                    'perplexity': perplexity
-                }, ignore_index=True
-            )
+    @staticmethod
+    def perplexity_rows(generated_rows, changepoint, perplexities):
+        """
+        Store rows for one prompt: each generated row with its perplexity,
+        then the actual output's row (temp None) with the last perplexity
+        """
+        rows = [
+            {**row, 'changepoint': changepoint, 'perplexity': perplexity}
+            for row, perplexity in zip(generated_rows, perplexities)
+        ]
+        first = generated_rows[0]
+        rows.append({
+            'essay': first['essay'],
+            'name': first.get('name'),
+            'changepoint': changepoint,
+            'full_prompt': first['full_prompt'],
+            'short_prompt': first['short_prompt'],
+            'act_output': first['act_output'],
+            'temp': None,
+            'pred_output': None,
+            'perplexity': perplexities[-1]
+        })
+        return rows
 
-            formatted_outputs = (
-                self.generated_outputs
-                .sort_values(by=['essay', 'temp'])
-            )
-                
-            formatted_outputs.to_csv("essay/results/perplexity-results.csv")
+    @staticmethod
+    def write_results(store):
+        results_df = store.to_dataframe().sort_values(by=['essay', 'changepoint', 'temp'])
+        write_results(results_df, RESULTS_PATH)
 
 if __name__ == "__main__":
     experiment = PerplexityExperiment()
-    experiment.run()
\ No newline at end of file
+    experiment.run()
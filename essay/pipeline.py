@@ -0,0 +1,142 @@
+from autocomplete import AutocompleteExperiment, STORE_PATH as AUTOCOMPLETE_STORE_PATH
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from perplexity import PerplexityExperiment, STORE_PATH as PERPLEXITY_STORE_PATH, STORE_COLUMNS, STORE_KEY
+from utils.bloom import generate_text
+from utils.cache import PrefixCache
+from utils.sampling import SEED
+from utils.scoring import continuation_perplexities
+from utils.store import ResultStore
+import asyncio
+import time
+
+
+QUEUE_SIZE = 4
+
+
+class AutocompletePerplexityPipeline(AutocompleteExperiment):
+    """
+    Runs the autocomplete and perplexity experiments together: each
+    changepoint's generations go through a bounded queue straight to a
+    scoring stage, so scoring overlaps with generating the next
+    changepoint and nothing is read back from CSV.
+
+    Each stage makes its model calls on its own executor thread, while the
+    event loop writes results to both experiments' stores. The stages share
+    torch's intra-op thread pool, which is process-wide. A full queue
+    holds generation back until scoring catches up.
+    """
+    def run(self, verbose=True, batched=True, queue_size=QUEUE_SIZE,
+            autocomplete_store_path=AUTOCOMPLETE_STORE_PATH,
+            perplexity_store_path=PERPLEXITY_STORE_PATH,
+            **kwargs):
+        with self.open_store(autocomplete_store_path) as generated_store, \
+                ResultStore(perplexity_store_path, "perplexity", STORE_COLUMNS, STORE_KEY) as scored_store:
+            elapsed = asyncio.run(
+                self._run(generated_store, scored_store, verbose, batched, queue_size, kwargs)
+            )
+            self.write_results(generated_store)
+            PerplexityExperiment.write_results(scored_store)
+
+        if verbose:
+            print(f"Pipeline finished in {elapsed:.1f}s")
+        return elapsed
+
+    async def _run(self, generated_store, scored_store, verbose, batched, queue_size, kwargs):
+        start = time.perf_counter()
+        queue = asyncio.Queue(maxsize=queue_size)
+        with ThreadPoolExecutor(max_workers=1) as generate_executor, \
+                ThreadPoolExecutor(max_workers=1) as score_executor:
+            await asyncio.gather(
+                self._generate(queue, generate_executor, generated_store, scored_store, verbose, batched, kwargs),
+                self._score(queue, score_executor, scored_store, verbose)
+            )
+        return time.perf_counter() - start
+
+    async def _generate(self, queue, executor, generated_store, scored_store, verbose, batched, kwargs):
+        loop = asyncio.get_running_loop()
+        generated_keys = generated_store.completed_keys()
+        scored_keys = scored_store.completed_keys()
+        stored = generated_store.to_dataframe()
+
+        essay = None
+        for i, name, j, prompt, prompt_short, actual_output in self.essay_units():
+            if i != essay:
+                # Prompts within an essay are prefixes of one another
+                essay, prefix_cache = i, PrefixCache() if batched else None
+
+            if scored_store.key({'essay': i, 'changepoint': j, 'temp': None}) in scored_keys:
+                continue
+
+            pending = [
+                (k, temp) for k, temp in enumerate(self.temperatures)
+                if generated_store.key({'essay': i, 'changepoint': j, 'temp': temp}) not in generated_keys
+            ]
+            rows = []
+            if pending:
+                if verbose:
+                    print(f"Generating essay {i}, changepoint {j}...")
+                temp_nums, temps = zip(*pending)
+                prompt_ids, actual_output_ids = self.token_ids(name, j)
+                pred_outputs = await loop.run_in_executor(executor, partial(
+                    generate_text,
+                    prompt, prompt_short, actual_output,
+                    model=self.model, tokenizer=self.tokenizer,
+                    temperatures=list(temps),
+                    batched=batched,
+                    seeds=[SEED + k for k in temp_nums] if batched else None,
+                    prefix_cache=prefix_cache,
+                    prompt_ids=prompt_ids, actual_output_ids=actual_output_ids,
+                    **kwargs
+                ))
+                rows = [
+                    {
+                        'essay': i,
+                        'name': name,
+                        'changepoint': j,
+                        'full_prompt': prompt,
+                        'short_prompt': prompt_short,
+                        'act_output': actual_output,
+                        'temp': temp,
+                        'pred_output': pred_output
+                    }
+                    for temp, pred_output in zip(temps, pred_outputs)
+                ]
+                generated_store.append(rows)
+
+            # Generations finished by an earlier, interrupted run
+            earlier = stored[(stored['essay'] == i) & (stored['changepoint'] == j)]
+            rows = sorted(earlier.to_dict('records') + rows, key=lambda row: row['temp'])
+            await queue.put((name, j, rows))
+
+        await queue.put(None)
+
+    async def _score(self, queue, executor, scored_store, verbose):
+        loop = asyncio.get_running_loop()
+        essay, prefix_cache = None, None
+        while (item := await queue.get()) is not None:
+            name, changepoint, rows = item
+            first = rows[0]
+            if verbose:
+                print(f"Scoring essay {first['essay']}, changepoint {changepoint}...")
+            if first['essay'] != essay:
+                essay, prefix_cache = first['essay'], PrefixCache()
+            prompt_ids, _ = self.token_ids(name, changepoint)
+
+            perplexities = await loop.run_in_executor(executor, partial(
+                continuation_perplexities,
+                first['full_prompt'],
+                [row['pred_output'] or '' for row in rows] + [first['act_output']],
+                self.model, self.tokenizer,
+                prefix_cache=prefix_cache,
+                prompt_ids=prompt_ids
+            ))
+            scored_store.append(PerplexityExperiment.perplexity_rows(
+                [{key: row[key] for key in STORE_COLUMNS if key in row} for row in rows],
+                changepoint, perplexities
+            ))
+
+
+if __name__ == "__main__":
+    pipeline = AutocompletePerplexityPipeline()
+    pipeline.run()
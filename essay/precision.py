@@ -0,0 +1,106 @@
+from utils.bloom import load_model, calculate_perplexity, PRECISIONS
+from utils.ingest import DATA_SOURCE, iter_work_units
+from utils.resources import resident_memory, model_nbytes
+import gc
+import pandas as pd
+import time
+
+
+MODEL_PATH = "essay/models/bloom-1b1"
+REFERENCE_PRECISION = "fp32"
+MAX_RELATIVE_ERROR = 0.05
+
+
+class PrecisionExperiment:
+    """
+    Checks reduced-precision models against fp32 by comparing the perplexity
+    of each essay's actual output at every changepoint, along with the
+    memory, load time and throughput of each precision
+    """
+    def __init__(self, precisions=PRECISIONS, model_path=MODEL_PATH, data_source=DATA_SOURCE):
+        self.precisions = [REFERENCE_PRECISION] + [p for p in precisions if p != REFERENCE_PRECISION]
+        self.model_path = model_path
+        self.units = [
+            (unit.essay, unit.changepoint, unit.prompt, unit.actual_output)
+            for unit in iter_work_units(data_source)
+        ]
+
+    def measure(self, precision, verbose=True):
+        memory_before = resident_memory()
+        start = time.perf_counter()
+        model, tokenizer = load_model(self.model_path, precision=precision)
+        load_seconds = time.perf_counter() - start
+
+        rows = []
+        num_tokens = 0
+        start = time.perf_counter()
+        for i, j, prompt, actual_output in self.units:
+            prompt_length = tokenizer(prompt, return_tensors='pt').input_ids.shape[1]
+            full_text = prompt + actual_output
+            num_tokens += tokenizer(full_text, return_tensors='pt').input_ids.shape[1]
+            rows.append({
+                'essay': i,
+                'changepoint': j,
+                'precision': precision,
+                'perplexity': calculate_perplexity(
+                    full_text,
+                    model=model, tokenizer=tokenizer,
+                    start_calculating_at=prompt_length
+                )
+            })
+        score_seconds = time.perf_counter() - start
+
+        summary = {
+            'precision': precision,
+            'weight_bytes': model_nbytes(model),
+            'resident_bytes': resident_memory() - memory_before,
+            'load_seconds': load_seconds,
+            'tokens_per_second': num_tokens / score_seconds
+        }
+        if verbose:
+            print(
+                f"{precision}: {summary['weight_bytes'] / 1e9:.2f} GB weights, "
+                f"loaded in {load_seconds:.1f}s, {summary['tokens_per_second']:.0f} tokens/s"
+            )
+
+        del model
+        gc.collect()
+
+        return rows, summary
+
+    def run(self, verbose=True, max_relative_error=MAX_RELATIVE_ERROR):
+        results = []
+        summaries = []
+        for precision in self.precisions:
+            rows, summary = self.measure(precision, verbose=verbose)
+            results.extend(rows)
+            summaries.append(summary)
+
+        results_df = pd.DataFrame(results)
+        reference = (
+            results_df
+            .query(f"precision == '{REFERENCE_PRECISION}'")
+            .set_index(['essay', 'changepoint'])['perplexity']
+        )
+        results_df['reference_perplexity'] = [
+            reference[(essay, changepoint)]
+            for essay, changepoint in zip(results_df['essay'], results_df['changepoint'])
+        ]
+        results_df['relative_error'] = (
+            (results_df['perplexity'] - results_df['reference_perplexity']).abs()
+            / results_df['reference_perplexity']
+        )
+        results_df.to_csv("essay/results/precision-results.csv")
+
+        summary_df = pd.DataFrame(summaries).set_index('precision')
+        summary_df['max_relative_error'] = results_df.groupby('precision')['relative_error'].max()
+        summary_df['passed'] = summary_df['max_relative_error'] <= max_relative_error
+        if verbose:
+            print(summary_df)
+
+        return summary_df
+
+
+if __name__ == "__main__":
+    experiment = PrecisionExperiment()
+    experiment.run()
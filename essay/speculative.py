@@ -0,0 +1,72 @@
+from utils.bloom import generate_text
+from utils.ingest import DATA_SOURCE, iter_work_units
+from utils.registry import get_model
+from utils.sampling import SEED
+from utils.speculative import SpeculativeStats, DRAFT_MODEL_PATH
+import pandas as pd
+import time
+
+
+SPECULATIVE_TEMPS = [0.1, 0.3, 0.5, 0.7]
+SPECULATIVE_NEW_TOKENS = 128
+
+
+class SpeculativeExperiment:
+    """
+    Times long low-temperature continuations at every changepoint with and
+    without a draft model, reporting the draft's acceptance rate and the
+    speedup of speculative decoding over plain KV-cached decoding
+    """
+    def __init__(self, draft_path=DRAFT_MODEL_PATH, precision="fp32", data_source=DATA_SOURCE):
+        self.model, self.tokenizer = get_model("essay/models/bloom-1b1", precision=precision)
+        self.draft_model, _ = get_model(draft_path, precision=precision)
+        self.data_source = data_source
+
+    def run(self, verbose=True, temperatures=SPECULATIVE_TEMPS, max_new_tokens=SPECULATIVE_NEW_TOKENS):
+        results = []
+        for unit in iter_work_units(self.data_source):
+            i, j, prompt = unit.essay, unit.changepoint, unit.prompt
+            prompt_ids = self.tokenizer(prompt, return_tensors="pt").input_ids
+            for k, temp in enumerate(temperatures):
+                common = dict(
+                    model=self.model, tokenizer=self.tokenizer,
+                    temperatures=[temp], seeds=[SEED + k],
+                    prompt_ids=prompt_ids, max_new_tokens=max_new_tokens
+                )
+
+                start = time.perf_counter()
+                generate_text(prompt, prompt, '', batched=True, **common)
+                baseline_seconds = time.perf_counter() - start
+
+                stats = SpeculativeStats()
+                start = time.perf_counter()
+                generate_text(prompt, prompt, '', draft_model=self.draft_model, speculative_stats=stats, **common)
+                speculative_seconds = time.perf_counter() - start
+
+                results.append({
+                    'essay': i,
+                    'changepoint': j,
+                    'temp': temp,
+                    'tokens': stats.generated,
+                    'baseline_seconds': baseline_seconds,
+                    'speculative_seconds': speculative_seconds,
+                    'acceptance_rate': stats.acceptance_rate,
+                    'tokens_per_round': stats.tokens_per_round,
+                    'speedup': baseline_seconds / speculative_seconds
+                })
+                if verbose:
+                    print(
+                        f"Essay {i}, changepoint {j}, temp {temp:.1f}: "
+                        f"acceptance {stats.acceptance_rate:.2f}, speedup {baseline_seconds / speculative_seconds:.2f}x"
+                    )
+
+        results_df = pd.DataFrame(results)
+        results_df.to_csv("essay/results/speculative-results.csv")
+        if verbose:
+            print(results_df.groupby('temp')[['acceptance_rate', 'speedup']].mean())
+        return results_df
+
+
+if __name__ == "__main__":
+    experiment = SpeculativeExperiment()
+    experiment.run()
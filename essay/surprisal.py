@@ -0,0 +1,45 @@
+from utils.corpus import strip_markers
+from utils.registry import get_model
+from utils.surprisal import SurprisalIndex, build_surprisal_index, CONTEXT_LENGTH, STRIDE
+import glob
+import os
+
+
+class SurprisalExperiment:
+    """
+    Scores every token of every essay once and saves a surprisal index per
+    essay, so later questions about an essay are lookups, not model calls
+    """
+    def __init__(self, data_glob="essay/data/essay-*.txt", precision="fp32"):
+        self.model, self.tokenizer = get_model("essay/models/bloom-1b1", precision=precision)
+        self.essay_paths = sorted(glob.glob(data_glob))
+
+    @staticmethod
+    def index_path(essay_path):
+        name = os.path.splitext(os.path.basename(essay_path))[0]
+        return f"essay/results/surprisal-{name}.npz"
+
+    @classmethod
+    def load_index(cls, essay_path):
+        return SurprisalIndex.load(cls.index_path(essay_path))
+
+    def run(self, verbose=True, context_length=CONTEXT_LENGTH, stride=STRIDE):
+        for essay_path in self.essay_paths:
+            with open(essay_path, 'r', encoding="utf8") as f:
+                text, _ = strip_markers(f.read())
+
+            index = build_surprisal_index(
+                text, self.model, self.tokenizer,
+                context_length=context_length, stride=stride
+            )
+            index.save(self.index_path(essay_path))
+
+            if verbose:
+                print(f"{essay_path}: {len(index)} tokens, perplexity {index.span_perplexity(0, len(text)):.2f}")
+                for char_start, char_end, surprisal in index.top_passages(n=3):
+                    print(f"    ({surprisal:.2f} nats/token) {text[char_start:char_end]!r}")
+
+
+if __name__ == "__main__":
+    experiment = SurprisalExperiment()
+    experiment.run()
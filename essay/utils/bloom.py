@@ -1,16 +1,26 @@
-from transformers import BloomForCausalLM, BloomTokenizerFast, set_seed
-import torch
-from torch.nn import functional as F
+from collections import namedtuple
+import time
+
+# torch and transformers take seconds to import, so they (and the helpers
+# built on them) are imported by the functions that run a model
+from .profiling import TRACER, span
+from .registry import get_model
+from .seed import SEED
+from .stopping import StopCondition, row_stopper
 
 
 LINEBREAK = "-" * 80
 MAX_LENGTH_COEFF = 3
 MAX_REPETITIONS = 2
-PROMPT_END_LENGTH = 100
+STREAM_MAX_NEW_TOKENS = 100
+PRECISIONS = ("fp32", "bf16", "int8")
+BACKENDS = ("eager", "compile", "torchscript")
 
 
 def download_model_online(model_name: str, model_path: str):
     """ Download model from HuggingFace and save locally """
+    from transformers import BloomForCausalLM, BloomTokenizerFast
+
     model = BloomForCausalLM.from_pretrained(model_name)
     tokenizer = BloomTokenizerFast.from_pretrained(model_name)
 
@@ -18,11 +28,40 @@ def download_model_online(model_name: str, model_path: str):
     tokenizer.save_pretrained(model_path)
 
 
-def load_model(model_path: str):
-    """ Load model from local path """
-    model = BloomForCausalLM.from_pretrained(model_path)
+def load_model(model_path: str, precision: str = "fp32", backend: str = "eager"):
+    """ 
+    Load model from local path 
+
+    precision is one of PRECISIONS: "fp32", "bf16" weights and activations,
+    or "int8" dynamic quantization of the transformer's linear layers (CPU)
+
+    backend is one of BACKENDS: "eager" PyTorch, or forward passes over more
+    than one token (scoring, prefills, prefix-cache extensions) run through
+    torch.compile or per-shape TorchScript traces at bucketed lengths, with
+    decoding steps left eager (see utils/compiled.py)
+    """
+    if precision not in PRECISIONS:
+        raise ValueError(f"Precision must be one of {PRECISIONS}")
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend must be one of {BACKENDS}")
+    import torch
+    from torch.ao.quantization import quantize_dynamic
+    from transformers import BloomForCausalLM, BloomTokenizerFast
+
+    dtype = torch.bfloat16 if precision == "bf16" else torch.float32
+    model = BloomForCausalLM.from_pretrained(model_path, torch_dtype=dtype)
     tokenizer = BloomTokenizerFast.from_pretrained(model_path)
 
+    if precision == "int8":
+        # The LM head stays fp32: it is tied to the input embeddings and
+        # quantizing it would keep a second copy of the vocabulary matrix.
+        # In place, so the fp32 transformer is not deep-copied first
+        quantize_dynamic(model.transformer, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+
+    if backend != "eager":
+        from .compiled import set_backend
+        set_backend(model, backend)
+
     return model, tokenizer
 
 
@@ -31,18 +70,65 @@ def generate_text(prompt, prompt_short, actual_output,
                   temperatures=None,
                   verbose=False, 
                   model_path="essay/models/bloom-1b1", 
+                  batched=False,
+                  seeds=None,
+                  prefix_cache=None,
+                  prompt_ids=None,
+                  actual_output_ids=None,
+                  cache=None,
+                  stop=None,
+                  draft_model=None,
+                  draft_prefix_cache=None,
+                  speculative_stats=None,
                   **kwargs):
-    """ Generate text using a Bloom model, at various temperatures """
-    set_seed(4242)
+    """ 
+    Generate text using a Bloom model, at various temperatures 
+
+    prompt_ids and actual_output_ids, e.g. slices of a pre-tokenized
+    Corpus, skip tokenizing the prompt and actual output strings.
+
+    With batched=True the prompt is encoded once and all temperatures are
+    sampled together as rows of one batch, row i seeded with seeds[i].
+    A PrefixCache shared across calls lets a prompt that extends an earlier
+    one encode only its new tokens.
+
+    A DiskCache given as cache returns the outputs of an identical earlier
+    call (same model, prompt tokens, temperatures, seeds and parameters)
+    without running the model.
+
+    stop, a StopCondition or one of its modes ("word", "sentence",
+    "paragraph", "tokens"), ends each continuation after its first complete
+    unit instead of at MAX_LENGTH_COEFF times the actual output's length.
+    Each temperature stops on its own and, when batched, leaves the batch.
+
+    draft_model, a smaller model sharing the tokenizer (e.g. bloom-560m),
+    switches to speculative decoding: it drafts tokens that model verifies
+    several at a time, with the same output distribution at each
+    temperature (see utils/speculative.py). Temperatures are then sampled
+    one at a time, seeded like the batched path, and a SpeculativeStats
+    given as speculative_stats collects the acceptance rate. The draft model
+    keeps its own prompt encodings in draft_prefix_cache, or in one made for
+    this call so that its temperatures share them.
+    """
+    from transformers import set_seed
+
+    set_seed(SEED)
     if temperatures is None:
         raise ValueError("Temperatures must be specified")
     
     if model is None or tokenizer is None:
-        model, tokenizer = load_model(model_path)
-
-    if "max_new_tokens" not in kwargs.keys():
-        tokenized_actual_output = tokenizer(actual_output, return_tensors='pt')
-        num_tokens_actual_output = tokenized_actual_output['input_ids'].shape[1]
+        model, tokenizer = get_model(model_path)
+
+    if isinstance(stop, str):
+        stop = StopCondition(stop)
+
+    if stop is not None and "max_new_tokens" not in kwargs.keys():
+        result_length = stop.max_new_tokens
+    elif "max_new_tokens" not in kwargs.keys():
+        if actual_output_ids is None:
+            with span("tokenize"):
+                actual_output_ids = tokenizer(actual_output, return_tensors='pt').input_ids
+        num_tokens_actual_output = actual_output_ids.shape[1]
         result_length = int(MAX_LENGTH_COEFF * num_tokens_actual_output)
     else:
         result_length = kwargs['max_new_tokens']
@@ -55,7 +141,11 @@ def generate_text(prompt, prompt_short, actual_output,
     }
     model_params.update(kwargs)
     
-    input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    if prompt_ids is None:
+        with span("tokenize"):
+            input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    else:
+        input_ids = prompt_ids
     
     if verbose:
         print(LINEBREAK)
@@ -65,62 +155,240 @@ def generate_text(prompt, prompt_short, actual_output,
         print("Actual Output: ", actual_output)
         print(LINEBREAK)
 
-    pred_outputs = []
-    for temp in temperatures:
-        model_params['temperature'] = temp
-        output = model.generate(input_ids, **model_params)
-        pred_output = tokenizer.decode(output[0], skip_special_tokens=True)
-        end_of_prompt = prompt[-PROMPT_END_LENGTH:]
-        pred_output_short = pred_output[(pred_output.index(end_of_prompt) + len(end_of_prompt)):]
-        pred_outputs.append(pred_output_short)
-        if verbose:
+    if draft_model is not None:
+        compute = lambda: _generate_speculative(
+            input_ids, model, draft_model, tokenizer, temperatures, seeds, model_params,
+            prefix_cache=prefix_cache, draft_prefix_cache=draft_prefix_cache,
+            stop=stop, stats=speculative_stats
+        )
+    elif batched:
+        compute = lambda: _generate_batched(
+            input_ids, model, tokenizer, temperatures, seeds, model_params,
+            prefix_cache=prefix_cache, stop=stop
+        )
+    else:
+        compute = lambda: _generate_sequential(input_ids, model, tokenizer, temperatures, model_params, stop=stop)
+
+    if cache is None:
+        pred_outputs = compute()
+    else:
+        from .disk_cache import model_fingerprint
+
+        pred_outputs = cache.memoize(
+            "generate_text", compute,
+            model=model_fingerprint(model),
+            prompt_ids=input_ids,
+            temperatures=list(temperatures),
+            batched=batched,
+            seeds=seeds,
+            seed=SEED,
+            params=model_params,
+            stop=None if stop is None else (stop.mode, stop.max_new_tokens),
+            draft=None if draft_model is None else model_fingerprint(draft_model)
+        )
+
+    if verbose:
+        for temp, pred_output_short in zip(temperatures, pred_outputs):
             print(f"Predicted Output (w/temp {temp:.2f}): ", pred_output_short)
             print(LINEBREAK)
-    
-    if verbose:
         print(LINEBREAK)
 
     return pred_outputs
 
 
+def _generate_sequential(input_ids, model, tokenizer, temperatures, model_params, stop=None):
+    """ Sample each temperature in turn with model.generate """
+    from transformers import StoppingCriteriaList
+    from .stopping import UnitStoppingCriteria
+
+    if stop is not None:
+        stopping_criteria = StoppingCriteriaList([UnitStoppingCriteria(stop, tokenizer, input_ids.shape[1])])
+        model_params = {**model_params, 'stopping_criteria': stopping_criteria}
+
+    pred_outputs = []
+    for temp in temperatures:
+        with span("generate", tokens_prefilled=input_ids.shape[1]) as counters:
+            output = model.generate(input_ids, **{**model_params, 'temperature': temp})
+            counters['tokens_generated'] = output.shape[1] - input_ids.shape[1]
+        # The continuation is everything after the prompt's tokens
+        with span("detokenize"):
+            pred_outputs.append(tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True))
+
+    if stop is not None:
+        pred_outputs = [stop.trim(pred_output) for pred_output in pred_outputs]
+    return pred_outputs
+
+
+def _generate_batched(input_ids, model, tokenizer, temperatures, seeds, model_params,
+                      prefix_cache=None, stop=None):
+    """ Sample every temperature in one batch that shares the prompt encoding """
+    from .sampling import sample_batched
+
+    output_ids = sample_batched(
+        model, input_ids, temperatures,
+        seeds=seeds,
+        max_new_tokens=model_params['max_new_tokens'],
+        no_repeat_ngram_size=model_params.get('no_repeat_ngram_size', 0),
+        top_k=model_params.get('top_k', 50),
+        top_p=model_params.get('top_p', 1.0),
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        prefix_cache=prefix_cache,
+        should_stop=None if stop is None else row_stopper(stop, tokenizer)
+    )
+
+    with span("detokenize"):
+        pred_outputs = [tokenizer.decode(output, skip_special_tokens=True) for output in output_ids]
+    if stop is not None:
+        pred_outputs = [stop.trim(pred_output) for pred_output in pred_outputs]
+    return pred_outputs
+
+
+def _generate_speculative(input_ids, model, draft_model, tokenizer, temperatures, seeds, model_params,
+                          prefix_cache=None, draft_prefix_cache=None, stop=None, stats=None):
+    """ Sample each temperature in turn by speculative decoding with draft_model """
+    from .cache import PrefixCache
+    from .speculative import SpeculativeStats, speculative_sample
+
+    if draft_prefix_cache is None:
+        draft_prefix_cache = PrefixCache()
+    if seeds is None:
+        seeds = [SEED + i for i in range(len(temperatures))]
+    call_stats = SpeculativeStats()
+
+    pred_outputs = []
+    for temp, seed in zip(temperatures, seeds):
+        output_ids = speculative_sample(
+            model, draft_model, input_ids, temp,
+            seed=seed,
+            max_new_tokens=model_params['max_new_tokens'],
+            no_repeat_ngram_size=model_params.get('no_repeat_ngram_size', 0),
+            top_k=model_params.get('top_k', 50),
+            top_p=model_params.get('top_p', 1.0),
+            eos_token_id=tokenizer.eos_token_id,
+            should_stop=None if stop is None else row_stopper(stop, tokenizer),
+            prefix_cache=prefix_cache,
+            draft_prefix_cache=draft_prefix_cache,
+            stats=call_stats
+        )
+        with span("detokenize"):
+            pred_outputs.append(tokenizer.decode(output_ids, skip_special_tokens=True))
+
+    TRACER.count("speculative", drafted=call_stats.drafted, accepted=call_stats.accepted, rounds=call_stats.rounds)
+    if stats is not None:
+        stats.add(call_stats)
+
+    if stop is not None:
+        pred_outputs = [stop.trim(pred_output) for pred_output in pred_outputs]
+    return pred_outputs
+
+
+StreamedToken = namedtuple("StreamedToken", ["token_id", "text", "offset", "elapsed"])
+
+
+def stream_text(prompt,
+                model=None, tokenizer=None,
+                temperature=1.0,
+                max_new_tokens=STREAM_MAX_NEW_TOKENS,
+                seed=SEED,
+                model_path="essay/models/bloom-1b1",
+                prefix_cache=None,
+                prompt_ids=None,
+                no_repeat_ngram_size=MAX_REPETITIONS,
+                top_k=50,
+                top_p=1.0):
+    """
+    Generate text at one temperature, yielding a StreamedToken as each token
+    is decoded: its id, the text it adds, its offset in the continuation and
+    the seconds since the call (so the first one gives time-to-first-token).
+    The continuation is the concatenation of the yielded texts; stop early
+    by breaking out of the loop, e.g. once a sentence ends:
+
+        for token in stream_text(prompt, temperature=0.7):
+            text += token.text
+            if text.rstrip().endswith((".", "!", "?")):
+                break
+    """
+    from .sampling import iter_sample_batched
+
+    start = time.perf_counter()
+    if model is None or tokenizer is None:
+        model, tokenizer = get_model(model_path)
+
+    if prompt_ids is None:
+        prompt_ids = tokenizer(prompt, return_tensors="pt").input_ids
+
+    steps = iter_sample_batched(
+        model, prompt_ids, [temperature],
+        seeds=[seed],
+        max_new_tokens=max_new_tokens,
+        no_repeat_ngram_size=no_repeat_ngram_size,
+        top_k=top_k,
+        top_p=top_p,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        prefix_cache=prefix_cache
+    )
+
+    generated = []
+    text = ""
+    for next_tokens in steps:
+        token_id = next_tokens[0].item()
+        if token_id == tokenizer.eos_token_id:
+            return
+        generated.append(token_id)
+
+        # Decode the whole continuation so multi-token characters come out
+        # whole, holding back text while a character is still incomplete
+        decoded = tokenizer.decode(generated, skip_special_tokens=True)
+        piece = ""
+        if not decoded.endswith("\ufffd"):
+            piece, text = decoded[len(text):], decoded
+
+        yield StreamedToken(token_id, piece, len(generated) - 1, time.perf_counter() - start)
+
+
 def generate_probabilities(prompt, 
                            model=None, tokenizer=None, 
                            verbose=False, 
                            temperature=1.0,
                            output_length=1,
                            num_outputs=10,
-                           model_path="essay/models/bloom-1b1"):
+                           model_path="essay/models/bloom-1b1",
+                           cache=None):
     """ 
     Generate probabilities for top next predicted words using a Bloom model 
+
+    For the next token (output_length=1) these are the model's exact
+    probabilities at the given temperature. Longer outputs fall back to a
+    beam search whose scores are renormalized across the beams.
+    A DiskCache given as cache skips the model for repeated calls.
     """
-    set_seed(4242)
+    from transformers import set_seed
+
+    set_seed(SEED)
 
     if model is None or tokenizer is None:
-        model, tokenizer = load_model(model_path)
+        model, tokenizer = get_model(model_path)
 
     input_ids = tokenizer(prompt, return_tensors='pt').input_ids
 
-    with torch.no_grad():
-        # We want 5 options for only the next word
-        # The output is of the class BeamSearchDecoderOnlyOutput  
-        beam_search_output = model.generate(
-            inputs=input_ids,
-            max_new_tokens=output_length,
-            num_beams=num_outputs,
-            num_return_sequences=num_outputs,
-            output_scores=True,
-            return_dict_in_generate=True,
-            temperature=temperature
+    compute = lambda: _top_outputs(prompt, input_ids, model, tokenizer, temperature, output_length, num_outputs)
+    if cache is None:
+        outputs = compute()
+    else:
+        from .disk_cache import model_fingerprint
+
+        outputs = cache.memoize(
+            "generate_probabilities", compute,
+            model=model_fingerprint(model),
+            prompt_ids=input_ids,
+            temperature=temperature,
+            output_length=output_length,
+            num_outputs=num_outputs,
+            seed=SEED
         )
 
-    # Decode the 5 output sequences
-    output_texts = [tokenizer.decode(output, skip_special_tokens=True) for output in beam_search_output.sequences]
-    
-    # Get the probabilities for each
-    probs = F.softmax(beam_search_output.sequences_scores, dim=0).numpy()
-
-    outputs = [(out_text, prob) for out_text, prob in zip(output_texts, probs)]
-
     if verbose:
         print(f"Prompt: {prompt}")
         for i, (out_text, prob) in enumerate(outputs):
@@ -129,43 +397,76 @@ def generate_probabilities(prompt,
     return outputs
 
 
+def _top_outputs(prompt, input_ids, model, tokenizer, temperature, output_length, num_outputs):
+    """ (text, probability) of the num_outputs most likely continuations """
+    import torch
+    from torch.nn import functional as F
+    from .scoring import next_token_probabilities
+
+    if output_length == 1:
+        token_ids, probs = next_token_probabilities(
+            [prompt], [temperature], model, tokenizer, top_k=num_outputs
+        )
+        prompt_ids = input_ids[0].tolist()
+        output_texts = [
+            tokenizer.decode(prompt_ids + [token_id], skip_special_tokens=True)
+            for token_id in token_ids[0, 0].tolist()
+        ]
+        probs = probs[0, 0].numpy()
+    else:
+        with torch.no_grad():
+            beam_search_output = model.generate(
+                inputs=input_ids,
+                max_new_tokens=output_length,
+                num_beams=num_outputs,
+                num_return_sequences=num_outputs,
+                output_scores=True,
+                return_dict_in_generate=True,
+                temperature=temperature
+            )
+
+        # Decode the output sequences
+        output_texts = [tokenizer.decode(output, skip_special_tokens=True) for output in beam_search_output.sequences]
+        
+        # Get the probabilities for each
+        probs = F.softmax(beam_search_output.sequences_scores, dim=0).numpy()
+
+    return [(out_text, prob) for out_text, prob in zip(output_texts, probs)]
+
+
 def calculate_perplexity(prompt, 
                          model=None, tokenizer=None, 
                          stride=1,
                          model_path="essay/models/bloom-1b1",
-                         start_calculating_at=0):
-    set_seed(4242)
+                         start_calculating_at=0,
+                         cache=None):
+    """
+    Perplexity of the tokens of prompt from start_calculating_at onwards,
+    each conditioned on the full text before it, from one forward pass.
+    stride is kept for backwards compatibility and no longer used.
+    A DiskCache given as cache skips the model for repeated calls.
+    """
+    from transformers import set_seed
+    from .scoring import token_log_probs, perplexity_from_log_probs
+
+    set_seed(SEED)
 
     if model is None or tokenizer is None:
-        model, tokenizer = load_model(model_path)
+        model, tokenizer = get_model(model_path)
 
     input_ids = tokenizer(prompt, return_tensors='pt').input_ids
-    seq_len = input_ids.size(1)
-
-    nlls = []
-    prev_end_loc = 0
+    compute = lambda: perplexity_from_log_probs(token_log_probs(model, input_ids, start=start_calculating_at))
+    if cache is None:
+        return compute()
 
-    for begin_loc in range(start_calculating_at, seq_len, stride):
-        end_loc = seq_len
-        trg_len = end_loc - prev_end_loc  # may be different from stride on last loop
-        input_ids = input_ids[:, begin_loc:end_loc]
-        target_ids = input_ids.clone()
-        target_ids[:, :-trg_len] = -100
-
-        with torch.no_grad():
-            outputs = model(input_ids, labels=target_ids)
-            neg_log_likelihood = outputs.loss * trg_len
+    from .disk_cache import model_fingerprint
 
-        nlls.append(neg_log_likelihood)
-
-        prev_end_loc = end_loc
-        if end_loc == seq_len:
-            break
-
-    ppl = torch.exp(torch.stack(nlls).sum() / end_loc).item()
-
-    return ppl
-    
+    return cache.memoize(
+        "calculate_perplexity", compute,
+        model=model_fingerprint(model),
+        input_ids=input_ids,
+        start=start_calculating_at
+    )
 
 
 if __name__=="__main__": 
@@ -188,5 +489,5 @@ It wasn't the smoke but the smell of it that bothered me. In later years, I didn
     model, tokenizer = load_model("essay/models/bloom-1b1")
     print(calculate_perplexity(
         prompt + act_output,
-        start_calculating_at=len(tokenizer(prompt, return_tensors='pt').input_ids)
+        start_calculating_at=tokenizer(prompt, return_tensors='pt').input_ids.shape[1]
     ))
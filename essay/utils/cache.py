@@ -0,0 +1,119 @@
+from collections import OrderedDict
+
+from .past import to_legacy, to_model_past, crop_past, past_length, past_nbytes
+from .profiling import span
+
+
+PREFIX_CACHE_BYTES = 4 * 1024 ** 3
+
+
+class PrefixCache:
+    """
+    LRU cache of prompt encodings keyed by their token ids.
+
+    Prompts taken at successive changepoints of one essay are prefixes of
+    each other, so a new prompt only has to encode the tokens past the
+    longest prefix already held here. Entries are evicted least recently
+    used first once their past_key_values exceed max_bytes.
+    """
+    def __init__(self, max_bytes=PREFIX_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.tokens_reused = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    @staticmethod
+    def _common_prefix_length(a, b):
+        length = min(len(a), len(b))
+        for i in range(length):
+            if a[i] != b[i]:
+                return i
+        return length
+
+    def lookup(self, token_ids):
+        """ Return (key, shared length) of the entry sharing the longest prefix """
+        token_ids = tuple(token_ids)
+        best_key, best_length = None, 0
+        for key in self.entries:
+            length = self._common_prefix_length(key, token_ids)
+            if length > best_length:
+                best_key, best_length = key, length
+
+        if best_key is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.tokens_reused += best_length
+            self.entries.move_to_end(best_key)
+
+        return best_key, best_length
+
+    def get(self, key):
+        return self.entries[key]
+
+    def store(self, token_ids, past_key_values, last_logits):
+        token_ids = tuple(token_ids)
+        if token_ids in self.entries:
+            self.entries.move_to_end(token_ids)
+            return
+
+        size = past_nbytes(past_key_values)
+        if size > self.max_bytes:
+            return
+
+        self.entries[token_ids] = (past_key_values, last_logits)
+        self.nbytes += size
+        while self.nbytes > self.max_bytes:
+            _, (evicted, _) = self.entries.popitem(last=False)
+            self.nbytes -= past_nbytes(evicted)
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+
+def prefill(model, input_ids, prefix_cache=None):
+    """
+    Encode a single prompt and return (past_key_values, last-position logits),
+    reusing and extending the longest cached prefix when a cache is given
+    """
+    import torch
+
+    token_ids = input_ids[0].tolist()
+    past = None
+    start = 0
+
+    with span("prefill", tokens_prefilled=0, tokens_reused=0, prefix_cache_hits=0) as counters:
+        if prefix_cache is not None:
+            key, length = prefix_cache.lookup(token_ids)
+            if key is not None:
+                counters['prefix_cache_hits'] = 1
+                cached_past, cached_logits = prefix_cache.get(key)
+                if length == len(token_ids) and length == past_length(cached_past):
+                    counters['tokens_reused'] = length
+                    return cached_past, cached_logits
+                # Always leave at least one token to run so there are logits to return
+                start = min(length, len(token_ids) - 1)
+                past = crop_past(cached_past, start)
+
+        counters['tokens_prefilled'] = len(token_ids) - start
+        counters['tokens_reused'] = start
+        with torch.no_grad():
+            outputs = model(
+                input_ids[:, start:],
+                past_key_values=to_model_past(past),
+                attention_mask=torch.ones_like(input_ids),
+                use_cache=True
+            )
+        past = to_legacy(outputs.past_key_values)
+        last_logits = outputs.logits[:, -1, :]
+
+    if prefix_cache is not None:
+        prefix_cache.store(token_ids, past, last_logits)
+
+    return past, last_logits
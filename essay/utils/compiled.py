@@ -0,0 +1,182 @@
+from collections import defaultdict
+
+import torch
+from transformers.modeling_outputs import BaseModelOutputWithPastAndCrossAttentions
+
+from .bloom import BACKENDS
+from .past import crop_past, pad_past, past_length, select_positions, to_legacy, to_model_past
+from .profiling import span
+
+
+# Sequences and KV caches are right-padded up to the next of these lengths,
+# or past the largest to a multiple of LONG_BUCKET_STEP, so only a few
+# shapes are ever compiled
+SEQUENCE_BUCKETS = (32, 64, 128, 256, 512, 1024, 2048)
+# Finer than doubling, since attention memory grows with the square of the padded length
+LONG_BUCKET_STEP = 512
+# torch.compile keeps one graph per (batch size, bucket, past bucket); the
+# default limit of 8 would send longer runs back to eager
+MAX_COMPILED_SHAPES = 64
+
+
+def bucket_length(length, buckets=SEQUENCE_BUCKETS, step=LONG_BUCKET_STEP):
+    """ Smallest bucket holding length tokens """
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    largest = buckets[-1]
+    return largest + -(-(length - largest) // step) * step
+
+
+def _tensor_forward(eager, input_ids, attention_mask, past_key_values, use_cache):
+    """ The eager forward's hidden states and, with use_cache, its KV cache as (key, value) tuples """
+    outputs = eager(
+        input_ids=input_ids, attention_mask=attention_mask, past_key_values=to_model_past(past_key_values),
+        use_cache=use_cache, return_dict=False
+    )
+    return (outputs[0], to_legacy(outputs[1])) if use_cache else (outputs[0],)
+
+
+class _TracedForward(torch.nn.Module):
+    """ The eager forward with tensor-only inputs and outputs, for torch.jit.trace """
+    def __init__(self, transformer, eager, use_cache):
+        super().__init__()
+        # Registered so the traced graph refers to the model's own weights
+        self.transformer = transformer
+        self.eager = eager
+        self.use_cache = use_cache
+
+    def forward(self, input_ids, attention_mask, past_key_values=None):
+        return _tensor_forward(self.eager, input_ids, attention_mask, past_key_values, self.use_cache)
+
+
+class BucketedForward:
+    """
+    Drop-in forward for a BloomModel (model.transformer) that runs calls
+    encoding more than one token through a compiled graph: whole-sequence
+    scoring, prompt prefills (including generate()'s, and prefix-cache
+    extensions of a cached prompt) and batched continuation scoring on a
+    prompt's KV cache. torch.compile (backend="compile") or a TorchScript
+    trace per shape (backend="torchscript") only ever sees bucketed
+    lengths: input_ids and any past are right-padded to bucket_length with
+    the padding masked out, and since attention is causal and BLOOM's ALiBi
+    positions count only unmasked tokens, the real positions' outputs are
+    unchanged. Their hidden states and KV cache are sliced back out.
+
+    Single-token decoding steps, and calls asking for attentions, hidden
+    states or tuple outputs, go to the eager forward.
+    """
+    def __init__(self, transformer, backend, buckets=SEQUENCE_BUCKETS, pad_token_id=None):
+        if backend not in BACKENDS or backend == "eager":
+            raise ValueError(f"Compiled backend must be one of {BACKENDS[1:]}")
+        self.transformer = transformer
+        self.eager = transformer.forward
+        self.backend = backend
+        self.buckets = buckets
+        self.pad_token_id = pad_token_id if pad_token_id is not None else 0
+        self.graphs = {}
+        self.calls = defaultdict(int)
+        if backend == "compile":
+            torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, MAX_COMPILED_SHAPES)
+            self.compiled = torch.compile(self._forward, dynamic=False)
+
+    def _forward(self, input_ids, attention_mask, use_cache, past_key_values=None):
+        return _tensor_forward(self.eager, input_ids, attention_mask, past_key_values, use_cache)
+
+    def _run_graph(self, input_ids, attention_mask, past, use_cache):
+        if self.backend == "compile":
+            return self.compiled(input_ids, attention_mask, use_cache, past)
+        inputs = (input_ids, attention_mask) + ((past,) if past else ())
+        key = (tuple(input_ids.shape), past_length(past) if past else 0, use_cache)
+        if key not in self.graphs:
+            with span("trace", tokens=input_ids.numel()), torch.no_grad():
+                # Not frozen: freezing would fold a copy of the weights into every graph
+                self.graphs[key] = torch.jit.trace(
+                    _TracedForward(self.transformer, self.eager, use_cache).eval(),
+                    inputs,
+                    check_trace=False
+                )
+        return self.graphs[key](*inputs)
+
+    def _compilable(self, input_ids, past, return_dict, kwargs):
+        if input_ids is None or return_dict is False:
+            return False
+        if past is not None and input_ids.shape[1] == 1:
+            # A decoding step: a graph per token would not pay for itself
+            return False
+        # head_mask, inputs_embeds, output_attentions, ... are passed as None by BloomForCausalLM
+        return not any(value for value in kwargs.values())
+
+    def __call__(self, input_ids=None, past_key_values=None, attention_mask=None,
+                 use_cache=None, return_dict=None, cache_position=None, **kwargs):
+        # generate() starts from an empty cache object
+        past = to_legacy(past_key_values) or None
+        if not self._compilable(input_ids, past, return_dict, kwargs):
+            self.calls['eager'] += 1
+            return self.eager(
+                input_ids=input_ids, past_key_values=past_key_values, attention_mask=attention_mask,
+                use_cache=use_cache, return_dict=return_dict, cache_position=cache_position, **kwargs
+            )
+
+        # cache_position is left for the model to derive from the padded past
+        use_cache = use_cache if use_cache is not None else self.transformer.config.use_cache
+        batch_size, length = input_ids.shape
+        prefix = past_length(past) if past else 0
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, prefix + length), dtype=torch.long)
+        padding = bucket_length(length, self.buckets) - length
+        if padding:
+            input_ids = torch.nn.functional.pad(input_ids, (0, padding), value=self.pad_token_id)
+            attention_mask = torch.nn.functional.pad(attention_mask, (0, padding), value=0)
+        padded_prefix = bucket_length(prefix, self.buckets) if past else 0
+        if padded_prefix > prefix:
+            past = pad_past(past, padded_prefix)
+            attention_mask = torch.cat([
+                attention_mask[:, :prefix],
+                attention_mask.new_zeros((batch_size, padded_prefix - prefix)),
+                attention_mask[:, prefix:]
+            ], dim=1)
+
+        self.calls[self.backend] += 1
+        outputs = self._run_graph(input_ids, attention_mask, past, use_cache)
+
+        present = None
+        if use_cache:
+            present = outputs[1]
+            if past:
+                positions = torch.cat([torch.arange(prefix), torch.arange(padded_prefix, padded_prefix + length)])
+                present = select_positions(present, positions)
+            else:
+                present = crop_past(present, length)
+            if hasattr(past_key_values, "to_legacy_cache"):
+                # Hand back the cache class the caller passed in
+                present = to_model_past(present)
+        return BaseModelOutputWithPastAndCrossAttentions(
+            last_hidden_state=outputs[0][:, :length],
+            past_key_values=present
+        )
+
+
+def set_backend(model, backend, buckets=SEQUENCE_BUCKETS):
+    """
+    Run model's forward passes through backend (one of BACKENDS), in place.
+    The compiled forward replaces model.transformer's, so model(...),
+    model.generate and the scoring helpers that call model.transformer
+    directly all use it; "eager" puts the original back.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Backend must be one of {BACKENDS}")
+    transformer = model.transformer
+    # The instance attribute shadows the class's forward; removing it restores eager
+    transformer.__dict__.pop("forward", None)
+    if backend != "eager":
+        transformer.forward = BucketedForward(transformer, backend, buckets, model.config.pad_token_id)
+    return model
+
+
+def backend_stats(model):
+    """ Calls taken by the compiled graph and by eager, and the shapes traced """
+    forward = model.transformer.__dict__.get("forward")
+    if not isinstance(forward, BucketedForward):
+        return {'backend': "eager"}
+    return {'backend': forward.backend, **forward.calls, 'traced_shapes': len(forward.graphs)}
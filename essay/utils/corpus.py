@@ -0,0 +1,185 @@
+import hashlib
+import json
+import os
+import re
+
+import numpy as np
+
+
+CORPUS_PATH = "essay/data/corpus"
+TOKEN_DTYPE = "int64"
+# Bumped whenever the index layout changes
+CORPUS_VERSION = 2
+MARKER_PATTERN = re.compile(r"\[(START|CHANGEPOINT|END)\]")
+
+
+def strip_markers(text):
+    """
+    Remove the [START]/[CHANGEPOINT]/[END] markers from an essay and return
+    (clean text, list of (start, change, end) character offsets into it).
+    The k-th START, CHANGEPOINT and END markers form the k-th changepoint.
+
+    Markers are validated in the same pass: changepoints may overlap, but
+    the k-th CHANGEPOINT must follow the k-th START and the k-th END must
+    follow the k-th CHANGEPOINT.
+    """
+    pieces = []
+    offsets = {"START": [], "CHANGEPOINT": [], "END": []}
+    previous = {"CHANGEPOINT": "START", "END": "CHANGEPOINT"}
+    position = 0
+    clean_length = 0
+    for match in MARKER_PATTERN.finditer(text):
+        marker = match.group(1)
+        if marker in previous and len(offsets[marker]) >= len(offsets[previous[marker]]):
+            raise ValueError(
+                f"[{marker}] at character {match.start()} has no matching [{previous[marker]}] before it"
+            )
+        pieces.append(text[position:match.start()])
+        clean_length += match.start() - position
+        offsets[marker].append(clean_length)
+        position = match.end()
+    pieces.append(text[position:])
+
+    starts, changes, ends = offsets["START"], offsets["CHANGEPOINT"], offsets["END"]
+    if len(starts) != len(changes) or len(changes) != len(ends):
+        raise ValueError("Number of start, change, and end indices must be equal")
+
+    return "".join(pieces), list(zip(starts, changes, ends))
+
+
+def _essay_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def tokens_before(token_ends, char_offset):
+    """
+    Number of leading tokens that hold any character before char_offset.
+    A token straddling the offset counts, as do the whitespace gaps a
+    tokenizer leaves out of its offsets; tokens sharing one character's
+    span stay together.
+    """
+    if char_offset <= 0:
+        return 0
+    first = int(np.searchsorted(token_ends, char_offset, side="left"))
+    if first == len(token_ends):
+        return first
+    return int(np.searchsorted(token_ends, token_ends[first], side="right"))
+
+
+def compile_corpus(essay_paths, tokenizer, corpus_path=CORPUS_PATH):
+    """
+    Tokenize essays once into a flat token file plus a JSON index of each
+    essay's token span and, per changepoint, the [begin, end) token spans
+    of its prompt, short prompt and actual output.
+
+    A span is a slice of its essay's tokens when that slice decodes to
+    exactly the span's text. Where a changepoint falls inside a token, the
+    text on either side is tokenized by itself and appended to the buffer
+    after the essay, so a prompt never holds the start of its actual
+    output.
+    """
+    index = {"version": CORPUS_VERSION, "dtype": TOKEN_DTYPE, "essays": []}
+    chunks = []
+    num_tokens = 0
+    for path in essay_paths:
+        with open(path, "r", encoding="utf8") as f:
+            text, changepoints = strip_markers(f.read())
+
+        encoding = tokenizer(text, return_offsets_mapping=True)
+        token_ends = np.array([end for _, end in encoding.offset_mapping])
+        ids = np.asarray(encoding.input_ids, dtype=TOKEN_DTYPE)
+        essay_start = num_tokens
+        chunks.append(ids)
+        num_tokens += len(ids)
+
+        def token_span(char_start, char_end):
+            nonlocal num_tokens
+            begin, end = tokens_before(token_ends, char_start), tokens_before(token_ends, char_end)
+            if tokenizer.decode(ids[begin:end].tolist()) == text[char_start:char_end]:
+                return [essay_start + begin, essay_start + end]
+            segment = np.asarray(tokenizer(text[char_start:char_end]).input_ids, dtype=TOKEN_DTYPE)
+            chunks.append(segment)
+            num_tokens += len(segment)
+            return [num_tokens - len(segment), num_tokens]
+
+        index["essays"].append({
+            "name": _essay_name(path),
+            "path": path,
+            "sha256": _file_digest(path),
+            "token_start": essay_start,
+            "token_end": essay_start + len(ids),
+            "changepoints": [
+                {
+                    "prompt": token_span(0, change),
+                    "prompt_short": token_span(start, change),
+                    "actual_output": token_span(change, end)
+                }
+                for start, change, end in changepoints
+            ]
+        })
+
+    np.concatenate(chunks).astype(TOKEN_DTYPE).tofile(corpus_path + ".tokens")
+    with open(corpus_path + ".index.json", "w") as f:
+        json.dump(index, f, indent=2)
+
+    return index
+
+
+class Corpus:
+    """
+    Pre-tokenized essays, memory-mapped so prompts are zero-copy slices of
+    one shared token buffer. Loading fails if an essay file still on disk
+    has changed since the corpus was compiled, or if the corpus was
+    compiled in an older layout.
+    """
+    def __init__(self, corpus_path=CORPUS_PATH):
+        with open(corpus_path + ".index.json", "r") as f:
+            self.index = json.load(f)
+        if self.index.get("version") != CORPUS_VERSION:
+            raise ValueError(f"Corpus {corpus_path} has an older layout; compile it again")
+        for essay in self.index["essays"]:
+            if os.path.exists(essay["path"]) and essay.get("sha256") != _file_digest(essay["path"]):
+                raise ValueError(
+                    f"Corpus {corpus_path} is stale: {essay['path']} changed since it was compiled"
+                )
+        # Copy-on-write mapping: writable views for torch, but never written back
+        self.tokens = np.memmap(corpus_path + ".tokens", dtype=self.index["dtype"], mode="c")
+        self.essays = {essay["name"]: essay for essay in self.index["essays"]}
+
+    def __len__(self):
+        return len(self.essays)
+
+    def num_changepoints(self, name):
+        return len(self.essays[name]["changepoints"])
+
+    def ids(self, start, end):
+        """ Token ids [start, end) of the buffer as a (1, n) tensor sharing its memory """
+        import torch
+
+        return torch.from_numpy(self.tokens[start:end]).unsqueeze(0)
+
+    def _span_ids(self, name, k, part):
+        return self.ids(*self.essays[name]["changepoints"][k][part])
+
+    def prompt_ids(self, name, k):
+        return self._span_ids(name, k, "prompt")
+
+    def prompt_short_ids(self, name, k):
+        return self._span_ids(name, k, "prompt_short")
+
+    def actual_output_ids(self, name, k):
+        return self._span_ids(name, k, "actual_output")
+
+
+if __name__ == "__main__":
+    import glob
+    from transformers import BloomTokenizerFast
+
+    tokenizer = BloomTokenizerFast.from_pretrained("essay/models/bloom-1b1")
+    index = compile_corpus(sorted(glob.glob("essay/data/essay-*.txt")), tokenizer)
+    print(f"Compiled {len(index['essays'])} essays to {CORPUS_PATH}")
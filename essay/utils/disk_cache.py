@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import weakref
+
+import numpy as np
+import torch
+
+from .profiling import TRACER
+
+
+DISK_CACHE_PATH = "essay/cache"
+DISK_CACHE_BYTES = 2 * 1024 ** 3
+# Eviction frees down to this fraction of max_bytes, so it runs rarely
+EVICT_TO = 0.9
+# Tensors this small are hashed whole when fingerprinting a model
+FINGERPRINT_MAX_NUMEL = 100_000
+FINGERPRINT_EMBEDDING_SAMPLES = 65_536
+
+_MISSING = object()
+_fingerprints = weakref.WeakKeyDictionary()
+
+
+def _tensor_bytes(tensor):
+    return tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes()
+
+
+def model_fingerprint(model):
+    """
+    Short id of a model's weights, for cache keys.
+
+    Hashes the config, the module types (so a quantized model differs from
+    its float original), every small tensor (layer norms, biases) whole and
+    an evenly spaced sample of the input embeddings, which is fast enough
+    to compute once per model and still tells fine-tuned weights apart.
+    """
+    if model in _fingerprints:
+        return _fingerprints[model]
+
+    digest = hashlib.sha256()
+    digest.update(model.config.to_json_string().encode("utf8"))
+    digest.update(str(sorted({type(module).__name__ for module in model.modules()})).encode("utf8"))
+    for name, tensor in model.state_dict().items():
+        if isinstance(tensor, torch.Tensor) and tensor.numel() <= FINGERPRINT_MAX_NUMEL:
+            digest.update(name.encode("utf8"))
+            digest.update(str(tensor.dtype).encode("utf8"))
+            digest.update(_tensor_bytes(tensor))
+
+    embeddings = model.get_input_embeddings().weight.view(-1)
+    step = max(1, embeddings.numel() // FINGERPRINT_EMBEDDING_SAMPLES)
+    digest.update(_tensor_bytes(embeddings[::step]))
+
+    fingerprint = digest.hexdigest()[:16]
+    _fingerprints[model] = fingerprint
+    return fingerprint
+
+
+def _jsonable(value):
+    if isinstance(value, (torch.Tensor, np.ndarray)):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Cannot use {type(value).__name__} in a cache key")
+
+
+class DiskCache:
+    """
+    Content-addressed cache of results on disk, shared across runs and
+    processes.
+
+    Keys are hashes of everything a result depends on (model fingerprint,
+    prompt token ids, parameters, seed), so the same call always maps to
+    the same file. Entries are pickled and written to a temporary file
+    that is then renamed into place, so concurrent readers never see a
+    partial entry and concurrent writers of one key are harmless. Reads
+    touch an entry's mtime and, once the entries exceed max_bytes, the
+    least recently used are deleted first.
+    """
+    def __init__(self, path=DISK_CACHE_PATH, max_bytes=DISK_CACHE_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self.nbytes = sum(size for _, _, size in self._entries())
+
+    @staticmethod
+    def key(namespace, **parts):
+        data = json.dumps([namespace, parts], sort_keys=True, default=_jsonable)
+        return hashlib.sha256(data.encode("utf8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".pkl")
+
+    def _entries(self):
+        """ (path, mtime, size) of every entry, skipping writes in progress """
+        for directory in os.scandir(self.path):
+            if not directory.is_dir():
+                continue
+            for entry in os.scandir(directory.path):
+                if not entry.name.endswith(".pkl"):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def __contains__(self, key):
+        return os.path.exists(self._entry_path(key))
+
+    def __len__(self):
+        return sum(1 for _ in self._entries())
+
+    def get(self, key, default=None):
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+            os.utime(path)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            # Missing, or evicted by another process while being read
+            self.misses += 1
+            TRACER.count("disk_cache", misses=1)
+            return default
+        self.hits += 1
+        TRACER.count("disk_cache", hits=1)
+        return value
+
+    def put(self, key, value):
+        path = self._entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+        self.nbytes += len(data)
+        if self.nbytes > self.max_bytes:
+            self.evict()
+
+    def memoize(self, namespace, compute, **parts):
+        """ The cached result for (namespace, parts), calling compute() on a miss """
+        key = self.key(namespace, **parts)
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = compute()
+            self.put(key, value)
+        return value
+
+    def evict(self):
+        """ Delete least recently used entries until under EVICT_TO of max_bytes """
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.nbytes = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if self.nbytes <= EVICT_TO * self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            self.nbytes -= size
+
+    def clear(self):
+        for path, _, _ in list(self._entries()):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self.nbytes = 0
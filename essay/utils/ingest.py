@@ -0,0 +1,111 @@
+import glob
+import os
+import re
+import time
+from collections import namedtuple
+
+from .corpus import strip_markers
+from .profiling import span
+
+
+DATA_SOURCE = "essay/data"
+ESSAY_SUFFIX = ".txt"
+DIGITS_PATTERN = re.compile(r"(\d+)")
+
+# One changepoint of one essay; essay is its 1-based position in ingestion order
+EssayUnit = namedtuple("EssayUnit", ["essay", "name", "changepoint", "prompt", "prompt_short", "actual_output"])
+
+
+def _natural_key(path):
+    """ Sort key under which essay-10 comes after essay-9 """
+    return [int(part) if part.isdigit() else part for part in DIGITS_PATTERN.split(path)]
+
+
+def iter_essay_paths(source=DATA_SOURCE, suffix=ESSAY_SUFFIX):
+    """
+    Paths of the essays under a directory (walked recursively, one
+    directory listing at a time) or matching a glob pattern, in natural
+    order within each directory
+    """
+    if os.path.isdir(source):
+        with os.scandir(source) as entries:
+            entries = sorted(entries, key=lambda entry: _natural_key(entry.name))
+        for entry in entries:
+            if entry.is_dir():
+                yield from iter_essay_paths(entry.path, suffix)
+            elif entry.name.endswith(suffix):
+                yield entry.path
+    else:
+        yield from sorted(glob.iglob(source, recursive=True), key=_natural_key)
+
+
+def parse_essay(text):
+    """ (prompts, prompts_short, actual_outputs) of an essay, from one scan over its markers """
+    clean, changepoints = strip_markers(text)
+    return (
+        [clean[:change] for _, change, _ in changepoints],
+        [clean[start:change] for start, change, _ in changepoints],
+        [clean[change:end] for _, change, end in changepoints]
+    )
+
+
+class IngestStats:
+    """ Counts and time spent reading and parsing essays, excluding time spent by the consumer """
+    def __init__(self):
+        self.essays = 0
+        self.changepoints = 0
+        self.bytes = 0
+        self.skipped = []
+        self.seconds = 0.0
+
+    @property
+    def essays_per_second(self):
+        return self.essays / self.seconds if self.seconds else float("nan")
+
+    @property
+    def megabytes_per_second(self):
+        return self.bytes / 2**20 / self.seconds if self.seconds else float("nan")
+
+    def report(self):
+        lines = [
+            f"Ingested {self.essays} essays ({self.changepoints} changepoints, "
+            f"{self.bytes / 2**20:.2f} MiB) in {self.seconds:.3f}s: "
+            f"{self.essays_per_second:.1f} essays/s, {self.megabytes_per_second:.2f} MiB/s"
+        ]
+        lines += [f"Skipped {path}: {error}" for path, error in self.skipped]
+        return "\n".join(lines)
+
+
+def iter_work_units(source=DATA_SOURCE, stats=None, skip_invalid=False):
+    """
+    Stream EssayUnits from the essays in source, one file in memory at a
+    time. A malformed essay raises ValueError naming the file, or with
+    skip_invalid is recorded in stats.skipped and left out (without taking
+    up an essay number).
+    """
+    stats = stats if stats is not None else IngestStats()
+    essay = 0
+    for path in iter_essay_paths(source):
+        start = time.perf_counter()
+        with span("ingest") as counters:
+            with open(path, "r", encoding="utf8") as f:
+                text = f.read()
+            counters["bytes"] = len(text.encode("utf8"))
+            try:
+                prompts, prompts_short, actual_outputs = parse_essay(text)
+            except ValueError as error:
+                if not skip_invalid:
+                    raise ValueError(f"{path}: {error}") from error
+                stats.skipped.append((path, str(error)))
+                prompts = None
+        stats.seconds += time.perf_counter() - start
+        if prompts is None:
+            continue
+
+        essay += 1
+        stats.essays += 1
+        stats.changepoints += len(prompts)
+        stats.bytes += counters["bytes"]
+        name = os.path.splitext(os.path.basename(path))[0]
+        for j, unit in enumerate(zip(prompts, prompts_short, actual_outputs)):
+            yield EssayUnit(essay, name, j, *unit)
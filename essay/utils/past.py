@@ -0,0 +1,116 @@
+# Memory the row copies of one prompt's cache may take, see rows_per_group
+MAX_PAST_BYTES = 2 * 1024 ** 3
+
+
+def to_legacy(past_key_values):
+    """ Normalize a model's past_key_values to a tuple of (key, value) pairs """
+    if past_key_values is None:
+        return None
+    if hasattr(past_key_values, "to_legacy_cache"):
+        return past_key_values.to_legacy_cache()
+    return tuple((key, value) for key, value in past_key_values)
+
+
+def to_model_past(past_key_values):
+    """
+    Wrap legacy (key, value) pairs in the cache class the model expects.
+    The model may grow the cache in place, so a fresh wrapper is built on
+    every call and the legacy tensors themselves are never mutated.
+    """
+    if past_key_values is None:
+        return None
+    try:
+        from transformers import DynamicCache
+    except ImportError:
+        return past_key_values
+    return DynamicCache.from_legacy_cache(past_key_values)
+
+
+def past_length(past_key_values):
+    """ Number of token positions held in the cache """
+    key, value = past_key_values[0]
+    return value.shape[-2]
+
+
+def expand_past(past_key_values, batch_size):
+    """ Repeat a single-row cache so it can be shared by batch_size rows """
+    if batch_size == 1:
+        # The cache is never written to, so one row can use it as it is
+        return tuple(past_key_values)
+    return tuple(
+        (
+            key.repeat(batch_size, *([1] * (key.dim() - 1))),
+            value.repeat(batch_size, *([1] * (value.dim() - 1)))
+        )
+        for key, value in past_key_values
+    )
+
+
+def crop_past(past_key_values, length):
+    """ Keep only the first length token positions of the cache """
+    cropped = []
+    for key, value in past_key_values:
+        if key.dim() == 3:
+            # BLOOM's fused layout stores keys as (batch * heads, head_dim, seq)
+            key = key[..., :length]
+        else:
+            key = key[..., :length, :]
+        cropped.append((key, value[..., :length, :]))
+    return tuple(cropped)
+
+
+def pad_past(past_key_values, length):
+    """ Zero-pad the cache to length token positions, to be masked out by the attention mask """
+    import torch.nn.functional as F
+
+    padding = length - past_length(past_key_values)
+    padded = []
+    for key, value in past_key_values:
+        if key.dim() == 3:
+            key = F.pad(key, (0, padding))
+        else:
+            key = F.pad(key, (0, 0, 0, padding))
+        padded.append((key, F.pad(value, (0, 0, 0, padding))))
+    return tuple(padded)
+
+
+def select_positions(past_key_values, positions):
+    """ Keep only the token positions listed in positions (a 1-D index tensor) """
+    selected = []
+    for key, value in past_key_values:
+        key = key.index_select(-1 if key.dim() == 3 else -2, positions)
+        selected.append((key, value.index_select(-2, positions)))
+    return tuple(selected)
+
+
+def past_nbytes(past_key_values):
+    """ Memory held by the cache tensors, in bytes """
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in past_key_values
+    )
+
+
+def rows_per_group(past_key_values, new_positions, max_bytes=MAX_PAST_BYTES):
+    """
+    How many rows may share copies of a single-row cache within max_bytes,
+    once each row has grown by new_positions. Growing the cache concatenates
+    it into new tensors, so each row's copy is counted twice.
+    """
+    length = past_length(past_key_values)
+    row_bytes = 2 * past_nbytes(past_key_values) * (length + new_positions) / max(1, length)
+    return max(1, int(max_bytes // row_bytes))
+
+
+def select_past(past_key_values, rows, batch_size):
+    """ Gather the cache rows listed in rows (indices into a batch of batch_size) """
+    selected = []
+    for key, value in past_key_values:
+        if key.dim() == 3:
+            # BLOOM's fused layout folds heads into the batch dimension
+            key = key.reshape(batch_size, -1, *key.shape[1:])[rows].flatten(0, 1)
+            value = value.reshape(batch_size, -1, *value.shape[1:])[rows].flatten(0, 1)
+        else:
+            key, value = key[rows], value[rows]
+        selected.append((key, value))
+    return tuple(selected)
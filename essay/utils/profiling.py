@@ -0,0 +1,170 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+PROFILE_ENV = "ESSAY_PROFILE"
+PROFILE_PATHS = {
+    'torch': "essay/results/torch-profile.json",
+    'cprofile': "essay/results/profile.pstats"
+}
+PROFILE_TOP_N = 30
+MAX_TRACE_EVENTS = 1_000_000
+
+
+class Tracer:
+    """
+    Records timing spans around the pipeline's stages (tokenization,
+    prefill, decoding, scoring, result writes) with per-stage counters such
+    as tokens prefilled or generated and cache hits.
+
+    Every span is kept as a Chrome trace event (open the saved file in
+    chrome://tracing or Perfetto) and totalled per stage for summary().
+    Spans nest, so an outer stage's time includes its inner stages'.
+    """
+    def __init__(self, max_events=MAX_TRACE_EVENTS):
+        self.max_events = max_events
+        self.events = []
+        self.totals = defaultdict(lambda: defaultdict(float))
+        self.lock = threading.Lock()
+        self.origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **counters):
+        """
+        Time the enclosed block as stage name. Yields the counters dict so
+        the block can fill in counts it only knows at the end.
+        """
+        # Labelled for torch.profiler too, once torch is in use
+        torch = sys.modules.get("torch")
+        label = torch.profiler.record_function(name) if torch is not None else nullcontext()
+        start = time.perf_counter()
+        with label:
+            yield counters
+        end = time.perf_counter()
+
+        with self.lock:
+            totals = self.totals[name]
+            totals['calls'] += 1
+            totals['seconds'] += end - start
+            for counter, value in counters.items():
+                totals[counter] += value
+            if len(self.events) < self.max_events:
+                self.events.append({
+                    'name': name,
+                    'ph': 'X',
+                    'ts': (start - self.origin) * 1e6,
+                    'dur': (end - start) * 1e6,
+                    'pid': os.getpid(),
+                    'tid': threading.get_ident(),
+                    'args': counters
+                })
+
+    def count(self, name, **counters):
+        """ Add to a stage's counters without timing anything """
+        with self.lock:
+            totals = self.totals[name]
+            for counter, value in counters.items():
+                totals[counter] += value
+
+    def drain(self):
+        """
+        Hand over the recorded spans and totals, clearing them, so a worker
+        process can return them with its results for the parent to merge()
+        """
+        with self.lock:
+            spans = {
+                'origin': self.origin,
+                'events': self.events,
+                'totals': {name: dict(totals) for name, totals in self.totals.items()}
+            }
+            self.events = []
+            self.totals.clear()
+        return spans
+
+    def merge(self, spans):
+        """ Add spans drained from another process's tracer to this one """
+        # perf_counter is a system-wide monotonic clock, so only the origins differ
+        shift = (spans['origin'] - self.origin) * 1e6
+        with self.lock:
+            for name, totals in spans['totals'].items():
+                for counter, value in totals.items():
+                    self.totals[name][counter] += value
+            room = self.max_events - len(self.events)
+            self.events.extend({**event, 'ts': event['ts'] + shift} for event in spans['events'][:room])
+
+    def save(self, path):
+        """ Write the spans as Chrome trace JSON """
+        with self.lock:
+            with open(path, 'w') as f:
+                json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+    def summary(self):
+        with self.lock:
+            stages = sorted(self.totals.items(), key=lambda item: -item[1].get('seconds', 0.0))
+            lines = [f"{'stage':<20} {'calls':>8} {'seconds':>10} {'ms/call':>10}  counters"]
+            for name, totals in stages:
+                calls = int(totals.get('calls', 0))
+                seconds = totals.get('seconds', 0.0)
+                per_call = f"{1000 * seconds / calls:10.2f}" if calls else f"{'':>10}"
+                counters = ", ".join(
+                    f"{counter}={int(value)}" for counter, value in totals.items()
+                    if counter not in ('calls', 'seconds')
+                )
+                lines.append(f"{name:<20} {calls:>8} {seconds:>10.3f} {per_call}  {counters}")
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.totals.clear()
+            self.origin = time.perf_counter()
+
+
+TRACER = Tracer()
+
+
+def span(name, **counters):
+    """ TRACER.span, for instrumenting library code """
+    return TRACER.span(name, **counters)
+
+
+@contextmanager
+def profiled(kind=None, path=None):
+    """
+    Run the enclosed block under torch.profiler (kind="torch") or cProfile
+    (kind="cprofile"), saving the profile to path and printing the top
+    entries. kind defaults to the ESSAY_PROFILE environment variable, so
+    a run can be profiled without code changes; unset does nothing.
+    """
+    kind = kind or os.environ.get(PROFILE_ENV)
+    if not kind:
+        yield
+        return
+    if kind not in PROFILE_PATHS:
+        raise ValueError(f"Profiler must be one of {tuple(PROFILE_PATHS)}")
+    path = path or PROFILE_PATHS[kind]
+
+    if kind == 'torch':
+        import torch
+
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as profiler:
+            yield
+        profiler.export_chrome_trace(path)
+        print(profiler.key_averages().table(sort_by="cpu_time_total", row_limit=PROFILE_TOP_N))
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(PROFILE_TOP_N)
+    print(f"Saved {kind} profile to {path}")
@@ -0,0 +1,70 @@
+import threading
+import time
+
+from .resources import resident_memory, model_nbytes
+
+
+MODEL_PATH = "essay/models/bloom-1b1"
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of loaded models, keyed by (path, precision, backend).
+
+    Each model is loaded once, on first request, and then shared by every
+    caller in the process. Worker processes forked after a model is loaded
+    inherit it copy-on-write instead of loading their own copy.
+    """
+    def __init__(self):
+        self.entries = {}
+        self.stats = {}
+        self.lock = threading.Lock()
+
+    def get(self, model_path=MODEL_PATH, precision="fp32", backend="eager"):
+        key = (model_path, precision, backend)
+        with self.lock:
+            if key not in self.entries:
+                # Imported here because bloom.py itself falls back to the registry
+                from .bloom import load_model
+
+                memory_before = resident_memory()
+                start = time.perf_counter()
+                model, tokenizer = load_model(model_path, precision=precision, backend=backend)
+                self.entries[key] = (model, tokenizer)
+                self.stats[key] = {
+                    'model_path': model_path,
+                    'precision': precision,
+                    'backend': backend,
+                    'load_seconds': time.perf_counter() - start,
+                    'weight_bytes': model_nbytes(model),
+                    'resident_bytes': resident_memory() - memory_before
+                }
+
+        return self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def report(self):
+        lines = []
+        for stats in self.stats.values():
+            lines.append(
+                f"{stats['model_path']} ({stats['precision']}, {stats['backend']}): "
+                f"loaded in {stats['load_seconds']:.1f}s, "
+                f"{stats['weight_bytes'] / 1e9:.2f} GB weights, "
+                f"{stats['resident_bytes'] / 1e9:.2f} GB resident"
+            )
+        return "\n".join(lines)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.stats.clear()
+
+
+REGISTRY = ModelRegistry()
+
+
+def get_model(model_path=MODEL_PATH, precision="fp32", backend="eager"):
+    """ (model, tokenizer) for model_path at precision on backend, loaded once per process """
+    return REGISTRY.get(model_path, precision, backend)
@@ -0,0 +1,33 @@
+import os
+import resource
+import sys
+
+
+def resident_memory():
+    """ Current resident set size of this process, in bytes """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return peak_resident_memory()
+
+
+def peak_resident_memory():
+    """ Peak resident set size of this process, in bytes """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and kilobytes elsewhere
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def model_nbytes(model):
+    """ Bytes held by a model's weights, including packed quantized weights """
+    import torch
+
+    def tensor_bytes(value):
+        if isinstance(value, torch.Tensor):
+            return value.numel() * value.element_size()
+        if isinstance(value, (tuple, list)):
+            return sum(tensor_bytes(v) for v in value)
+        return 0
+
+    return sum(tensor_bytes(value) for value in model.state_dict().values())
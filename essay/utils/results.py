@@ -0,0 +1,270 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+from .ingest import DATA_SOURCE, iter_work_units
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+PROMPT_COLUMNS = ['essay', 'name', 'changepoint', 'full_prompt', 'short_prompt', 'act_output']
+PROMPT_TEXT_COLUMNS = ['full_prompt', 'short_prompt', 'act_output']
+OUTPUT_TEXT_COLUMNS = ['pred_output']
+PREDICTED = "predicted"
+ACTUAL = "actual"
+KINDS = [PREDICTED, ACTUAL]
+COMPRESSION = "zstd"
+
+PROMPTS_SCHEMA = None if pa is None else pa.schema([
+    ('prompt_id', pa.int32()),
+    ('essay', pa.int32()),
+    ('name', pa.string()),
+    ('changepoint', pa.int32()),
+    ('full_prompt', pa.string()),
+    ('short_prompt', pa.string()),
+    ('act_output', pa.string())
+])
+OUTPUTS_SCHEMA = None if pa is None else pa.schema([
+    ('prompt_id', pa.int32()),
+    ('kind', pa.dictionary(pa.int8(), pa.string())),
+    ('temp', pa.float64()),
+    ('pred_output', pa.string()),
+    ('perplexity', pa.float64())
+])
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("Columnar results need pyarrow (pip install pyarrow)")
+
+
+def _paths(path):
+    return path + ".prompts.parquet", path + ".outputs.parquet"
+
+
+def exists(path):
+    return all(os.path.exists(part) for part in _paths(path))
+
+
+class ResultsTable:
+    """
+    Experiment results split into a prompts table, holding each
+    changepoint's prompt texts once, and an outputs table of
+    (prompt_id, kind, temp, pred_output, perplexity) rows referring to it.
+    kind is "predicted" for a generation and "actual" for the author's
+    continuation, whose temp is None (or, in migrated results, the
+    author's estimated temperature).
+
+    Saved as two Parquet files with dictionary encoding, so a load can
+    skip the text columns entirely when only the numbers are needed.
+    """
+    def __init__(self, prompts, outputs):
+        self.prompts = prompts
+        self.outputs = outputs
+
+    @classmethod
+    def from_frame(cls, rows):
+        """
+        Normalize flat rows with STORE_COLUMNS (plus perplexity and kind,
+        when present) as the experiments' stores hold them; rows with a
+        null temp and pred_output are the actual outputs
+        """
+        rows = rows.copy()
+        if 'kind' not in rows:
+            actual = rows['temp'].isna() & rows['pred_output'].isna()
+            rows['kind'] = np.where(actual, ACTUAL, PREDICTED)
+        if 'perplexity' not in rows:
+            rows['perplexity'] = np.nan
+        if 'name' not in rows:
+            rows['name'] = None
+
+        prompts = (
+            rows[PROMPT_COLUMNS]
+            .drop_duplicates(subset=['essay', 'changepoint'])
+            .sort_values(by=['essay', 'changepoint'])
+            .reset_index(drop=True)
+        )
+        prompts.insert(0, 'prompt_id', np.arange(len(prompts), dtype=np.int32))
+        prompts = prompts.astype({'essay': np.int32, 'changepoint': np.int32})
+
+        outputs = rows.merge(prompts[['prompt_id', 'essay', 'changepoint']], on=['essay', 'changepoint'])
+        outputs = (
+            outputs[['prompt_id', 'kind', 'temp', 'pred_output', 'perplexity']]
+            .sort_values(by=['prompt_id', 'kind', 'temp'], key=cls._sort_key)
+            .reset_index(drop=True)
+        )
+        outputs['kind'] = pd.Categorical(outputs['kind'], categories=KINDS)
+        outputs['temp'] = outputs['temp'].astype(float)
+        outputs['perplexity'] = outputs['perplexity'].astype(float)
+        return cls(prompts, outputs)
+
+    @staticmethod
+    def _sort_key(column):
+        # Predicted rows first, then each prompt's actual output
+        if column.name == 'kind':
+            return column.map(KINDS.index)
+        return column
+
+    def save(self, path):
+        _require_pyarrow()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        for frame, schema, part in zip(
+            (self.prompts, self.outputs), (PROMPTS_SCHEMA, OUTPUTS_SCHEMA), _paths(path)
+        ):
+            table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+            pq.write_table(table, part, use_dictionary=True, compression=COMPRESSION)
+
+    @classmethod
+    def load(cls, path, text=True):
+        """ Read saved results; text=False leaves out the prompt and output texts """
+        _require_pyarrow()
+        prompts_path, outputs_path = _paths(path)
+        # Results saved before essays had a name column load without it
+        prompt_columns = None if text else [
+            name for name in pq.read_schema(prompts_path).names if name not in PROMPT_TEXT_COLUMNS
+        ]
+        output_columns = None if text else [
+            name for name in OUTPUTS_SCHEMA.names if name not in OUTPUT_TEXT_COLUMNS
+        ]
+        prompts = pq.read_table(prompts_path, columns=prompt_columns).to_pandas()
+        outputs = pq.read_table(outputs_path, columns=output_columns).to_pandas()
+        outputs['kind'] = pd.Categorical(outputs['kind'], categories=KINDS)
+        return cls(prompts, outputs)
+
+    def frame(self, essay=None, changepoint=None, temps=None, kind=None):
+        """
+        Flat rows, one per output, with their prompt's columns joined in.
+        Each filter takes a value or a list of values; temps match to
+        within 1e-6.
+        """
+        prompts = self.prompts
+        if essay is not None:
+            prompts = prompts[prompts['essay'].isin(np.atleast_1d(essay))]
+        if changepoint is not None:
+            prompts = prompts[prompts['changepoint'].isin(np.atleast_1d(changepoint))]
+
+        outputs = self.outputs[self.outputs['prompt_id'].isin(prompts['prompt_id'])]
+        if kind is not None:
+            outputs = outputs[outputs['kind'].isin(np.atleast_1d(kind))]
+        if temps is not None:
+            temps = np.atleast_1d(temps).astype(float)
+            close = np.abs(outputs['temp'].to_numpy()[:, None] - temps[None, :]) < 1e-6
+            outputs = outputs[close.any(axis=1)]
+
+        return prompts.merge(outputs, on='prompt_id').drop(columns=['prompt_id'])
+
+    def by_essay(self, essay):
+        return self.frame(essay=essay)
+
+    def by_temperature(self, temp):
+        return self.frame(temps=temp, kind=PREDICTED)
+
+    def predicted(self, **filters):
+        return self.frame(kind=PREDICTED, **filters)
+
+    def actual(self, **filters):
+        return self.frame(kind=ACTUAL, **filters)
+
+    def actual_vs_predicted(self):
+        """
+        One row per generation with its perplexity next to the actual
+        output's for the same prompt, and their ratio
+        """
+        outputs = self.outputs[['prompt_id', 'kind', 'temp', 'perplexity']]
+        predicted = outputs[outputs['kind'] == PREDICTED].drop(columns=['kind'])
+        actual = (
+            outputs[outputs['kind'] == ACTUAL][['prompt_id', 'perplexity']]
+            .rename(columns={'perplexity': 'actual_perplexity'})
+        )
+        paired = predicted.merge(actual, on='prompt_id', how='left')
+        paired['perplexity_ratio'] = paired['perplexity'] / paired['actual_perplexity']
+        prompts = self.prompts[['prompt_id', 'essay', 'changepoint']]
+        return prompts.merge(paired, on='prompt_id').drop(columns=['prompt_id'])
+
+    def temperatures(self):
+        return np.sort(self.outputs.loc[self.outputs['kind'] == PREDICTED, 'temp'].unique())
+
+
+def write_results(rows, path):
+    """
+    Save an experiment store's rows as a ResultsTable at path, or as the
+    flat path + ".csv" when pyarrow is not installed
+    """
+    if pa is None:
+        rows.drop(columns=['changepoint']).reset_index(drop=True).to_csv(path + ".csv")
+        return
+    ResultsTable.from_frame(rows).save(path)
+
+
+def _repair_mojibake(text):
+    """
+    Undo UTF-8 text that was decoded as cp1252 and saved again (as a
+    spreadsheet round trip does); text that does not decode is left as is
+    """
+    if not isinstance(text, str) or text.isascii():
+        return text
+    try:
+        raw = bytes(ord(char) if ord(char) < 256 else char.encode("cp1252")[0] for char in text)
+        return raw.decode("utf8")
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return text
+
+
+def read_legacy_csv(path, source=DATA_SOURCE):
+    """
+    Flat rows from an autocomplete-results.csv or perplexity-results.csv
+    written before the results were columnar, with stray unnamed columns
+    dropped. Those files number essays their own way and have no
+    changepoint column, so both (and the essay's name) are taken from the
+    changepoint of the essays in source whose prompt each row has, as a new
+    run would number it. With source None the legacy essay ids are kept,
+    names are left empty and changepoints are recovered from the prompts,
+    which within an essay are prefixes of one another.
+    """
+    rows = pd.read_csv(path, encoding="utf-8-sig")
+    rows = rows.drop(columns=[column for column in rows.columns if column.startswith('Unnamed:')])
+    for column in PROMPT_TEXT_COLUMNS + OUTPUT_TEXT_COLUMNS:
+        rows[column] = rows[column].map(_repair_mojibake)
+    if 'perplexity' in rows:
+        # The actual outputs are the rows without a generation
+        rows['kind'] = np.where(rows['pred_output'].isna(), ACTUAL, PREDICTED)
+    if source is not None:
+        units = {unit.prompt: (unit.essay, unit.name, unit.changepoint) for unit in iter_work_units(source)}
+        unmatched = sorted(set(rows.loc[~rows['full_prompt'].isin(units), 'essay']))
+        if unmatched:
+            raise ValueError(f"Prompts of legacy essays {unmatched} in {path} match no essay in {source}")
+        rows['essay'], rows['name'], rows['changepoint'] = zip(*rows['full_prompt'].map(units))
+        return rows
+    rows['changepoint'] = (
+        rows['full_prompt'].str.len()
+        .groupby(rows['essay'])
+        .rank(method='dense')
+        .astype(int) - 1
+    )
+    return rows
+
+
+def migrate_csv(csv_path, path, source=DATA_SOURCE):
+    """ Convert a legacy results CSV to a ResultsTable saved at path, numbered as source's essays """
+    table = ResultsTable.from_frame(read_legacy_csv(csv_path, source))
+    table.save(path)
+    return table
+
+
+if __name__ == "__main__":
+    for name in ("autocomplete-results", "perplexity-results"):
+        csv_path = f"essay/results/{name}.csv"
+        if not os.path.exists(csv_path):
+            continue
+        path = f"essay/results/{name}"
+        table = migrate_csv(csv_path, path)
+        size = sum(os.path.getsize(part) for part in _paths(path))
+        print(
+            f"{csv_path} ({os.path.getsize(csv_path) / 1024:.0f} KiB) -> {path}.*.parquet ({size / 1024:.0f} KiB): "
+            f"{len(table.prompts)} prompts, {len(table.outputs)} outputs"
+        )
@@ -0,0 +1,217 @@
+import torch
+from torch.nn import functional as F
+from transformers import (
+    LogitsProcessor, LogitsProcessorList, NoRepeatNGramLogitsProcessor,
+    TopKLogitsWarper, TopPLogitsWarper
+)
+
+from .cache import prefill
+from .profiling import span
+from .past import MAX_PAST_BYTES, to_legacy, to_model_past, expand_past, rows_per_group, select_past
+from .seed import SEED
+
+
+class PerRowTemperatureLogitsWarper(LogitsProcessor):
+    """ Rescale each row of the scores by its own temperature """
+    def __init__(self, temperatures):
+        self.temperatures = torch.as_tensor(temperatures, dtype=torch.float).unsqueeze(1)
+
+    def __call__(self, input_ids, scores):
+        return scores / self.temperatures.to(scores.device, scores.dtype)
+
+
+def build_logits_processors(temperatures, no_repeat_ngram_size=0, top_k=50, top_p=1.0):
+    """ Mirror the processor order model.generate uses for sampling """
+    processors = LogitsProcessorList()
+    if no_repeat_ngram_size:
+        processors.append(NoRepeatNGramLogitsProcessor(no_repeat_ngram_size))
+    processors.append(PerRowTemperatureLogitsWarper(temperatures))
+    if top_k:
+        processors.append(TopKLogitsWarper(top_k=top_k))
+    if top_p < 1.0:
+        processors.append(TopPLogitsWarper(top_p=top_p))
+    return processors
+
+
+def sample_rows(probs, generators):
+    """ Draw one token per row, each row from its own random generator """
+    return torch.cat([
+        torch.multinomial(row_probs, 1, generator=generator)
+        for row_probs, generator in zip(probs, generators)
+    ])
+
+
+def _default_pad_token_id(pad_token_id, eos_token_id):
+    if pad_token_id is not None:
+        return pad_token_id
+    return eos_token_id if eos_token_id is not None else 0
+
+
+@torch.no_grad()
+def iter_sample_batched(model, input_ids, temperatures,
+                        seeds=None,
+                        max_new_tokens=20,
+                        no_repeat_ngram_size=0,
+                        top_k=50,
+                        top_p=1.0,
+                        eos_token_id=None,
+                        pad_token_id=None,
+                        prefix_cache=None,
+                        should_stop=None):
+    """
+    Sample one continuation per temperature from a single prompt, yielding
+    the (num_rows,) tensor of new tokens as soon as each step is drawn.
+
+    The prompt is encoded once and its KV cache is shared by every row of
+    the batch, so a sweep over temperatures costs one prefill plus batched
+    decoding. Each row draws from its own generator seeded with seeds[i],
+    which makes a row reproducible regardless of the rest of the batch.
+    A PrefixCache lets the prefill reuse an earlier prompt's encoding.
+
+    A row finishes when it emits EOS or when should_stop(row, new token
+    ids) returns True (see utils/stopping.py); it then yields pad_token_id
+    and drops out of the batch, so later forward passes only run the rows
+    still going. The next forward pass only runs once the consumer asks
+    for the next step, so closing the generator early costs nothing further.
+
+    Every row holds its own copy of the prompt's cache; sample_batched
+    splits long sweeps into groups that fit a memory budget.
+    """
+    num_rows = len(temperatures)
+    if seeds is None:
+        seeds = [SEED + i for i in range(num_rows)]
+    if len(seeds) != num_rows:
+        raise ValueError("Number of seeds must match number of temperatures")
+
+    past, next_logits = prefill(model, input_ids, prefix_cache)
+    yield from _iter_rows(
+        model, input_ids, past, next_logits, temperatures, seeds,
+        max_new_tokens=max_new_tokens,
+        no_repeat_ngram_size=no_repeat_ngram_size,
+        top_k=top_k,
+        top_p=top_p,
+        eos_token_id=eos_token_id,
+        pad_token_id=_default_pad_token_id(pad_token_id, eos_token_id),
+        should_stop=should_stop
+    )
+
+
+@torch.no_grad()
+def _iter_rows(model, input_ids, past, next_logits, temperatures, seeds,
+               max_new_tokens, no_repeat_ngram_size, top_k, top_p,
+               eos_token_id, pad_token_id, should_stop):
+    """ The decoding loop of iter_sample_batched, from the prompt's prefilled cache """
+    num_rows = len(temperatures)
+    generators = [torch.Generator().manual_seed(int(seed)) for seed in seeds]
+    processors = build_logits_processors(
+        temperatures,
+        no_repeat_ngram_size=no_repeat_ngram_size,
+        top_k=top_k,
+        top_p=top_p
+    )
+
+    past = expand_past(past, num_rows)
+    next_logits = next_logits.expand(num_rows, -1)
+
+    prompt_length = input_ids.shape[1]
+    sequences = input_ids.repeat(num_rows, 1)
+    # Original row numbers of the rows still in the batch
+    active = torch.arange(num_rows)
+    for step in range(max_new_tokens):
+        with span("sample", tokens_generated=len(active)):
+            scores = processors(sequences[active], next_logits.float())
+            probs = F.softmax(scores, dim=-1)
+            sampled = sample_rows(probs, [generators[row] for row in active.tolist()])
+            next_tokens = torch.full((num_rows,), pad_token_id, dtype=sampled.dtype)
+            next_tokens[active] = sampled
+            sequences = torch.cat([sequences, next_tokens.unsqueeze(1)], dim=1)
+
+        yield next_tokens
+
+        keep = torch.ones(len(active), dtype=torch.bool)
+        if eos_token_id is not None:
+            keep &= sampled != eos_token_id
+        if should_stop is not None:
+            for i, row in enumerate(active.tolist()):
+                if keep[i] and should_stop(row, sequences[row, prompt_length:].tolist()):
+                    keep[i] = False
+        if not keep.any() or step == max_new_tokens - 1:
+            return
+
+        if not keep.all():
+            past = select_past(past, keep.nonzero().squeeze(1), len(active))
+            active, sampled = active[keep], sampled[keep]
+            processors = build_logits_processors(
+                [temperatures[row] for row in active.tolist()],
+                no_repeat_ngram_size=no_repeat_ngram_size,
+                top_k=top_k,
+                top_p=top_p
+            )
+
+        with span("decode", rows=len(active)):
+            outputs = model(
+                sampled.unsqueeze(1),
+                past_key_values=to_model_past(past),
+                attention_mask=torch.ones((len(active), sequences.shape[1]), dtype=torch.long),
+                use_cache=True
+            )
+            past = to_legacy(outputs.past_key_values)
+            next_logits = outputs.logits[:, -1, :]
+
+
+def sample_batched(model, input_ids, temperatures,
+                   seeds=None,
+                   max_new_tokens=20,
+                   no_repeat_ngram_size=0,
+                   top_k=50,
+                   top_p=1.0,
+                   eos_token_id=None,
+                   pad_token_id=None,
+                   prefix_cache=None,
+                   should_stop=None,
+                   max_past_bytes=MAX_PAST_BYTES):
+    """
+    Sample one continuation per temperature from a single prompt, see
+    iter_sample_batched. Returns the new token ids, padded with
+    pad_token_id after EOS.
+
+    The prompt is prefilled once, and the rows are decoded in groups small
+    enough that their copies of its cache fit in max_past_bytes (see
+    utils/past.py), so a long prompt is never copied for the whole sweep
+    at once. A row's output does not depend on its group.
+    """
+    num_rows = len(temperatures)
+    if seeds is None:
+        seeds = [SEED + i for i in range(num_rows)]
+    if len(seeds) != num_rows:
+        raise ValueError("Number of seeds must match number of temperatures")
+    pad_token_id = _default_pad_token_id(pad_token_id, eos_token_id)
+
+    past, next_logits = prefill(model, input_ids, prefix_cache)
+    group_size = rows_per_group(past, max_new_tokens, max_past_bytes)
+
+    outputs = []
+    for group_start in range(0, num_rows, group_size):
+        group = slice(group_start, group_start + group_size)
+        group_should_stop = None
+        if should_stop is not None:
+            # Rows are numbered within the group; the callback sees sweep rows
+            group_should_stop = lambda row, token_ids, offset=group_start: should_stop(row + offset, token_ids)
+        steps = list(_iter_rows(
+            model, input_ids, past, next_logits, temperatures[group], seeds[group],
+            max_new_tokens=max_new_tokens,
+            no_repeat_ngram_size=no_repeat_ngram_size,
+            top_k=top_k,
+            top_p=top_p,
+            eos_token_id=eos_token_id,
+            pad_token_id=pad_token_id,
+            should_stop=group_should_stop
+        ))
+        outputs.append(
+            torch.stack(steps, dim=1) if steps else input_ids.new_empty((len(temperatures[group]), 0))
+        )
+
+    if not outputs:
+        return input_ids.new_empty((0, 0))
+    width = max(output.shape[1] for output in outputs)
+    return torch.cat([F.pad(output, (0, width - output.shape[1]), value=pad_token_id) for output in outputs])
@@ -0,0 +1,170 @@
+import math
+
+import torch
+from torch.nn import functional as F
+
+from .cache import prefill
+from .disk_cache import model_fingerprint
+from .profiling import span
+from .past import MAX_PAST_BYTES, to_model_past, expand_past, rows_per_group
+
+
+SCORING_BATCH_SIZE = 8
+
+
+def token_log_probs(model, input_ids, start=1):
+    """
+    Log-probability of each token of a single sequence given everything
+    before it, for positions start onwards, from one forward pass.
+    The LM head only runs over the positions being scored.
+    """
+    start = max(start, 1)
+    with span("score", tokens_prefilled=input_ids.shape[1], tokens_scored=max(0, input_ids.shape[1] - start)), torch.no_grad():
+        hidden = model.transformer(input_ids).last_hidden_state
+        logits = model.lm_head(hidden[:, start - 1:-1])
+    log_probs = F.log_softmax(logits.float(), dim=-1)
+    targets = input_ids[:, start:]
+
+    return log_probs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)[0]
+
+
+def perplexity_from_log_probs(log_probs):
+    """ exp of the mean negative log-likelihood, nan for an empty span """
+    if len(log_probs) == 0:
+        return math.nan
+    return torch.exp(-log_probs.mean()).item()
+
+
+def score_continuations(prompt, continuations, model, tokenizer,
+                        batch_size=SCORING_BATCH_SIZE,
+                        prefix_cache=None,
+                        prompt_ids=None,
+                        max_past_bytes=MAX_PAST_BYTES):
+    """
+    Per-token log-probabilities of several continuations of one prompt.
+
+    The prompt is encoded once; its KV cache is shared by every row while
+    the continuations are scored in right-padded batches, of at most
+    batch_size rows and fewer if their copies of a long prompt's cache
+    would not fit in max_past_bytes. Only the continuation tokens are
+    scored. Returns one 1-D tensor per continuation.
+    prompt_ids, e.g. a slice of a pre-tokenized Corpus, skips tokenizing
+    the prompt string.
+    """
+    if prompt_ids is None:
+        prompt_ids = tokenizer(prompt, return_tensors='pt').input_ids
+    past, last_logits = prefill(model, prompt_ids, prefix_cache)
+    prompt_length = prompt_ids.shape[1]
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    encoded = [
+        tokenizer(continuation, add_special_tokens=False).input_ids
+        for continuation in continuations
+    ]
+
+    width = max((len(ids) for ids in encoded), default=1)
+    batch_size = min(batch_size, rows_per_group(past, width, max_past_bytes))
+
+    results = []
+    for batch_start in range(0, len(encoded), batch_size):
+        batch = encoded[batch_start:batch_start + batch_size]
+        rows = len(batch)
+        width = max(1, max(len(ids) for ids in batch))
+
+        cont_ids = torch.full((rows, width), pad_token_id, dtype=torch.long)
+        cont_mask = torch.zeros((rows, width), dtype=torch.long)
+        for row, ids in enumerate(batch):
+            cont_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            cont_mask[row, :len(ids)] = 1
+
+        attention_mask = torch.cat(
+            [torch.ones((rows, prompt_length), dtype=torch.long), cont_mask], dim=1
+        )
+        with span("score", tokens_scored=int(cont_mask.sum())), torch.no_grad():
+            outputs = model(
+                cont_ids,
+                past_key_values=to_model_past(expand_past(past, rows)),
+                attention_mask=attention_mask,
+                use_cache=True
+            )
+
+        # The first continuation token is predicted from the end of the prompt
+        logits = torch.cat(
+            [last_logits.expand(rows, -1).unsqueeze(1), outputs.logits[:, :-1]], dim=1
+        )
+        log_probs = F.log_softmax(logits.float(), dim=-1)
+        log_probs = log_probs.gather(-1, cont_ids.unsqueeze(-1)).squeeze(-1)
+
+        for row, ids in enumerate(batch):
+            results.append(log_probs[row, :len(ids)])
+
+    return results
+
+
+def continuation_perplexities(prompt, continuations, model, tokenizer,
+                              batch_size=SCORING_BATCH_SIZE,
+                              prefix_cache=None,
+                              prompt_ids=None,
+                              cache=None):
+    """
+    Perplexity of each continuation, conditioned on the shared prompt.
+    A DiskCache given as cache skips the model for repeated calls.
+    """
+    def compute():
+        log_probs = score_continuations(
+            prompt, continuations, model, tokenizer,
+            batch_size=batch_size, prefix_cache=prefix_cache, prompt_ids=prompt_ids
+        )
+        return [perplexity_from_log_probs(lp) for lp in log_probs]
+
+    if cache is None:
+        return compute()
+
+    if prompt_ids is None:
+        prompt_ids = tokenizer(prompt, return_tensors="pt").input_ids
+    return cache.memoize(
+        "continuation_perplexities", compute,
+        model=model_fingerprint(model),
+        prompt_ids=prompt_ids,
+        continuations=list(continuations)
+    )
+
+
+def next_token_probabilities(prompts, temperatures, model, tokenizer,
+                             top_k=10,
+                             batch_size=SCORING_BATCH_SIZE):
+    """
+    Exact top-k next-token probabilities of each prompt at each temperature.
+
+    Prompts are run in right-padded batches with one forward pass each, the
+    LM head only over each prompt's last position, and that one logits row
+    is rescaled for every temperature at once. Returns (token_ids, probs),
+    both of shape (num_prompts, num_temperatures, top_k).
+    """
+    temperatures = torch.as_tensor(temperatures, dtype=torch.float).reshape(1, -1, 1)
+    pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else 0
+
+    token_ids, probs = [], []
+    for batch_start in range(0, len(prompts), batch_size):
+        encoded = [
+            tokenizer(prompt).input_ids
+            for prompt in prompts[batch_start:batch_start + batch_size]
+        ]
+        lengths = torch.tensor([len(ids) for ids in encoded])
+        input_ids = torch.full((len(encoded), int(lengths.max())), pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros_like(input_ids)
+        for row, ids in enumerate(encoded):
+            input_ids[row, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            attention_mask[row, :len(ids)] = 1
+
+        with torch.no_grad():
+            hidden = model.transformer(input_ids, attention_mask=attention_mask).last_hidden_state
+            last_hidden = hidden[torch.arange(len(encoded)), lengths - 1]
+            logits = model.lm_head(last_hidden).float()
+
+        log_probs = F.log_softmax(logits.unsqueeze(1) / temperatures, dim=-1)
+        top_log_probs, top_ids = log_probs.topk(top_k, dim=-1)
+        token_ids.append(top_ids)
+        probs.append(top_log_probs.exp())
+
+    return torch.cat(token_ids), torch.cat(probs)
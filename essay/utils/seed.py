@@ -0,0 +1,3 @@
+# Base seed for sampling; row k of a batched sweep uses SEED + k. Kept in
+# its own module so callers can import it without loading torch
+SEED = 4242
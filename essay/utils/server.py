@@ -0,0 +1,346 @@
+import json
+import math
+import queue
+import threading
+import time
+import urllib.request
+from collections import defaultdict, deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from .bloom import generate_text
+from .cache import PrefixCache
+from .registry import MODEL_PATH, get_model
+from .sampling import SEED
+from .scoring import continuation_perplexities, next_token_probabilities
+
+
+HOST = "127.0.0.1"
+PORT = 8765
+MAX_BATCH_SIZE = 16
+MAX_WAIT_SECONDS = 0.01
+MAX_NEW_TOKENS = 20
+LATENCY_WINDOW = 1000
+KINDS = ('generate', 'perplexity', 'probabilities')
+
+
+def _require(condition, message):
+    if not condition:
+        raise ValueError(message)
+
+
+def validate_payload(kind, payload):
+    """ Raise ValueError for a request the batch would fail on, before it is queued """
+    _require(kind in KINDS, f"Unknown request kind: {kind}")
+    _require(isinstance(payload, dict), "Request body must be a JSON object")
+    _require(isinstance(payload.get('prompt'), str), "'prompt' must be a string")
+    is_number = lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)
+
+    if kind == 'generate':
+        temperatures = payload.get('temperatures')
+        _require(
+            isinstance(temperatures, list) and temperatures and all(is_number(t) and t > 0 for t in temperatures),
+            "'temperatures' must be a non-empty list of positive numbers"
+        )
+        seeds = payload.get('seeds')
+        _require(
+            seeds is None or (isinstance(seeds, list) and len(seeds) == len(temperatures)
+                              and all(isinstance(seed, int) for seed in seeds)),
+            "'seeds' must be a list of integers, one per temperature"
+        )
+        max_new_tokens = payload.get('max_new_tokens')
+        _require(
+            max_new_tokens is None or (isinstance(max_new_tokens, int) and max_new_tokens > 0),
+            "'max_new_tokens' must be a positive integer"
+        )
+    elif kind == 'perplexity':
+        _require(isinstance(payload.get('continuation'), str), "'continuation' must be a string")
+    else:
+        temperature = payload.get('temperature', 1.0)
+        _require(is_number(temperature) and temperature > 0, "'temperature' must be a positive number")
+        num_outputs = payload.get('num_outputs', 10)
+        _require(isinstance(num_outputs, int) and num_outputs > 0, "'num_outputs' must be a positive integer")
+
+
+def _finite(value):
+    """ value with NaN and infinities replaced by None, which JSON can represent """
+    if isinstance(value, float):
+        return value if math.isfinite(value) else None
+    if isinstance(value, dict):
+        return {key: _finite(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_finite(item) for item in value]
+    return value
+
+
+class DynamicBatcher:
+    """
+    Collects concurrent requests into batches and runs them on one thread.
+
+    A batch closes once it holds max_batch_size requests or max_wait seconds
+    have passed since its first request. Within a batch, generate requests
+    for the same prompt share one sampling batch and perplexity requests for
+    the same prompt share one prompt encoding. Payloads are validated when
+    submitted, and a batch that still fails is rerun one request at a time,
+    so an error only reaches the requests that cause it.
+    """
+    def __init__(self, model, tokenizer,
+                 max_batch_size=MAX_BATCH_SIZE,
+                 max_wait=MAX_WAIT_SECONDS):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.prefix_cache = PrefixCache()
+        self.started = time.perf_counter()
+
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def submit(self, kind, payload):
+        """ Queue a request and return a Future for its result; raises ValueError for an invalid one """
+        validate_payload(kind, payload)
+        future = Future()
+        self.requests.put((kind, payload, future, time.perf_counter()))
+        return future
+
+    def _collect(self):
+        batch = [self.requests.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.requests.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        handlers = {
+            'generate': self._run_generate,
+            'perplexity': self._run_perplexity,
+            'probabilities': self._run_probabilities
+        }
+        while True:
+            batch = self._collect()
+            by_kind = defaultdict(list)
+            for request in batch:
+                by_kind[request[0]].append(request)
+
+            for kind, requests in by_kind.items():
+                self._run(handlers[kind], requests)
+
+            finished = time.perf_counter()
+            with self.lock:
+                self.num_batches += 1
+                self.num_requests += len(batch)
+                self.latencies.extend(finished - submitted for _, _, _, submitted in batch)
+
+    def _run(self, handler, requests):
+        try:
+            results = handler([payload for _, payload, _, _ in requests])
+        except Exception as e:
+            if len(requests) == 1:
+                requests[0][2].set_exception(e)
+                return
+            for request in requests:
+                self._run(handler, [request])
+            return
+        for (_, _, future, _), result in zip(requests, results):
+            future.set_result(result)
+
+    @staticmethod
+    def _group(payloads, key):
+        groups = defaultdict(list)
+        for i, payload in enumerate(payloads):
+            groups[key(payload)].append(i)
+        return groups.values()
+
+    def _run_generate(self, payloads):
+        results = [None] * len(payloads)
+        groups = self._group(payloads, lambda p: (p['prompt'], p.get('max_new_tokens') or MAX_NEW_TOKENS))
+        for indices in groups:
+            temperatures, seeds = [], []
+            for i in indices:
+                request_temps = payloads[i]['temperatures']
+                temperatures.extend(request_temps)
+                seeds.extend(payloads[i].get('seeds') or [SEED + k for k in range(len(request_temps))])
+
+            first = payloads[indices[0]]
+            outputs = generate_text(
+                first['prompt'], first['prompt'], '',
+                model=self.model, tokenizer=self.tokenizer,
+                temperatures=temperatures,
+                batched=True,
+                seeds=seeds,
+                prefix_cache=self.prefix_cache,
+                max_new_tokens=first.get('max_new_tokens') or MAX_NEW_TOKENS
+            )
+
+            position = 0
+            for i in indices:
+                count = len(payloads[i]['temperatures'])
+                results[i] = outputs[position:position + count]
+                position += count
+        return results
+
+    def _run_perplexity(self, payloads):
+        results = [None] * len(payloads)
+        for indices in self._group(payloads, lambda p: p['prompt']):
+            perplexities = continuation_perplexities(
+                payloads[indices[0]]['prompt'],
+                [payloads[i]['continuation'] for i in indices],
+                self.model, self.tokenizer,
+                prefix_cache=self.prefix_cache
+            )
+            for i, perplexity in zip(indices, perplexities):
+                results[i] = perplexity
+        return results
+
+    def _run_probabilities(self, payloads):
+        """ One forward pass over every prompt, rescaled for every temperature """
+        temperatures = sorted({payload.get('temperature', 1.0) for payload in payloads})
+        top_k = max(payload.get('num_outputs', 10) for payload in payloads)
+        token_ids, probs = next_token_probabilities(
+            [payload['prompt'] for payload in payloads], temperatures,
+            self.model, self.tokenizer, top_k=top_k
+        )
+
+        results = []
+        for row, payload in enumerate(payloads):
+            column = temperatures.index(payload.get('temperature', 1.0))
+            num_outputs = payload.get('num_outputs', 10)
+            results.append([
+                (payload['prompt'] + self.tokenizer.decode([token_id]), prob)
+                for token_id, prob in zip(
+                    token_ids[row, column, :num_outputs].tolist(),
+                    probs[row, column, :num_outputs].tolist()
+                )
+            ])
+        return results
+
+    def stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) if self.latencies else np.zeros(1)
+            uptime = time.perf_counter() - self.started
+            return {
+                'requests': self.num_requests,
+                'batches': self.num_batches,
+                'mean_batch_size': self.num_requests / max(1, self.num_batches),
+                'latency_p50': float(np.percentile(latencies, 50)),
+                'latency_p95': float(np.percentile(latencies, 95)),
+                'requests_per_second': self.num_requests / uptime,
+                'prefix_cache_hits': self.prefix_cache.hits
+            }
+
+
+class _Handler(BaseHTTPRequestHandler):
+    routes = {
+        '/generate': 'generate',
+        '/perplexity': 'perplexity',
+        '/probabilities': 'probabilities'
+    }
+
+    def _reply(self, status, body):
+        data = json.dumps(_finite(body), allow_nan=False).encode("utf8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self._reply(200, self.server.batcher.stats())
+        else:
+            self._reply(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        kind = self.routes.get(self.path)
+        if kind is None:
+            self._reply(404, {'error': f"Unknown path {self.path}"})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+            result = self.server.batcher.submit(kind, payload).result()
+        except Exception as e:
+            self._reply(400, {'error': str(e)})
+            return
+        self._reply(200, {'result': result})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class InferenceServer(ThreadingHTTPServer):
+    """ Local HTTP front end for a DynamicBatcher around one BLOOM model """
+    daemon_threads = True
+
+    def __init__(self, model_path=MODEL_PATH, precision="fp32",
+                 host=HOST, port=PORT,
+                 max_batch_size=MAX_BATCH_SIZE,
+                 max_wait=MAX_WAIT_SECONDS):
+        super().__init__((host, port), _Handler)
+        model, tokenizer = get_model(model_path, precision=precision)
+        self.batcher = DynamicBatcher(model, tokenizer, max_batch_size=max_batch_size, max_wait=max_wait)
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        """ Serve on a background thread, for use from scripts and notebooks """
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+class BloomClient:
+    """ Minimal client for an InferenceServer """
+    def __init__(self, url=f"http://{HOST}:{PORT}", timeout=600):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def _request(self, path, payload=None):
+        data = None if payload is None else json.dumps(payload).encode("utf8")
+        request = urllib.request.Request(
+            self.url + path, data=data, headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return json.loads(response.read())
+
+    def generate(self, prompt, temperatures, max_new_tokens=None, seeds=None):
+        payload = {'prompt': prompt, 'temperatures': list(map(float, temperatures))}
+        if max_new_tokens is not None:
+            payload['max_new_tokens'] = max_new_tokens
+        if seeds is not None:
+            payload['seeds'] = list(seeds)
+        return self._request('/generate', payload)['result']
+
+    def perplexity(self, prompt, continuation):
+        return self._request('/perplexity', {'prompt': prompt, 'continuation': continuation})['result']
+
+    def probabilities(self, prompt, temperature=1.0, num_outputs=10):
+        payload = {'prompt': prompt, 'temperature': temperature, 'num_outputs': num_outputs}
+        return [tuple(output) for output in self._request('/probabilities', payload)['result']]
+
+    def stats(self):
+        return self._request('/stats')
+
+
+if __name__ == "__main__":
+    server = InferenceServer()
+    print(f"Serving {MODEL_PATH} on {server.url}")
+    server.serve_forever()
@@ -0,0 +1,181 @@
+import time
+
+import torch
+from torch.nn import functional as F
+
+from .cache import prefill
+from .past import to_legacy, to_model_past, crop_past
+from .profiling import span
+from .sampling import SEED, build_logits_processors
+
+
+DRAFT_MODEL_PATH = "essay/models/bloom-560m"
+NUM_DRAFT_TOKENS = 4
+
+
+class SpeculativeStats:
+    """ Running totals of drafted and accepted tokens across speculative calls """
+    def __init__(self):
+        self.rounds = 0
+        self.drafted = 0
+        self.accepted = 0
+        self.generated = 0
+        self.seconds = 0.0
+
+    @property
+    def acceptance_rate(self):
+        return self.accepted / self.drafted if self.drafted else float("nan")
+
+    @property
+    def tokens_per_round(self):
+        """ Tokens gained per target forward pass; plain decoding gets 1 """
+        return self.generated / self.rounds if self.rounds else float("nan")
+
+    def add(self, other):
+        for field in ('rounds', 'drafted', 'accepted', 'generated', 'seconds'):
+            setattr(self, field, getattr(self, field) + getattr(other, field))
+
+    def __repr__(self):
+        return (
+            f"SpeculativeStats(acceptance_rate={self.acceptance_rate:.3f}, "
+            f"tokens_per_round={self.tokens_per_round:.2f}, generated={self.generated})"
+        )
+
+
+def _forward(model, token_ids, past, length):
+    """ Run token_ids after a cache holding length positions; (logits, new cache) """
+    outputs = model(
+        torch.tensor([token_ids], dtype=torch.long),
+        past_key_values=to_model_past(past),
+        attention_mask=torch.ones((1, length + len(token_ids)), dtype=torch.long),
+        use_cache=True
+    )
+    return outputs.logits[0].float(), to_legacy(outputs.past_key_values)
+
+
+def _prefill_all_but_last(model, input_ids, prefix_cache=None):
+    """ Cache of every prompt token except the last, which each round feeds again """
+    if input_ids.shape[1] < 2:
+        return None
+    past, _ = prefill(model, input_ids, prefix_cache)
+    return crop_past(past, input_ids.shape[1] - 1)
+
+
+@torch.no_grad()
+def speculative_sample(model, draft_model, input_ids, temperature,
+                       seed=SEED,
+                       max_new_tokens=20,
+                       num_draft_tokens=NUM_DRAFT_TOKENS,
+                       no_repeat_ngram_size=0,
+                       top_k=50,
+                       top_p=1.0,
+                       eos_token_id=None,
+                       should_stop=None,
+                       prefix_cache=None,
+                       draft_prefix_cache=None,
+                       stats=None):
+    """
+    Sample one continuation of a single prompt from model at temperature,
+    with draft_model proposing num_draft_tokens tokens at a time that model
+    then checks in one forward pass. Returns the new token ids.
+
+    A drafted token x is kept with probability min(1, p(x) / q(x)), where p
+    and q are the target's and draft's next-token distributions after the
+    same temperature, top-k/top-p and n-gram processing; the first rejected
+    token is replaced by a draw from max(0, p - q), renormalized, and a
+    fully accepted draft earns one more token from p. This makes every
+    token an exact sample from the target's processed distribution, so the
+    result is distributed as plain sampling at that temperature (though
+    not token-for-token equal to it for a given seed).
+
+    Both models must share a vocabulary, e.g. two BLOOM sizes. should_stop
+    and stats behave as in iter_sample_batched and SpeculativeStats.
+    prefix_cache and draft_prefix_cache are PrefixCaches for model and
+    draft_model; caches are per model, so they must not be the same one.
+    """
+    if draft_model.config.vocab_size != model.config.vocab_size:
+        raise ValueError("Draft and target models must share a vocabulary")
+
+    start = time.perf_counter()
+    generator = torch.Generator().manual_seed(int(seed))
+    processors = build_logits_processors(
+        [temperature], no_repeat_ngram_size=no_repeat_ngram_size, top_k=top_k, top_p=top_p
+    )
+
+    def distribution(logits, sequence):
+        scores = processors(torch.tensor([sequence], dtype=torch.long), logits.unsqueeze(0))
+        return F.softmax(scores, dim=-1)[0]
+
+    sequence = input_ids[0].tolist()
+    # Each cache holds every token of sequence but the last
+    with span("prefill_draft"):
+        draft_past = _prefill_all_but_last(draft_model, input_ids, draft_prefix_cache)
+    target_past = _prefill_all_but_last(model, input_ids, prefix_cache)
+    draft_length = target_length = len(sequence) - 1
+
+    generated = []
+    while len(generated) < max_new_tokens:
+        num_draft = min(num_draft_tokens, max_new_tokens - len(generated) - 1)
+
+        with span("draft", tokens_drafted=num_draft):
+            drafted, draft_probs = [], []
+            pending = sequence[draft_length:]
+            for _ in range(num_draft):
+                logits, draft_past = _forward(draft_model, pending, draft_past, draft_length)
+                draft_length += len(pending)
+                q = distribution(logits[-1], sequence + drafted)
+                token = torch.multinomial(q, 1, generator=generator).item()
+                drafted.append(token)
+                draft_probs.append(q)
+                pending = [token]
+
+        with span("verify", tokens_verified=num_draft + 1):
+            fed = sequence[target_length:] + drafted
+            logits, target_past = _forward(model, fed, target_past, target_length)
+            # logits[offset + i] predicts the token after sequence + drafted[:i]
+            offset = len(fed) - num_draft - 1
+
+            accepted = []
+            next_token = None
+            for i, token in enumerate(drafted):
+                p = distribution(logits[offset + i], sequence + accepted)
+                q = draft_probs[i]
+                if torch.rand(1, generator=generator).item() * q[token] < p[token]:
+                    accepted.append(token)
+                    continue
+                residual = (p - q).clamp_min(0)
+                if residual.sum() <= 0:
+                    residual = p
+                next_token = torch.multinomial(residual / residual.sum(), 1, generator=generator).item()
+                break
+            if next_token is None:
+                p = distribution(logits[offset + num_draft], sequence + accepted)
+                next_token = torch.multinomial(p, 1, generator=generator).item()
+
+        # Both caches go back to the accepted tokens; the new one is fed next round
+        target_length = len(sequence) + len(accepted)
+        target_past = crop_past(target_past, target_length)
+        draft_length = min(draft_length, target_length)
+        if draft_past is not None:
+            draft_past = crop_past(draft_past, draft_length)
+
+        new_tokens = accepted + [next_token]
+        if stats is not None:
+            stats.rounds += 1
+            stats.drafted += num_draft
+            stats.accepted += len(accepted)
+
+        done = False
+        for token in new_tokens:
+            generated.append(token)
+            sequence.append(token)
+            if token == eos_token_id:
+                done = True
+                break
+        if done or (should_stop is not None and should_stop(0, generated)):
+            break
+
+    if stats is not None:
+        stats.generated += len(generated)
+        stats.seconds += time.perf_counter() - start
+    return generated
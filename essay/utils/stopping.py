@@ -0,0 +1,114 @@
+import re
+
+
+# Token budgets per mode: the most a unit is allowed to take before
+# generation stops regardless
+STOP_BUDGETS = {
+    'word': 8,
+    'sentence': 64,
+    'paragraph': 384,
+    'tokens': 20
+}
+STOP_MODES = tuple(STOP_BUDGETS)
+
+# A word is complete once something that cannot continue it follows;
+# a leading punctuation mark counts as a word of its own
+WORD_PATTERN = re.compile(r"^\s*(?:[\w'’-]*\w(?=[^\w'’-])|[^\w\s])")
+# Abbreviations whose period does not end a sentence
+ABBREVIATIONS = (
+    "Mr", "Mrs", "Ms", "Dr", "Prof", "Sr", "Jr", "St", "Mt", "Rev", "Gen", "Col", "Capt", "Lt",
+    "vs", "e.g", "i.e", "cf", "al", "Fig", "Vol", "pp"
+)
+_NOT_ABBREVIATION = "".join(rf"(?<!\b{re.escape(abbreviation)})" for abbreviation in ABBREVIATIONS)
+# Sentence punctuation, any closing quotes or brackets, then whitespace
+SENTENCE_PATTERN = re.compile(
+    rf"\S.*?(?:{_NOT_ABBREVIATION}\.|[!?])[.!?]*[\"'”’)\]]*(?=\s)", re.DOTALL
+)
+# A line break after some text ends the paragraph
+PARAGRAPH_PATTERN = re.compile(r"\S[^\n]*(?=\n)")
+
+
+class StopCondition:
+    """
+    When to stop generating one continuation: after a word, a sentence, a
+    paragraph, or only at the token budget (mode "tokens").
+
+    boundary(text) is the length of text up to the end of the first
+    complete unit, or None while the unit is still incomplete. A unit only
+    counts as complete once the character after it has been generated, so
+    "Mr" is not taken for a whole word before the model has a chance to
+    write "Mr." and a sentence does not end inside a closing quote. The
+    period of a common abbreviation ("Mr.", "e.g.") does not end a sentence.
+    """
+    patterns = {
+        'word': WORD_PATTERN,
+        'sentence': SENTENCE_PATTERN,
+        'paragraph': PARAGRAPH_PATTERN,
+        'tokens': None
+    }
+
+    def __init__(self, mode="sentence", max_new_tokens=None):
+        if mode not in STOP_MODES:
+            raise ValueError(f"Stop mode must be one of {STOP_MODES}")
+        self.mode = mode
+        self.max_new_tokens = max_new_tokens or STOP_BUDGETS[mode]
+
+    def __repr__(self):
+        return f"StopCondition({self.mode!r}, max_new_tokens={self.max_new_tokens})"
+
+    def boundary(self, text):
+        pattern = self.patterns[self.mode]
+        if pattern is None:
+            return None
+        match = pattern.match(text) if self.mode == 'word' else pattern.search(text)
+        return match.end() if match else None
+
+    def is_done(self, text):
+        # A trailing replacement character is a multi-byte character still
+        # being decoded, which may yet continue the unit (as in stream_text)
+        return self.boundary(text.rstrip("\ufffd")) is not None
+
+    def trim(self, text):
+        """ text cut at the end of its first complete unit, or unchanged if there is none """
+        end = self.boundary(text)
+        return text if end is None else text[:end]
+
+
+def row_stopper(condition, tokenizer):
+    """
+    should_stop callback for iter_sample_batched: decodes a row's new
+    tokens and asks condition whether its unit is complete
+    """
+    def should_stop(row, token_ids):
+        return condition.is_done(tokenizer.decode(token_ids, skip_special_tokens=True))
+    return should_stop
+
+
+def _unit_stopping_criteria():
+    import torch
+    from transformers import StoppingCriteria
+
+    class UnitStoppingCriteria(StoppingCriteria):
+        """ The same stop condition for model.generate, on a single sequence """
+        def __init__(self, condition, tokenizer, prompt_length):
+            self.condition = condition
+            self.tokenizer = tokenizer
+            self.prompt_length = prompt_length
+
+        def __call__(self, input_ids, scores, **kwargs):
+            done = [
+                self.condition.is_done(self.tokenizer.decode(row[self.prompt_length:], skip_special_tokens=True))
+                for row in input_ids
+            ]
+            return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+    return UnitStoppingCriteria
+
+
+def __getattr__(name):
+    # UnitStoppingCriteria subclasses a transformers class, so it is only
+    # defined on first use and importing the stop modes stays cheap
+    if name == "UnitStoppingCriteria":
+        globals()[name] = _unit_stopping_criteria()
+        return globals()[name]
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,84 @@
+import sqlite3
+
+import pandas as pd
+
+
+class ResultStore:
+    """
+    Append-only SQLite table of experiment results.
+
+    Rows are committed as soon as they are appended, so a crashed run keeps
+    everything it finished, and the key columns let a rerun skip that work.
+    Columns added since a store was created are added to it, null in its
+    older rows.
+    """
+    def __init__(self, path, table, columns, key_columns):
+        self.path = path
+        self.table = table
+        self.columns = list(columns)
+        self.key_columns = list(key_columns)
+        self.connection = sqlite3.connect(path)
+
+        column_sql = ", ".join(f'"{column}"' for column in self.columns)
+        key_sql = ", ".join(f'"{column}"' for column in self.key_columns)
+        with self.connection:
+            self.connection.execute(f'CREATE TABLE IF NOT EXISTS "{table}" ({column_sql})')
+            existing = {row[1] for row in self.connection.execute(f'PRAGMA table_info("{table}")')}
+            for column in self.columns:
+                if column not in existing:
+                    self.connection.execute(f'ALTER TABLE "{table}" ADD COLUMN "{column}"')
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS "{table}_key" ON "{table}" ({key_sql})'
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def _normalize(value):
+        # numpy scalars are not understood by sqlite3
+        if hasattr(value, "item"):
+            value = value.item()
+        return value
+
+    @classmethod
+    def _key_value(cls, value):
+        # float keys (e.g. temperatures) are compared after rounding, so a
+        # value read back from sqlite matches the one computed in a rerun
+        value = cls._normalize(value)
+        if isinstance(value, float):
+            value = round(value, 6)
+        return value
+
+    def key(self, row):
+        return tuple(self._key_value(row[column]) for column in self.key_columns)
+
+    def append(self, rows):
+        """ Insert rows (dicts) in one transaction """
+        rows = list(rows)
+        if not rows:
+            return
+        column_sql = ", ".join(f'"{column}"' for column in self.columns)
+        placeholders = ", ".join("?" for _ in self.columns)
+        values = [
+            tuple(self._normalize(row.get(column)) for column in self.columns)
+            for row in rows
+        ]
+        with self.connection:
+            self.connection.executemany(
+                f'INSERT INTO "{self.table}" ({column_sql}) VALUES ({placeholders})', values
+            )
+
+    def completed_keys(self):
+        key_sql = ", ".join(f'"{column}"' for column in self.key_columns)
+        cursor = self.connection.execute(f'SELECT {key_sql} FROM "{self.table}"')
+        return {tuple(self._key_value(value) for value in row) for row in cursor}
+
+    def to_dataframe(self):
+        return pd.read_sql_query(f'SELECT * FROM "{self.table}"', self.connection)
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,137 @@
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+
+CONTEXT_LENGTH = 2048
+STRIDE = 512
+HEAD_CHUNK = 64
+
+
+def iter_window_logits(model, input_ids, context_length=CONTEXT_LENGTH, stride=STRIDE,
+                       head_chunk=HEAD_CHUNK):
+    """
+    Slide a window over one long sequence and yield (positions, logits) so
+    that every token after the first is predicted exactly once.
+
+    Each window scores the next stride tokens, with the window reaching
+    back context_length tokens, so every prediction sees at least
+    context_length - stride tokens of context. The LM head runs over at
+    most head_chunk positions at a time to bound the vocabulary-sized
+    logits held in memory.
+    """
+    if not 0 < stride < context_length:
+        raise ValueError("Stride must be positive and smaller than the context length")
+
+    seq_len = input_ids.shape[1]
+    for target_start in range(1, seq_len, stride):
+        target_end = min(target_start + stride, seq_len)
+        begin = max(0, target_end - context_length)
+
+        with torch.no_grad():
+            hidden = model.transformer(input_ids[:, begin:target_end]).last_hidden_state[0]
+            # The hidden state at position p - 1 predicts token p
+            for chunk_start in range(target_start, target_end, head_chunk):
+                chunk_end = min(chunk_start + head_chunk, target_end)
+                logits = model.lm_head(hidden[chunk_start - 1 - begin:chunk_end - 1 - begin])
+                yield torch.arange(chunk_start, chunk_end), logits.float()
+
+
+class SurprisalIndex:
+    """
+    Per-token surprisal of one text: for every token its id, position,
+    character span, log-probability, predictive entropy and the rank of
+    the actual token under the model (0 = the model's top choice)
+    """
+    fields = ['token_id', 'char_start', 'char_end', 'log_prob', 'entropy', 'rank']
+
+    def __init__(self, token_id, char_start, char_end, log_prob, entropy, rank):
+        self.token_id = np.asarray(token_id, dtype=np.int64)
+        self.char_start = np.asarray(char_start, dtype=np.int64)
+        self.char_end = np.asarray(char_end, dtype=np.int64)
+        self.log_prob = np.asarray(log_prob, dtype=np.float32)
+        self.entropy = np.asarray(entropy, dtype=np.float32)
+        self.rank = np.asarray(rank, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.token_id)
+
+    @property
+    def surprisal(self):
+        return -self.log_prob
+
+    def tokens_in(self, char_start, char_end):
+        """ Token positions whose characters fall within [char_start, char_end) """
+        return np.flatnonzero((self.char_start >= char_start) & (self.char_end <= char_end))
+
+    def span_perplexity(self, char_start, char_end):
+        positions = self.tokens_in(char_start, char_end)
+        positions = positions[~np.isnan(self.log_prob[positions])]
+        if len(positions) == 0:
+            return np.nan
+        return float(np.exp(-self.log_prob[positions].mean()))
+
+    def rolling_surprisal(self, window):
+        """ Mean surprisal of each run of window consecutive scored tokens """
+        surprisal = np.nan_to_num(self.surprisal[1:], nan=0.0)
+        if len(surprisal) < window:
+            return np.zeros(0, dtype=surprisal.dtype)
+        sums = np.convolve(surprisal, np.ones(window), mode="valid")
+        return sums / window
+
+    def top_passages(self, n=10, window=32):
+        """
+        The n non-overlapping runs of window tokens with the highest mean
+        surprisal, as (char_start, char_end, mean surprisal)
+        """
+        means = self.rolling_surprisal(window)
+        passages = []
+        taken = np.zeros(len(means), dtype=bool)
+        for start in np.argsort(-means, kind="stable"):
+            if len(passages) == n:
+                break
+            if taken[max(0, start - window + 1):start + window].any():
+                continue
+            taken[start] = True
+            # rolling_surprisal skips the unscored first token
+            first, last = start + 1, start + window
+            passages.append((int(self.char_start[first]), int(self.char_end[last]), float(means[start])))
+        return passages
+
+    def save(self, path):
+        np.savez_compressed(path, **{field: getattr(self, field) for field in self.fields})
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(*(data[field] for field in cls.fields))
+
+
+def build_surprisal_index(text, model, tokenizer,
+                          context_length=CONTEXT_LENGTH,
+                          stride=STRIDE):
+    """
+    Score every token of text in one sliding-window pass. The first token
+    has no context and is stored with nan log-probability and entropy.
+    """
+    encoding = tokenizer(text, return_offsets_mapping=True)
+    input_ids = torch.tensor([encoding.input_ids], dtype=torch.long)
+    seq_len = input_ids.shape[1]
+
+    log_prob = np.full(seq_len, np.nan, dtype=np.float32)
+    entropy = np.full(seq_len, np.nan, dtype=np.float32)
+    rank = np.zeros(seq_len, dtype=np.int64)
+
+    for positions, logits in iter_window_logits(model, input_ids, context_length, stride):
+        targets = input_ids[0, positions]
+        log_probs = F.log_softmax(logits, dim=-1)
+        target_log_probs = log_probs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+
+        log_prob[positions] = target_log_probs.numpy()
+        entropy[positions] = torch.special.entr(log_probs.exp()).sum(dim=-1).numpy()
+        rank[positions] = (log_probs > target_log_probs.unsqueeze(-1)).sum(dim=-1).numpy()
+
+    offsets = np.array(encoding.offset_mapping, dtype=np.int64).reshape(-1, 2)
+    return SurprisalIndex(
+        encoding.input_ids, offsets[:, 0], offsets[:, 1], log_prob, entropy, rank
+    )
@@ -0,0 +1,103 @@
+import numpy as np
+
+
+MIN_TEMP = 0.1
+MAX_TEMP = 2.0
+COARSE_POINTS = 5
+SWEEP_BUDGET = 10
+REFINE_PER_ROUND = 2
+MIN_INTERVAL = 0.02
+
+
+def crossing_temperature(temperatures, metrics, target):
+    """
+    Lowest temperature at which the metric curve reaches target, linearly
+    interpolated between neighbouring points; the temperature whose metric
+    is closest to target if the curve never crosses it
+    """
+    temperatures = np.asarray(temperatures, dtype=float)
+    offsets = np.asarray(metrics, dtype=float) - target
+    for i in range(len(offsets) - 1):
+        if offsets[i] == 0:
+            return float(temperatures[i])
+        if offsets[i] * offsets[i + 1] < 0:
+            fraction = offsets[i] / (offsets[i] - offsets[i + 1])
+            return float(temperatures[i] + fraction * (temperatures[i + 1] - temperatures[i]))
+    return float(temperatures[np.argmin(np.abs(offsets))])
+
+
+class AdaptiveSweep:
+    """
+    Chooses which temperatures to generate at for one changepoint.
+
+    It starts from a coarse grid and then, each round, splits the
+    refine_per_round intervals that matter most until budget temperatures
+    have been tried. An interval's priority is how much the metric changes
+    across it (relative to the whole curve's range), doubled if its ends
+    bracket the target (the actual text's value), plus its share of the
+    temperature range so that no stretch of the curve stays unexplored.
+    Intervals narrower than min_interval are never split.
+
+    evaluate(temperatures) must return one metric value per temperature;
+    it is called once per round, so it can batch the whole round.
+    """
+    def __init__(self, evaluate, target,
+                 min_temp=MIN_TEMP, max_temp=MAX_TEMP,
+                 coarse_points=COARSE_POINTS,
+                 budget=SWEEP_BUDGET,
+                 refine_per_round=REFINE_PER_ROUND,
+                 min_interval=MIN_INTERVAL):
+        if budget < coarse_points:
+            raise ValueError("Budget must cover the coarse grid")
+        self.evaluate = evaluate
+        self.target = target
+        self.min_temp = min_temp
+        self.max_temp = max_temp
+        self.coarse_points = coarse_points
+        self.budget = budget
+        self.refine_per_round = refine_per_round
+        self.min_interval = min_interval
+        self.results = {}
+        self.rounds = 0
+
+    def _record(self, temperatures):
+        temperatures = [round(float(temp), 6) for temp in temperatures]
+        metrics = self.evaluate(temperatures)
+        self.results.update(zip(temperatures, map(float, metrics)))
+        self.rounds += 1
+
+    def priorities(self):
+        """ (priority, low, high) of every interval between tried temperatures """
+        temperatures = sorted(self.results)
+        metrics = np.array([self.results[temp] for temp in temperatures])
+        # A non-finite metric (e.g. the perplexity of an empty continuation)
+        # says nothing about the curve's shape, so it adds no metric change
+        finite = np.isfinite(metrics)
+        spread = (np.ptp(metrics[finite]) if finite.any() else 0.0) or 1.0
+        span = self.max_temp - self.min_temp
+
+        intervals = []
+        for (low, high), (a, b) in zip(zip(temperatures, temperatures[1:]), zip(metrics, metrics[1:])):
+            if high - low < 2 * self.min_interval:
+                continue
+            priority = abs(b - a) / spread if np.isfinite(a) and np.isfinite(b) else 0.0
+            if (a - self.target) * (b - self.target) <= 0:
+                priority *= 2
+            priority += (high - low) / span
+            intervals.append((priority, low, high))
+        return sorted(intervals, reverse=True)
+
+    def run(self):
+        """ Sweep until the budget is spent; returns {temperature: metric} in order """
+        self._record(np.linspace(self.min_temp, self.max_temp, self.coarse_points))
+        while len(self.results) < self.budget:
+            count = min(self.refine_per_round, self.budget - len(self.results))
+            intervals = self.priorities()[:count]
+            if not intervals:
+                break
+            self._record([(low + high) / 2 for _, low, high in intervals])
+        return dict(sorted(self.results.items()))
+
+    def crossing_temperature(self):
+        temperatures = sorted(self.results)
+        return crossing_temperature(temperatures, [self.results[temp] for temp in temperatures], self.target)
@@ -0,0 +1,171 @@
+import math
+
+import numpy as np
+import torch
+
+from .surprisal import iter_window_logits, CONTEXT_LENGTH, STRIDE
+
+
+LOGIT_TOP_K = 1024
+TAIL_BINS = 256
+TEMPERATURE_GRID = np.geomspace(0.05, 5.0, 64)
+GOLDEN_RATIO = (math.sqrt(5) - 1) / 2
+FIT_TOLERANCE = 1e-4
+
+
+class LogitCache:
+    """
+    Compact record of the model's next-token logits over a text, enough to
+    evaluate the log-likelihood of the actual tokens at any temperature
+    without another forward pass.
+
+    For each scored token it keeps the actual token's logit, the top_k
+    logits exactly and a histogram of the remaining vocabulary's logits,
+    from which the softmax normalizer at temperature T is
+    logsumexp(top / T, log(count) + bin_center / T).
+
+    metadata holds strings saved with the cache, such as what the logits
+    were computed from, so a stale file can be told apart.
+    """
+    fields = ['positions', 'char_start', 'target_logit', 'top_logits', 'tail_low', 'tail_high', 'tail_counts']
+
+    def __init__(self, positions, char_start, target_logit, top_logits, tail_low, tail_high, tail_counts,
+                 metadata=None):
+        self.positions = np.asarray(positions, dtype=np.int64)
+        self.char_start = np.asarray(char_start, dtype=np.int64)
+        self.target_logit = np.asarray(target_logit, dtype=np.float32)
+        self.top_logits = np.asarray(top_logits, dtype=np.float32)
+        self.tail_low = np.asarray(tail_low, dtype=np.float32)
+        self.tail_high = np.asarray(tail_high, dtype=np.float32)
+        self.tail_counts = np.asarray(tail_counts, dtype=np.int32)
+        self.metadata = dict(metadata or {})
+
+    def __len__(self):
+        return len(self.positions)
+
+    def select(self, char_start=0, char_end=None):
+        """ Indices of the cached tokens starting within [char_start, char_end) """
+        mask = self.char_start >= char_start
+        if char_end is not None:
+            mask &= self.char_start < char_end
+        return np.flatnonzero(mask)
+
+    def log_likelihood(self, temperatures, rows=None):
+        """ Log-probability of each cached actual token at each temperature, shape (temps, tokens) """
+        if rows is None:
+            rows = np.arange(len(self))
+        target = torch.from_numpy(self.target_logit[rows])
+        top = torch.from_numpy(self.top_logits[rows])
+        low = torch.from_numpy(self.tail_low[rows]).unsqueeze(1)
+        high = torch.from_numpy(self.tail_high[rows]).unsqueeze(1)
+        bins = self.tail_counts.shape[1]
+        centers = low + (high - low) * (torch.arange(bins) + 0.5) / bins
+        log_counts = torch.from_numpy(self.tail_counts[rows]).float().log()
+
+        results = []
+        for temperature in np.atleast_1d(temperatures):
+            log_normalizer = torch.logsumexp(
+                torch.cat([top / temperature, log_counts + centers / temperature], dim=1), dim=1
+            )
+            results.append((target / temperature - log_normalizer).numpy())
+        return np.stack(results)
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            **{field: getattr(self, field) for field in self.fields},
+            **{f"metadata_{key}": np.array(str(value)) for key, value in self.metadata.items()}
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            metadata = {
+                name[len("metadata_"):]: str(data[name]) for name in data.files if name.startswith("metadata_")
+            }
+            return cls(*(data[field] for field in cls.fields), metadata=metadata)
+
+
+def cache_logits(text, model, tokenizer,
+                 top_k=LOGIT_TOP_K,
+                 tail_bins=TAIL_BINS,
+                 context_length=CONTEXT_LENGTH,
+                 stride=STRIDE):
+    """ Run the model over text once (sliding window) and keep a LogitCache """
+    encoding = tokenizer(text, return_offsets_mapping=True)
+    input_ids = torch.tensor([encoding.input_ids], dtype=torch.long)
+    offsets = np.array(encoding.offset_mapping, dtype=np.int64).reshape(-1, 2)
+
+    chunks = {field: [] for field in LogitCache.fields}
+    for positions, logits in iter_window_logits(model, input_ids, context_length, stride):
+        targets = input_ids[0, positions]
+        top_logits, top_ids = logits.topk(min(top_k, logits.shape[-1]), dim=-1)
+
+        tail_mask = torch.ones_like(logits).scatter_(1, top_ids, 0.0)
+        low = logits.min(dim=-1).values
+        high = top_logits[:, -1]
+        width = (high - low).clamp_min(1e-6).unsqueeze(1)
+        bin_ids = ((logits - low.unsqueeze(1)) / width * tail_bins).long().clamp(0, tail_bins - 1)
+        counts = torch.zeros((len(positions), tail_bins)).scatter_add_(1, bin_ids, tail_mask)
+
+        chunks['positions'].append(positions.numpy())
+        chunks['char_start'].append(offsets[positions.numpy(), 0])
+        chunks['target_logit'].append(logits.gather(-1, targets.unsqueeze(-1)).squeeze(-1).numpy())
+        chunks['top_logits'].append(top_logits.numpy())
+        chunks['tail_low'].append(low.numpy())
+        chunks['tail_high'].append(high.numpy())
+        chunks['tail_counts'].append(counts.int().numpy())
+
+    return LogitCache(*(np.concatenate(chunks[field]) for field in LogitCache.fields))
+
+
+def fit_temperature(cache, rows=None, grid=TEMPERATURE_GRID, tolerance=FIT_TOLERANCE):
+    """
+    Maximum-likelihood temperature for the cached tokens in rows.
+
+    The total log-likelihood is evaluated on the whole grid at once, then
+    refined by golden-section search between the best grid point's
+    neighbours. Returns (temperature, total log-likelihood).
+    """
+    grid = np.asarray(grid)
+    totals = cache.log_likelihood(grid, rows).sum(axis=1)
+    best = int(np.argmax(totals))
+    low, high = grid[max(best - 1, 0)], grid[min(best + 1, len(grid) - 1)]
+
+    def total(temperature):
+        return float(cache.log_likelihood([temperature], rows).sum())
+
+    a = high - GOLDEN_RATIO * (high - low)
+    b = low + GOLDEN_RATIO * (high - low)
+    total_a, total_b = total(a), total(b)
+    while high - low > tolerance:
+        if total_a > total_b:
+            high, b, total_b = b, a, total_a
+            a = high - GOLDEN_RATIO * (high - low)
+            total_a = total(a)
+        else:
+            low, a, total_a = a, b, total_b
+            b = low + GOLDEN_RATIO * (high - low)
+            total_b = total(b)
+
+    temperature = (low + high) / 2
+    return temperature, total(temperature)
+
+
+def fit_windows(cache, window, step=None, grid=TEMPERATURE_GRID):
+    """
+    Maximum-likelihood temperature of every run of window cached tokens,
+    every step tokens, to the grid's resolution, from one grid evaluation
+    over the whole text. Returns a list of (first row, temperature, mean log-likelihood).
+    """
+    step = step or window
+    grid = np.asarray(grid)
+    log_likelihood = cache.log_likelihood(grid)
+    cumulative = np.concatenate([np.zeros((len(grid), 1)), log_likelihood.cumsum(axis=1)], axis=1)
+
+    results = []
+    for start in range(0, len(cache) - window + 1, step):
+        totals = cumulative[:, start + window] - cumulative[:, start]
+        best = int(np.argmax(totals))
+        results.append((start, float(grid[best]), float(totals[best] / window)))
+    return results
@@ -0,0 +1,158 @@
+import math
+
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+from .cache import prefill
+from .past import to_legacy, to_model_past, select_past
+
+
+TREE_DEPTH = 3
+TREE_TOP_K = 5
+MIN_CUMULATIVE_PROB = 1e-3
+
+
+class WordTree:
+    """
+    Top-k next-token tree stored as parallel arrays, one entry per node.
+
+    Node 0 is the root (the prompt); every other node is a token with its
+    parent's index, its depth, its probability given the path to its
+    parent and the cumulative probability of the whole path.
+    """
+    def __init__(self, parent, token_id, depth, log_prob, cum_log_prob, temperature=1.0):
+        self.parent = np.asarray(parent, dtype=np.int32)
+        self.token_id = np.asarray(token_id, dtype=np.int64)
+        self.depth = np.asarray(depth, dtype=np.int16)
+        self.log_prob = np.asarray(log_prob, dtype=np.float32)
+        self.cum_log_prob = np.asarray(cum_log_prob, dtype=np.float32)
+        self.temperature = temperature
+
+    def __len__(self):
+        return len(self.parent)
+
+    def children(self, node):
+        """ Child node indices, most probable first """
+        children = np.flatnonzero(self.parent == node)
+        return children[np.argsort(-self.log_prob[children], kind="stable")]
+
+    def path(self, node):
+        """ Token ids from the root down to node """
+        tokens = []
+        while node > 0:
+            tokens.append(int(self.token_id[node]))
+            node = self.parent[node]
+        return tokens[::-1]
+
+    def compare(self, actual_ids):
+        """
+        Follow the actual continuation down the tree. Returns one record per
+        depth with the actual token, its rank among the siblings (-1 when
+        pruned), its probability and the path's cumulative probability.
+        """
+        records = []
+        node = 0
+        for depth, token_id in enumerate(list(actual_ids)[:int(self.depth.max())], start=1):
+            children = self.children(node) if node is not None else np.array([], dtype=np.int64)
+            matches = np.flatnonzero(self.token_id[children] == token_id)
+            if len(matches) == 0:
+                records.append({'depth': depth, 'token_id': int(token_id), 'rank': -1,
+                                'prob': math.nan, 'cum_prob': math.nan})
+                node = None
+                continue
+            node = int(children[matches[0]])
+            records.append({
+                'depth': depth,
+                'token_id': int(token_id),
+                'rank': int(matches[0]),
+                'prob': float(np.exp(self.log_prob[node])),
+                'cum_prob': float(np.exp(self.cum_log_prob[node]))
+            })
+        return records
+
+    def describe(self, tokenizer, node=0, indent=""):
+        """ Indented text rendering, one line per node """
+        lines = []
+        for child in self.children(node):
+            text = tokenizer.decode([int(self.token_id[child])])
+            lines.append(f"{indent}{text!r} ({100 * np.exp(self.log_prob[child]):.1f}%)")
+            lines.extend(self.describe(tokenizer, child, indent + "    "))
+        return lines if node != 0 else "\n".join(lines)
+
+    def save(self, path):
+        np.savez_compressed(
+            path,
+            parent=self.parent, token_id=self.token_id, depth=self.depth,
+            log_prob=self.log_prob, cum_log_prob=self.cum_log_prob,
+            temperature=np.float32(self.temperature)
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(
+                data['parent'], data['token_id'], data['depth'],
+                data['log_prob'], data['cum_log_prob'],
+                temperature=float(data['temperature'])
+            )
+
+
+def build_word_tree(prompt, model, tokenizer,
+                    depth=TREE_DEPTH,
+                    top_k=TREE_TOP_K,
+                    min_cum_prob=MIN_CUMULATIVE_PROB,
+                    temperature=1.0,
+                    prefix_cache=None,
+                    prompt_ids=None):
+    """
+    Expand the top-k next-token tree of a prompt to the given depth.
+
+    The prompt is encoded once. Each level then runs as one forward pass
+    over all of its nodes, every node continuing from its parent's KV cache
+    with just its own token. Branches whose cumulative probability falls
+    below min_cum_prob are pruned.
+    """
+    if prompt_ids is None:
+        prompt_ids = tokenizer(prompt, return_tensors='pt').input_ids
+    prompt_length = prompt_ids.shape[1]
+    min_cum_log_prob = math.log(min_cum_prob) if min_cum_prob > 0 else -math.inf
+
+    parent, token_id, node_depth, log_prob, cum_log_prob = [-1], [-1], [0], [0.0], [0.0]
+
+    past, logits = prefill(model, prompt_ids, prefix_cache)
+    frontier = torch.tensor([0])
+    for level in range(1, depth + 1):
+        level_log_probs = F.log_softmax(logits.float() / temperature, dim=-1)
+        top_log_probs, top_ids = level_log_probs.topk(top_k, dim=-1)
+        path_log_probs = torch.tensor(cum_log_prob)[frontier].unsqueeze(1) + top_log_probs
+
+        rows, columns = (path_log_probs >= min_cum_log_prob).nonzero(as_tuple=True)
+        if len(rows) == 0:
+            break
+
+        first_child = len(parent)
+        parent.extend(frontier[rows].tolist())
+        token_id.extend(top_ids[rows, columns].tolist())
+        node_depth.extend([level] * len(rows))
+        log_prob.extend(top_log_probs[rows, columns].tolist())
+        cum_log_prob.extend(path_log_probs[rows, columns].tolist())
+
+        if level == depth:
+            break
+
+        # Every child continues from its parent's cache with its own token
+        child_past = select_past(past, rows, len(frontier))
+        child_tokens = top_ids[rows, columns].unsqueeze(1)
+        with torch.no_grad():
+            outputs = model(
+                child_tokens,
+                past_key_values=to_model_past(child_past),
+                attention_mask=torch.ones((len(rows), prompt_length + level), dtype=torch.long),
+                use_cache=True
+            )
+        past = to_legacy(outputs.past_key_values)
+        logits = outputs.logits[:, -1, :]
+        frontier = torch.arange(first_child, len(parent))
+
+    return WordTree(parent, token_id, node_depth, log_prob, cum_log_prob, temperature=temperature)
@@ -0,0 +1,51 @@
+from utils.cache import PrefixCache
+from utils.ingest import DATA_SOURCE, iter_work_units
+from utils.registry import get_model
+from utils.tree import build_word_tree, TREE_DEPTH, TREE_TOP_K, MIN_CUMULATIVE_PROB
+import pandas as pd
+
+
+class WordTreeExperiment:
+    """
+    Builds a probability word tree at every essay changepoint and compares
+    it against the author's actual continuation
+    """
+    def __init__(self, precision="fp32", data_source=DATA_SOURCE):
+        self.model, self.tokenizer = get_model("essay/models/bloom-1b1", precision=precision)
+        self.data_source = data_source
+
+    def run(self, verbose=True, depth=TREE_DEPTH, top_k=TREE_TOP_K,
+            min_cum_prob=MIN_CUMULATIVE_PROB, temperature=1.0):
+        results = []
+        essay = None
+        for unit in iter_work_units(self.data_source):
+            i, j, prompt, actual_output = unit.essay, unit.changepoint, unit.prompt, unit.actual_output
+            if i != essay:
+                # Prompts within an essay are prefixes of one another
+                essay, prefix_cache = i, PrefixCache()
+            tree = build_word_tree(
+                prompt, self.model, self.tokenizer,
+                depth=depth, top_k=top_k, min_cum_prob=min_cum_prob,
+                temperature=temperature, prefix_cache=prefix_cache
+            )
+            tree.save(f"essay/results/word-tree-essay-{i}-{j}.npz")
+
+            actual_ids = self.tokenizer(actual_output, add_special_tokens=False).input_ids
+            for record in tree.compare(actual_ids):
+                results.append({
+                    'essay': i,
+                    'changepoint': j,
+                    'actual_token': self.tokenizer.decode([record['token_id']]),
+                    **record
+                })
+
+            if verbose:
+                print(f"Essay {i}, changepoint {j}: {len(tree)} nodes")
+                print(tree.describe(self.tokenizer))
+
+        pd.DataFrame(results).to_csv("essay/results/word-tree-results.csv")
+
+
+if __name__ == "__main__":
+    experiment = WordTreeExperiment()
+    experiment.run()
@@ -1,10 +1,172 @@
-from essay.autocomplete import AutocompleteExperiment
+import argparse
+import os
+import sys
+import tempfile
+import time
 
+# The experiment modules import their helpers as the top-level `utils` package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "essay"))
 
-def run():
-    experiment = AutocompleteExperiment()
-    experiment.run()
+# Only lightweight modules here: list, validate and plan never load torch,
+# and run imports the experiments when it starts
+from utils.bloom import PRECISIONS, BACKENDS
+from utils.ingest import DATA_SOURCE, IngestStats, iter_essay_paths, iter_work_units, parse_essay
+from utils.profiling import TRACER, profiled
+from utils.stopping import STOP_MODES
+
+COMMANDS = ("run", "list", "validate", "plan")
+
+
+def store_path(stop=None):
+    # Each stop mode keeps its own results so resuming never mixes them
+    if stop:
+        return f"essay/results/autocomplete-results-{stop}.sqlite"
+    from autocomplete import STORE_PATH
+    return STORE_PATH
+
+
+def run(workers=1, compare_serial=False, precision="fp32", cache_path=None, stop=None, draft_path=None,
+        data_source=DATA_SOURCE, backend="eager"):
+    from autocomplete import AutocompleteExperiment
+    from parallel import ParallelAutocompleteExperiment
+    from utils.disk_cache import DiskCache
+    from utils.registry import REGISTRY, get_model
+
+    kwargs = {'cache': DiskCache(cache_path)} if cache_path else {}
+    if stop:
+        kwargs.update(stop=stop, store_path=store_path(stop))
+    compare_dir = None
+    if workers > 1 and compare_serial:
+        # Both passes start from an empty store of their own, or the second
+        # would resume from the first's results and generate nothing
+        compare_dir = tempfile.mkdtemp(prefix="essay-compare-")
+        print(f"Comparing serial and parallel runs with fresh stores in {compare_dir}")
+    serial_elapsed = None
+    if workers == 1 or compare_serial:
+        start = time.perf_counter()
+        experiment = AutocompleteExperiment(precision=precision, data_source=data_source, backend=backend)
+        serial_kwargs = dict(kwargs)
+        if compare_dir:
+            serial_kwargs['store_path'] = os.path.join(compare_dir, "serial.sqlite")
+        if draft_path:
+            serial_kwargs['draft_model'], _ = get_model(draft_path, precision=precision)
+        experiment.run(**serial_kwargs)
+        serial_elapsed = time.perf_counter() - start
+        print(f"Serial run took {serial_elapsed:.1f}s")
+        print(REGISTRY.report())
+
+    if workers > 1:
+        start = time.perf_counter()
+        # Workers load the draft model themselves rather than receive a pickled copy
+        experiment = ParallelAutocompleteExperiment(
+            workers=workers, precision=precision, data_source=data_source, backend=backend,
+            draft_path=draft_path
+        )
+        parallel_kwargs = dict(kwargs)
+        if compare_dir:
+            parallel_kwargs['store_path'] = os.path.join(compare_dir, "parallel.sqlite")
+        experiment.run(**parallel_kwargs)
+        parallel_elapsed = time.perf_counter() - start
+        print(f"Parallel run on {workers} workers took {parallel_elapsed:.1f}s")
+        if serial_elapsed is not None:
+            print(f"Speedup over serial: {serial_elapsed / parallel_elapsed:.2f}x")
+
+
+def list_essays(data_source=DATA_SOURCE):
+    """ Print each essay with its number and number of changepoints """
+    stats = IngestStats()
+    essays = {}
+    for unit in iter_work_units(data_source, stats, skip_invalid=True):
+        essays.setdefault(unit.essay, [unit.name, 0])[1] += 1
+    for essay, (name, num_changepoints) in essays.items():
+        print(f"{essay:>6}  {name:<30} {num_changepoints:>3} changepoints")
+    print(stats.report())
+
+
+def validate(data_source=DATA_SOURCE):
+    """ Check every essay's markers; returns the number of invalid essays """
+    invalid = 0
+    for path in iter_essay_paths(data_source):
+        with open(path, "r", encoding="utf8") as f:
+            try:
+                parse_essay(f.read())
+            except ValueError as error:
+                invalid += 1
+                print(f"INVALID {path}: {error}")
+    print("All essays are valid" if not invalid else f"{invalid} invalid essays")
+    return invalid
+
+
+def plan(data_source=DATA_SOURCE, stop=None, workers=1):
+    """ Print the (essay, changepoint, temperature) units a run would generate, skipping stored ones """
+    import numpy as np
+    from autocomplete import MIN_TEMP, MAX_TEMP, NUM_TEMPS, STORE_COLUMNS, STORE_KEY
+    from utils.store import ResultStore
+
+    temperatures = np.linspace(MIN_TEMP, MAX_TEMP, NUM_TEMPS)
+    path = store_path(stop)
+    completed, key = set(), None
+    if os.path.exists(path):
+        with ResultStore(path, "autocomplete", STORE_COLUMNS, STORE_KEY) as store:
+            completed, key = store.completed_keys(), store.key
+
+    total = pending_total = 0
+    for unit in iter_work_units(data_source):
+        pending = sum(
+            1 for temp in temperatures
+            if key is None or key({'essay': unit.essay, 'changepoint': unit.changepoint, 'temp': temp}) not in completed
+        )
+        total += len(temperatures)
+        pending_total += pending
+        print(
+            f"essay {unit.essay} ({unit.name}) changepoint {unit.changepoint}: "
+            f"{pending}/{len(temperatures)} temperatures to generate, "
+            f"prompt {len(unit.prompt)} chars, actual output {len(unit.actual_output)} chars"
+        )
+    print(f"{pending_total} of {total} units to generate into {path} on {workers} worker(s)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run the essay autocomplete experiment")
+    parser.add_argument("command", nargs="?", choices=COMMANDS, default="run",
+                        help="run the experiment (default), list the essays, validate their markers, "
+                             "or print the work plan; only run loads the model")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="number of worker processes, each loading its own model")
+    parser.add_argument("--compare-serial", action="store_true",
+                        help="also run the serial path and report the speedup")
+    parser.add_argument("--precision", choices=PRECISIONS, default="fp32",
+                        help="model weight precision; int8 uses dynamic quantization on CPU")
+    parser.add_argument("--backend", choices=BACKENDS, default="eager",
+                        help="run prefills and scoring passes through torch.compile or TorchScript "
+                             "graphs at bucketed lengths; decoding steps stay eager")
+    parser.add_argument("--cache", metavar="DIR",
+                        help="reuse generations from an on-disk cache shared across runs")
+    parser.add_argument("--stop", choices=STOP_MODES,
+                        help="end each continuation after a word, sentence or paragraph "
+                             "instead of at 3x the actual output's length")
+    parser.add_argument("--draft", metavar="PATH",
+                        help="smaller BLOOM (e.g. essay/models/bloom-560m) for speculative decoding")
+    parser.add_argument("--data", metavar="DIR_OR_GLOB", default=DATA_SOURCE,
+                        help="directory (searched recursively for .txt files) or glob of marked-up essays")
+    parser.add_argument("--trace", metavar="PATH", default=os.environ.get("ESSAY_TRACE"),
+                        help="write per-stage timing spans as Chrome trace JSON "
+                             "(set ESSAY_PROFILE=torch or cprofile to profile the run as well)")
+    return parser.parse_args()
 
 
 if __name__=="__main__":
-    run()
\ No newline at end of file
+    args = parse_args()
+    if args.command == "list":
+        list_essays(args.data)
+    elif args.command == "validate":
+        sys.exit(1 if validate(args.data) else 0)
+    elif args.command == "plan":
+        plan(args.data, stop=args.stop, workers=args.workers)
+    else:
+        with profiled():
+            run(workers=args.workers, compare_serial=args.compare_serial, precision=args.precision, cache_path=args.cache, stop=args.stop, draft_path=args.draft, data_source=args.data, backend=args.backend)
+        print(TRACER.summary())
+        if args.trace:
+            TRACER.save(args.trace)
+            print(f"Saved trace to {args.trace}")
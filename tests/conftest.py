@@ -0,0 +1,26 @@
+import os
+import sys
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The experiment modules import their helpers as the top-level `utils` package
+sys.path.insert(0, os.path.join(REPO_ROOT, "essay"))
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    """ A random BLOOM with a tokenizer trained on the essays, so tests run offline in seconds """
+    from benchmark import build_tiny_model
+
+    return build_tiny_model(
+        str(tmp_path_factory.mktemp("bloom-tiny")),
+        data_glob=os.path.join(REPO_ROOT, "essay", "data", "essay-*.txt")
+    )
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tiny_model_path):
+    from utils.registry import get_model
+
+    return get_model(tiny_model_path)
@@ -0,0 +1,23 @@
+from utils.bloom import generate_text
+from utils.cache import PrefixCache
+
+
+ESSAY = "The river ran low that summer, and the town waited for rain that never came. Nobody spoke of it"
+
+
+def test_prefix_cache_hit_generates_as_a_cold_run(tiny_model):
+    model, tokenizer = tiny_model
+    earlier, prompt = ESSAY[:40], ESSAY
+    kwargs = dict(
+        model=model, tokenizer=tokenizer, temperatures=[0.7, 1.3], seeds=[5, 6],
+        batched=True, max_new_tokens=10
+    )
+
+    cold = generate_text(prompt, prompt, " at all.", **kwargs)
+
+    prefix_cache = PrefixCache()
+    generate_text(earlier, earlier, " at all.", prefix_cache=prefix_cache, **kwargs)
+    warm = generate_text(prompt, prompt, " at all.", prefix_cache=prefix_cache, **kwargs)
+
+    assert prefix_cache.hits >= 1 and prefix_cache.tokens_reused > 0
+    assert warm == cold
@@ -0,0 +1,120 @@
+import os
+
+import numpy as np
+import pytest
+import torch
+
+from conftest import REPO_ROOT
+from utils.bloom import generate_text, load_model
+from utils.cache import PrefixCache, prefill
+from utils.compiled import backend_stats, bucket_length, set_backend
+from utils.scoring import continuation_perplexities
+
+MAX_LOGIT_DIFFERENCE = 1e-4
+
+
+@pytest.fixture(scope="module")
+def model(tiny_model_path):
+    # Not the registry's copy: set_backend changes the model in place
+    model, tokenizer = load_model(tiny_model_path)
+    yield model, tokenizer
+    set_backend(model, "eager")
+
+
+@pytest.fixture(scope="module")
+def essay():
+    with open(os.path.join(REPO_ROOT, "essay", "data", "essay-1.txt"), encoding="utf8") as f:
+        return f.read().replace("[START]", "").replace("[CHANGE]", "").replace("[END]", "")[:3000]
+
+
+def compare(model, backend, run):
+    """ run()'s outputs on eager and on backend, leaving the model on eager """
+    set_backend(model, "eager")
+    expected = run()
+    set_backend(model, backend)
+    try:
+        return expected, run(), backend_stats(model)
+    finally:
+        set_backend(model, "eager")
+
+
+def test_bucket_length():
+    assert bucket_length(1) == 32
+    assert bucket_length(33) == 64
+    assert bucket_length(2048) == 2048
+    assert bucket_length(2049) == 2560
+
+
+@pytest.mark.parametrize("backend", ["torchscript", "compile"])
+def test_logits_match_eager(model, essay, backend):
+    model, tokenizer = model
+    input_ids = tokenizer(essay, return_tensors='pt').input_ids
+    # Two lengths in one bucket share a graph
+    lengths = [200, 240]
+
+    def run():
+        with torch.no_grad():
+            return [model(input_ids[:, :length], use_cache=False).logits for length in lengths]
+
+    expected, actual, stats = compare(model, backend, run)
+    for expected_logits, logits in zip(expected, actual):
+        assert logits.shape == expected_logits.shape
+        assert (logits - expected_logits).abs().max().item() < MAX_LOGIT_DIFFERENCE
+    assert stats[backend] == len(lengths) and 'eager' not in stats
+    if backend == "torchscript":
+        assert stats['traced_shapes'] == 1
+
+
+def test_prefix_cache_extension_matches_eager(model, essay):
+    model, tokenizer = model
+    input_ids = tokenizer(essay, return_tensors='pt').input_ids
+
+    def run():
+        prefix_cache = PrefixCache()
+        prefill(model, input_ids[:, :150], prefix_cache)
+        return prefill(model, input_ids[:, :260], prefix_cache)
+
+    (expected_past, expected_logits), (past, logits), stats = compare(model, "torchscript", run)
+    assert (logits - expected_logits).abs().max().item() < MAX_LOGIT_DIFFERENCE
+    for (expected_key, expected_value), (key, value) in zip(expected_past, past):
+        assert key.shape == expected_key.shape
+        assert (key - expected_key).abs().max().item() < MAX_LOGIT_DIFFERENCE
+        assert (value - expected_value).abs().max().item() < MAX_LOGIT_DIFFERENCE
+    # Both the cold prefill and its extension on the cached past are compiled
+    assert stats['torchscript'] == 2 and 'eager' not in stats
+
+
+def test_continuation_scoring_matches_eager(model, essay):
+    model, tokenizer = model
+    continuations = [" the sky went dark", " and then it was over, all of it", ""]
+
+    def run():
+        return continuation_perplexities(essay[:1000], continuations, model, tokenizer)
+
+    expected, actual, stats = compare(model, "torchscript", run)
+    np.testing.assert_allclose(actual, expected, rtol=1e-5)
+    assert stats['torchscript'] == 2 and 'eager' not in stats
+
+
+def test_generation_matches_eager(model, essay):
+    model, tokenizer = model
+
+    def run():
+        return generate_text(
+            essay[:600], essay[400:600], essay[600:700],
+            model=model, tokenizer=tokenizer,
+            temperatures=[0.7, 1.0], batched=True, seeds=[1, 2], max_new_tokens=8
+        )
+
+    expected, actual, stats = compare(model, "torchscript", run)
+    assert actual == expected
+    # The prefill is compiled; decoding steps stay eager
+    assert stats['torchscript'] >= 1 and stats['eager'] >= 1
+
+
+def test_eager_restores_forward(model):
+    model, _ = model
+    set_backend(model, "torchscript")
+    set_backend(model, "eager")
+    assert "forward" not in model.transformer.__dict__
+    assert backend_stats(model) == {'backend': "eager"}
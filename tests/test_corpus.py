@@ -0,0 +1,38 @@
+import pytest
+
+from utils.corpus import Corpus, compile_corpus
+
+
+def write_essay(tmp_path, text):
+    path = tmp_path / "essay-1.txt"
+    path.write_text(text, encoding="utf8")
+    return str(path)
+
+
+@pytest.mark.parametrize("prompt, actual_output", [
+    # The changepoint falls inside a token of the whole essay
+    ("The extr", "aordinary weather."),
+    ("The extraordinary", " weather."),
+])
+def test_spans_decode_to_exactly_their_text(tmp_path, tiny_model, prompt, actual_output):
+    _, tokenizer = tiny_model
+    path = write_essay(tmp_path, f"[START]{prompt}[CHANGEPOINT]{actual_output}[END] It rained.")
+    corpus_path = str(tmp_path / "corpus")
+    compile_corpus([path], tokenizer, corpus_path)
+
+    corpus = Corpus(corpus_path)
+    assert tokenizer.decode(corpus.prompt_ids("essay-1", 0)[0].tolist()) == prompt
+    assert tokenizer.decode(corpus.prompt_short_ids("essay-1", 0)[0].tolist()) == prompt
+    assert tokenizer.decode(corpus.actual_output_ids("essay-1", 0)[0].tolist()) == actual_output
+
+
+def test_stale_corpus_is_rejected(tmp_path, tiny_model):
+    _, tokenizer = tiny_model
+    path = write_essay(tmp_path, "[START]A short essay[CHANGEPOINT] about[END] nothing.")
+    corpus_path = str(tmp_path / "corpus")
+    compile_corpus([path], tokenizer, corpus_path)
+    Corpus(corpus_path)
+
+    write_essay(tmp_path, "[START]A revised essay[CHANGEPOINT] about[END] nothing.")
+    with pytest.raises(ValueError, match="stale"):
+        Corpus(corpus_path)
@@ -0,0 +1,31 @@
+import pytest
+
+from utils.bloom import generate_text
+from utils.disk_cache import DiskCache
+
+
+PROMPT = "The river ran low that summer, and the town waited"
+
+
+def test_disk_cache_hit_skips_the_model(tmp_path, tiny_model, monkeypatch):
+    model, tokenizer = tiny_model
+    kwargs = dict(
+        model=model, tokenizer=tokenizer, temperatures=[0.7, 1.3], seeds=[5, 6],
+        batched=True, max_new_tokens=8
+    )
+    cache = DiskCache(str(tmp_path / "cache"))
+    stored = generate_text(PROMPT, PROMPT, " for rain.", cache=cache, **kwargs)
+    assert cache.misses == 1 and len(cache) == 1
+
+    def forward(*args, **kwargs):
+        raise AssertionError("the model ran on a cache hit")
+
+    monkeypatch.setattr(model, "forward", forward)
+    # A fresh instance over the same directory, as a later run would open it
+    cache = DiskCache(str(tmp_path / "cache"))
+    assert generate_text(PROMPT, PROMPT, " for rain.", cache=cache, **kwargs) == stored
+    assert cache.hits == 1
+
+    # Different parameters are a different key, so the model would run
+    with pytest.raises(AssertionError, match="cache hit"):
+        generate_text(PROMPT, PROMPT, " for rain.", cache=cache, **{**kwargs, 'seeds': [7, 8]})
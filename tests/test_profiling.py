@@ -0,0 +1,12 @@
+from utils.profiling import Tracer
+
+
+def test_merge_adds_drained_spans():
+    worker, parent = Tracer(), Tracer()
+    with worker.span("decode", rows=3):
+        pass
+    parent.merge(worker.drain())
+    assert worker.events == [] and not worker.totals
+    assert parent.totals["decode"]["calls"] == 1
+    assert parent.totals["decode"]["rows"] == 3
+    assert [event["name"] for event in parent.events] == ["decode"]
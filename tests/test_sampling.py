@@ -0,0 +1,41 @@
+import torch
+
+from utils.past import past_nbytes
+from utils.sampling import sample_batched
+from utils.scoring import score_continuations
+
+
+PROMPT = "The town waited for rain through the long summer, and"
+TEMPERATURES = [0.5, 1.0, 1.5, 2.0]
+
+
+def test_rows_grouped_under_a_memory_budget_match_one_batch(tiny_model):
+    model, tokenizer = tiny_model
+    input_ids = tokenizer(PROMPT, return_tensors="pt").input_ids
+    kwargs = dict(seeds=[7, 8, 9, 10], max_new_tokens=12, eos_token_id=tokenizer.eos_token_id)
+
+    together = sample_batched(model, input_ids, TEMPERATURES, **kwargs)
+    # Room for about one row's cache at a time
+    one_row = past_nbytes(model(input_ids, use_cache=True).past_key_values)
+    grouped = sample_batched(model, input_ids, TEMPERATURES, max_past_bytes=3 * one_row, **kwargs)
+    assert torch.equal(together, grouped)
+
+
+def test_scoring_batches_shrink_under_a_memory_budget(tiny_model):
+    model, tokenizer = tiny_model
+    continuations = [" it never came.", " the river ran dry", " nobody spoke"]
+    together = score_continuations(PROMPT, continuations, model, tokenizer)
+    grouped = score_continuations(PROMPT, continuations, model, tokenizer, max_past_bytes=1)
+    for a, b in zip(together, grouped):
+        assert torch.allclose(a, b, atol=1e-5)
+
+
+def test_a_row_depends_only_on_its_own_seed(tiny_model):
+    model, tokenizer = tiny_model
+    input_ids = tokenizer(PROMPT, return_tensors="pt").input_ids
+    kwargs = dict(max_new_tokens=12, eos_token_id=tokenizer.eos_token_id, pad_token_id=tokenizer.pad_token_id)
+
+    alone = sample_batched(model, input_ids, [1.0], seeds=[42], **kwargs)[0]
+    batch = sample_batched(model, input_ids, [0.3, 1.0, 1.8], seeds=[1, 42, 3], **kwargs)
+    assert torch.equal(batch[1, :len(alone)], alone)
+    assert (batch[1, len(alone):] == tokenizer.pad_token_id).all()
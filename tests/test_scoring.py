@@ -0,0 +1,43 @@
+import pytest
+import torch
+
+from utils.bloom import calculate_perplexity
+from utils.cache import PrefixCache
+from utils.scoring import continuation_perplexities, next_token_probabilities
+
+
+PROMPT = "The river ran low that summer, and the town waited"
+CONTINUATIONS = [" for rain that never came.", " in silence", " and waited, and waited for the rain"]
+
+
+def test_continuation_perplexities_match_calculate_perplexity(tiny_model):
+    model, tokenizer = tiny_model
+    prompt_length = tokenizer(PROMPT, return_tensors="pt").input_ids.shape[1]
+    expected = [
+        calculate_perplexity(PROMPT + continuation, model=model, tokenizer=tokenizer,
+                             start_calculating_at=prompt_length)
+        for continuation in CONTINUATIONS
+    ]
+
+    # Batches of two, so one batch is right-padded
+    shared = continuation_perplexities(
+        PROMPT, CONTINUATIONS, model, tokenizer, batch_size=2, prefix_cache=PrefixCache()
+    )
+    assert shared == pytest.approx(expected, rel=1e-4)
+
+
+def test_next_token_probabilities_match_the_full_forward_pass(tiny_model):
+    model, tokenizer = tiny_model
+    prompts = [PROMPT, "Nobody spoke", PROMPT + CONTINUATIONS[0]]
+    temperatures = [0.5, 1.0, 1.7]
+    # Prompts of different lengths share a padded batch
+    token_ids, probs = next_token_probabilities(prompts, temperatures, model, tokenizer, top_k=5, batch_size=2)
+
+    for row, prompt in enumerate(prompts):
+        input_ids = tokenizer(prompt, return_tensors="pt").input_ids
+        with torch.no_grad():
+            logits = model(input_ids).logits[0, -1].float()
+        for column, temperature in enumerate(temperatures):
+            expected = torch.softmax(logits / temperature, dim=-1)
+            assert torch.allclose(probs[row, column], expected[token_ids[row, column]], atol=1e-5)
+            assert torch.equal(token_ids[row, column], expected.topk(5).indices)
@@ -0,0 +1,96 @@
+import json
+import math
+import urllib.error
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import pytest
+
+from utils.server import BloomClient, DynamicBatcher, InferenceServer
+
+PROMPT = "The eclipse began at noon, and"
+
+
+@pytest.fixture(scope="module")
+def client(tiny_model_path):
+    server = InferenceServer(model_path=tiny_model_path, port=0, max_wait=0.05)
+    server.start()
+    yield BloomClient(server.url, timeout=60)
+    server.shutdown()
+    server.server_close()
+
+
+def post(client, path, data):
+    request = urllib.request.Request(client.url + path, data=data, headers={"Content-Type": "application/json"})
+    with pytest.raises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request, timeout=60)
+    return error.value.code, json.loads(error.value.read())
+
+
+def test_generate(client):
+    outputs = client.generate(PROMPT, [0.5, 1.0], max_new_tokens=5, seeds=[1, 2])
+    assert len(outputs) == 2
+    assert all(isinstance(output, str) for output in outputs)
+    # Seeded sampling is reproducible across requests
+    assert client.generate(PROMPT, [0.5, 1.0], max_new_tokens=5, seeds=[1, 2]) == outputs
+
+
+def test_perplexity(client):
+    perplexity = client.perplexity(PROMPT, " the sky went dark.")
+    assert math.isfinite(perplexity) and perplexity > 1
+    # An empty continuation has no perplexity, sent as null rather than NaN
+    assert client.perplexity(PROMPT, "") is None
+
+
+def test_probabilities(client):
+    outputs = client.probabilities(PROMPT, temperature=0.8, num_outputs=3)
+    assert len(outputs) == 3
+    assert all(text.startswith(PROMPT) for text, _ in outputs)
+    probs = [prob for _, prob in outputs]
+    assert probs == sorted(probs, reverse=True)
+    assert 0 < sum(probs) <= 1 + 1e-6
+
+
+def test_bad_request_fails_alone(client):
+    def good():
+        return client.perplexity(PROMPT, " the sky went dark.")
+
+    def bad():
+        return post(client, "/generate", json.dumps({'prompt': PROMPT}).encode("utf8"))
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(good), pool.submit(bad), pool.submit(good)]
+        results = [future.result() for future in futures]
+    assert math.isfinite(results[0]) and results[0] == pytest.approx(results[2])
+    status, body = results[1]
+    assert status == 400 and 'temperatures' in body['error']
+
+
+def test_failed_batch_reruns_one_by_one(tiny_model):
+    batcher = DynamicBatcher(*tiny_model)
+
+    def handler(payloads):
+        if any(payload['prompt'] == "bad" for payload in payloads):
+            raise RuntimeError("bad prompt")
+        return [payload['prompt'] for payload in payloads]
+
+    requests = [(kind, {'prompt': prompt}, Future(), 0.0) for kind, prompt in
+                [('perplexity', "a"), ('perplexity', "bad"), ('perplexity', "b")]]
+    batcher._run(handler, requests)
+    futures = [future for _, _, future, _ in requests]
+    assert futures[0].result() == "a" and futures[2].result() == "b"
+    with pytest.raises(RuntimeError):
+        futures[1].result()
+
+
+def test_malformed_json(client):
+    status, body = post(client, "/perplexity", b"{not json")
+    assert status == 400 and 'error' in body
+
+
+def test_stats(client):
+    client.perplexity(PROMPT, " and then")
+    stats = client.stats()
+    assert stats['requests'] >= 1 and stats['batches'] >= 1
+    assert stats['mean_batch_size'] >= 1
+    assert stats['latency_p95'] >= stats['latency_p50'] >= 0
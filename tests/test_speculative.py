@@ -0,0 +1,19 @@
+import pytest
+
+from utils.speculative import SpeculativeStats, speculative_sample
+
+
+@pytest.mark.parametrize("temperature", [0.3, 1.0])
+def test_model_as_its_own_draft_accepts_every_token(tiny_model, temperature):
+    model, tokenizer = tiny_model
+    input_ids = tokenizer("The river ran low that summer, and the town", return_tensors="pt").input_ids
+    stats = SpeculativeStats()
+    output_ids = speculative_sample(
+        model, model, input_ids, temperature, seed=3, max_new_tokens=16, stats=stats
+    )
+
+    assert len(output_ids) == 16
+    assert stats.drafted > 0
+    assert stats.acceptance_rate == pytest.approx(1.0)
+    # Each round gains every drafted token plus the target's own
+    assert stats.tokens_per_round > 1
@@ -0,0 +1,44 @@
+import pytest
+
+from utils.bloom import generate_text
+from utils.stopping import StopCondition
+
+
+@pytest.mark.parametrize("mode, text, expected", [
+    ("word", " Hello there", " Hello"),
+    ("word", " don't stop", " don't"),
+    ("word", ", and so", ","),
+    ("sentence", " It rained. Then it stopped.", " It rained."),
+    ("sentence", ' "Go home!" she said', ' "Go home!"'),
+    ("sentence", " Mr. Smith left early. Then", " Mr. Smith left early."),
+    ("sentence", " Rivers, e.g. this one, run dry. Then", " Rivers, e.g. this one, run dry."),
+    ("paragraph", " First line, still going\nSecond", " First line, still going"),
+])
+def test_each_mode_cuts_at_its_boundary(mode, text, expected):
+    assert StopCondition(mode).trim(text) == expected
+
+
+@pytest.mark.parametrize("mode, text", [
+    # The unit is complete only once the next character has been generated
+    ("word", " Hello"),
+    ("sentence", " It rained."),
+    ("paragraph", " First line"),
+    ("tokens", " It rained. Then\nmore"),
+    # A multi-byte character still being decoded may continue the word
+    ("word", " caf\ufffd"),
+    ("sentence", " Ask Mr. Smith"),
+])
+def test_incomplete_units_do_not_stop(mode, text):
+    assert not StopCondition(mode).is_done(text)
+
+
+@pytest.mark.parametrize("batched", [True, False])
+def test_generations_stop_after_one_word(tiny_model, batched):
+    model, tokenizer = tiny_model
+    prompt = "The river ran low that summer, and the town"
+    outputs = generate_text(
+        prompt, prompt, " waited.", model=model, tokenizer=tokenizer,
+        temperatures=[0.5, 1.0, 1.5], seeds=[1, 2, 3], batched=batched, stop="word"
+    )
+    for output in outputs:
+        assert StopCondition("word").trim(output) == output
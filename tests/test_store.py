@@ -0,0 +1,25 @@
+import numpy as np
+
+from utils.store import ResultStore
+
+
+def test_rows_keep_full_precision_and_keys_match(tmp_path):
+    columns = ['essay', 'temperature', 'perplexity']
+    path = str(tmp_path / 'results.sqlite')
+    perplexity = 12.3456789012345
+    with ResultStore(path, 'results', columns, ['essay', 'temperature']) as store:
+        row = {'essay': 1, 'temperature': np.float64(0.1) * 3, 'perplexity': perplexity}
+        store.append([row])
+        assert store.key(row) in store.completed_keys()
+        assert store.to_dataframe()['perplexity'].iloc[0] == perplexity
+
+
+def test_new_columns_are_added_to_an_existing_store(tmp_path):
+    path = str(tmp_path / 'results.sqlite')
+    with ResultStore(path, 'results', ['essay', 'temperature'], ['essay']) as store:
+        store.append([{'essay': 1, 'temperature': 0.5}])
+    with ResultStore(path, 'results', ['essay', 'name', 'temperature'], ['essay']) as store:
+        store.append([{'essay': 2, 'name': 'essay-2', 'temperature': 1.0}])
+        rows = store.to_dataframe().sort_values('essay')
+    assert rows['name'].isna().tolist() == [True, False]
+    assert rows['temperature'].tolist() == [0.5, 1.0]
@@ -0,0 +1,20 @@
+import numpy as np
+
+from utils.surprisal import SurprisalIndex
+
+
+def make_index(log_prob):
+    n = len(log_prob)
+    starts = np.arange(n) * 2
+    return SurprisalIndex(np.arange(n), starts, starts + 2, log_prob, np.zeros(n), np.zeros(n))
+
+
+def test_short_text_has_no_passages():
+    index = make_index([np.nan, -1.0, -2.0])
+    assert len(index.rolling_surprisal(3)) == 0
+    assert index.top_passages(window=3) == []
+
+
+def test_top_passage_spans_its_window():
+    index = make_index([np.nan, -1.0, -5.0, -5.0, -1.0])
+    assert index.top_passages(n=1, window=2) == [(4, 8, 5.0)]
@@ -0,0 +1,13 @@
+import numpy as np
+
+from utils.sweep import AdaptiveSweep
+
+
+def test_non_finite_metric_keeps_priorities_finite():
+    def evaluate(temperatures):
+        return [np.nan if temp == 2.0 else temp for temp in temperatures]
+
+    sweep = AdaptiveSweep(evaluate, target=1.0, budget=7)
+    results = sweep.run()
+    assert len(results) == 7
+    assert all(np.isfinite(priority) for priority, _, _ in sweep.priorities())
@@ -0,0 +1,18 @@
+from utils.disk_cache import model_fingerprint
+from utils.temperature import LogitCache, cache_logits
+
+
+TEXT = "The river ran low that summer, and the town waited for rain. " * 4
+
+
+def test_logit_cache_keeps_its_metadata(tmp_path, tiny_model):
+    model, tokenizer = tiny_model
+    cache = cache_logits(TEXT, model, tokenizer)
+    cache.metadata = {'text_sha256': "abc", 'model': model_fingerprint(model)}
+    path = str(tmp_path / "logits.npz")
+    cache.save(path)
+
+    loaded = LogitCache.load(path)
+    assert loaded.metadata == cache.metadata
+    for field in LogitCache.fields:
+        assert (getattr(loaded, field) == getattr(cache, field)).all()